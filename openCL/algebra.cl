@@ -1,6 +1,30 @@
 
 typedef float4 keypoint;
 
+/*
+ Storage of the DoGs, float or half (-D HALF_DOGS), see image.cl
+*/
+#ifdef HALF_DOGS
+	#define DOG_T half
+	#define STORE_DOG(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define DOG_T float
+	#define STORE_DOG(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Storage of the gaussian levels, float or half (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+	#define STORE_LEVEL(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+	#define STORE_LEVEL(v, i, p) (p)[(i)] = (v)
+#endif
+
 /**
  * \brief Linear combination of two matrices
  *
@@ -16,11 +40,11 @@ typedef float4 keypoint;
  */
 
 __kernel void combine(
-	__global float *u,
+	__global LEVEL_T *u,
 	float a,
-	__global float *v,
+	__global LEVEL_T *v,
 	float b,
-	__global float *w,
+	__global DOG_T *w,
 	int dog,
 	int width,
 	int height)
@@ -32,7 +56,7 @@ __kernel void combine(
 	if (gid0 < width && gid1 < height) {
 		int index = gid0 + width * gid1;
 		int index_dog = dog * width * height +  index;
-		w[index_dog] = a * u[index] + b * v[index];
+		STORE_DOG(a * LOAD_LEVEL(index, u) + b * LOAD_LEVEL(index, v), index_dog, w);
 	}
 }
 
@@ -84,16 +108,286 @@ __kernel void compact(
 }
 
 
+/*
+ Exclusive prefix sum of the local_size(0) integers of data (Blelloch
+ work-efficient scan: the local size has to be a power of 2)
 
+ @return: sum of all values
+*/
+inline int exclusive_scan(__local int* data)
+{
+	int lid = (int) get_local_id(0);
+	int n = (int) get_local_size(0);
+	int offset = 1;
+	int total;
+	// up-sweep: partial sums in place
+	for (int d = n >> 1; d > 0; d >>= 1) {
+		barrier(CLK_LOCAL_MEM_FENCE);
+		if (lid < d)
+			data[offset * (2 * lid + 2) - 1] += data[offset * (2 * lid + 1) - 1];
+		offset <<= 1;
+	}
+	barrier(CLK_LOCAL_MEM_FENCE);
+	total = data[n - 1];
+	barrier(CLK_LOCAL_MEM_FENCE);
+	if (lid == 0)
+		data[n - 1] = 0;
+	// down-sweep
+	for (int d = 1; d < n; d <<= 1) {
+		offset >>= 1;
+		barrier(CLK_LOCAL_MEM_FENCE);
+		if (lid < d) {
+			int ai = offset * (2 * lid + 1) - 1;
+			int bi = offset * (2 * lid + 2) - 1;
+			int t = data[ai];
+			data[ai] = data[bi];
+			data[bi] += t;
+		}
+	}
+	barrier(CLK_LOCAL_MEM_FENCE);
+	return total;
+}
 
+/*
+ Keypoints [first, last) processed by the work-group in compact_count and compact_scatter:
+ the range [counters[0], counters[1]) is split in get_num_groups(0) contiguous chunks
+*/
+inline int2 compact_chunk(__global int* counters, int nb_keypoints)
+{
+	int start = counters[0];
+	int end = min(counters[1], nb_keypoints);
+	int groups = (int) get_num_groups(0);
+	int chunk = (max(end - start, 0) + groups - 1) / groups;
+	int first = start + (int) get_group_id(0) * chunk;
+	return (int2) (first, min(first + chunk, end));
+}
 
+/**
+ * \brief Stream compaction, step 1: number of valid keypoints in the chunk of each work-group
+ *
+ * The compaction of the keypoints [counters[0], counters[1]) is done in 3
+ * steps: compact_count, compact_offsets and compact_scatter. It keeps the
+ * order of the keypoints, does not use atomics and only reads and writes
+ * the compacted range.
+ *
+ * @param keypoints: Pointer to global memory with the keypoints, invalid ones having s1 == -1
+ * @param counters: Pointer to global memory with the start and the end of the range
+ * @param group_counts: Pointer to global memory with the output count of each work-group
+ * @param nb_keypoints: size of the keypoints vector
+ * @param scan: __local buffer of local_size(0) integers
+ */
+__kernel void compact_count(
+	__global keypoint* keypoints,
+	__global int* counters,
+	__global int* group_counts,
+	int nb_keypoints,
+	__local int* scan)
+{
+	int lid = (int) get_local_id(0);
+	int2 range = compact_chunk(counters, nb_keypoints);
+	int count = 0;
+	for (int i = range.s0 + lid; i < range.s1; i += (int) get_local_size(0))
+		if (keypoints[i].s1 != -1)
+			count++;
+	scan[lid] = count;
+	count = exclusive_scan(scan);
+	if (lid == 0)
+		group_counts[get_group_id(0)] = count;
+}
 
+/**
+ * \brief Stream compaction, step 2: exclusive prefix sum of the counts of the work-groups
+ *
+ * To be launched with a single work-group. The counter is set to the end of the compacted range.
+ *
+ * @param group_counts: Pointer to global memory with the counts, replaced by the offsets
+ * @param nb_groups: number of work-groups of compact_count
+ * @param counters: Pointer to global memory with the start and the end of the range
+ * @param output_start: index in counters of the start of the output: 0 to compact the range in place
+ * @param counter: Pointer to global memory with the output number of keypoints
+ * @param scan: __local buffer of local_size(0) integers
+ */
+__kernel void compact_offsets(
+	__global int* group_counts,
+	int nb_groups,
+	__global int* counters,
+	int output_start,
+	__global int* counter,
+	__local int* scan)
+{
+	int lid = (int) get_local_id(0);
+	int carry = 0;
+	for (int base = 0; base < nb_groups; base += (int) get_local_size(0)) {
+		int i = base + lid;
+		scan[lid] = (i < nb_groups) ? group_counts[i] : 0;
+		int total = exclusive_scan(scan);
+		if (i < nb_groups)
+			group_counts[i] = carry + scan[lid];
+		carry += total;
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+	if (lid == 0)
+		counter[0] = counters[output_start] + carry;
+}
 
+/**
+ * \brief Stream compaction, step 3: copy the valid keypoints of each chunk, in order
+ *
+ * @param keypoints: Pointer to global memory with the keypoints to compact
+ * @param output: Pointer to global memory with the compacted keypoints, from counters[output_start]
+ * @param counters: Pointer to global memory with the start and the end of the range
+ * @param output_start: index in counters of the start of the output: 0 to compact the range in place
+ * @param group_offsets: Pointer to global memory with the offsets of the work-groups (compact_offsets)
+ * @param nb_keypoints: size of the keypoints vectors
+ * @param scan: __local buffer of local_size(0) integers
+ */
+__kernel void compact_scatter(
+	__global keypoint* keypoints,
+	__global keypoint* output,
+	__global int* counters,
+	int output_start,
+	__global int* group_offsets,
+	int nb_keypoints,
+	__local int* scan)
+{
+	int lid = (int) get_local_id(0);
+	int2 range = compact_chunk(counters, nb_keypoints);
+	int offset = counters[output_start] + group_offsets[get_group_id(0)];
+	for (int base = range.s0; base < range.s1; base += (int) get_local_size(0)) {
+		int i = base + lid;
+		keypoint k = -1.0f;
+		if (i < range.s1)
+			k = keypoints[i];
+		scan[lid] = (k.s1 != -1) ? 1 : 0;
+		int total = exclusive_scan(scan);
+		if ((k.s1 != -1) && (offset + scan[lid] < nb_keypoints))
+			output[offset + scan[lid]] = k;
+		offset += total;
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+}
 
 
+/*
+ Bin of the histogram of the responses |DoG|, on a log scale covering 16
+ octaves above the peak threshold
+*/
+inline int response_bin(float response, float peak_thresh, int nb_bins)
+{
+	int bin = (int) ((nb_bins / 16) * log2(fabs(response) / peak_thresh));
+	return clamp(bin, 0, nb_bins - 1);
+}
 
+/**
+ * \brief Histogram of the responses of the keypoints [0, counter[0]) (refined, with the response in s0)
+ *
+ * Each work-group accumulates its keypoints in local memory, then adds its
+ * histogram to the global one, which has to be cleared before.
+ *
+ * @param keypoints: Pointer to global memory with the keypoints (peak, r, c, sigma)
+ * @param counter: Pointer to global memory with the number of keypoints
+ * @param histogram: Pointer to global memory with the histogram of nb_bins integers
+ * @param nb_keypoints: size of the keypoints vector
+ * @param peak_thresh: lowest response of the keypoints (par.PeakThresh)
+ * @param nb_bins: number of bins of the histogram, multiple of 16
+ * @param hist: __local buffer of nb_bins integers
+ */
+__kernel void response_histogram(
+	__global keypoint* keypoints,
+	__global int* counter,
+	__global int* histogram,
+	int nb_keypoints,
+	float peak_thresh,
+	int nb_bins,
+	__local int* hist)
+{
+	int lid = (int) get_local_id(0);
+	int end = min(counter[0], nb_keypoints);
+	for (int i = lid; i < nb_bins; i += (int) get_local_size(0))
+		hist[i] = 0;
+	barrier(CLK_LOCAL_MEM_FENCE);
+	for (int i = (int) get_global_id(0); i < end; i += (int) get_global_size(0))
+		atomic_inc(hist + response_bin(keypoints[i].s0, peak_thresh, nb_bins));
+	barrier(CLK_LOCAL_MEM_FENCE);
+	for (int i = lid; i < nb_bins; i += (int) get_local_size(0))
+		if (hist[i])
+			atomic_add(histogram + i, hist[i]);
+}
 
+/**
+ * \brief Threshold keeping the budget strongest keypoints of the histogram
+ *
+ * To be launched with a single work-item. The bins above threshold[0] are
+ * kept, and threshold[1] keypoints of the bin threshold[0]; threshold[0] is
+ * -1 when all the keypoints fit in the budget.
+ *
+ * @param histogram: Pointer to global memory with the histogram of the responses
+ * @param nb_bins: number of bins of the histogram
+ * @param budget: maximum number of keypoints
+ * @param threshold: Pointer to global memory with the output bin and the number of keypoints left for it
+ */
+__kernel void response_threshold(
+	__global int* histogram,
+	int nb_bins,
+	int budget,
+	__global int* threshold)
+{
+	int kept = 0;
+	int bin = nb_bins - 1;
+	while ((bin >= 0) && (kept + histogram[bin] <= budget))
+		kept += histogram[bin--];
+	threshold[0] = bin;
+	threshold[1] = budget - kept;
+}
 
-
-
-
+/**
+ * \brief Select the strongest keypoints of a range, before their compaction at the end of the keypoints
+ *
+ * The keypoints [bounds[first], bounds[last]) are copied to output at the
+ * same indices, those below the threshold being invalidated (s1 == -1).
+ * counters is set to the range and to the current number of keypoints, so
+ * that compact_count, compact_offsets and compact_scatter with
+ * output_start=2 append the selected keypoints.
+ *
+ * @param keypoints: Pointer to global memory with the keypoints of the first pass (peak, r, c, sigma)
+ * @param output: Pointer to global memory with the selected keypoints
+ * @param bounds: Pointer to global memory with the ends of the ranges of the first pass
+ * @param first: index in bounds of the start of the range
+ * @param last: index in bounds of the end of the range
+ * @param counter: Pointer to global memory with the number of keypoints
+ * @param counters: Pointer to global memory with the output start and end of the range and number of keypoints
+ * @param threshold: Pointer to global memory with the result of response_threshold
+ * @param nb_keypoints: size of the keypoints vectors
+ * @param peak_thresh: lowest response of the keypoints (par.PeakThresh)
+ * @param nb_bins: number of bins of the histogram
+ */
+__kernel void select_keypoints(
+	__global keypoint* keypoints,
+	__global keypoint* output,
+	__global int* bounds,
+	int first,
+	int last,
+	__global int* counter,
+	__global int* counters,
+	__global int* threshold,
+	int nb_keypoints,
+	float peak_thresh,
+	int nb_bins)
+{
+	int start = bounds[first];
+	int end = min(bounds[last], nb_keypoints);
+	int gid0 = (int) get_global_id(0);
+	if (gid0 == 0) {
+		counters[0] = start;
+		counters[1] = end;
+		counters[2] = counter[0];
+	}
+	for (int i = start + gid0; i < end; i += (int) get_global_size(0)) {
+		keypoint k = keypoints[i];
+		int bin = response_bin(k.s0, peak_thresh, nb_bins);
+		// the slots of the threshold bin go to the first keypoints reaching them
+		if ((bin < threshold[0]) || ((bin == threshold[0]) && (atomic_dec(threshold + 1) <= 0)))
+			k = -1.0f;
+		output[i] = k;
+	}
+}
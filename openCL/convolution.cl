@@ -7,15 +7,56 @@
 
 #define MAX_CONST_SIZE 16384
 
+/*
+ Compile-time specialization: when FILTER_SIZE, IMAGE_W or IMAGE_H are
+ defined at build time (i.e. -D FILTER_SIZE=9), the corresponding argument
+ of the kernel is ignored and the compiler can unroll the loops.
+*/
+#ifndef FILTER_SIZE
+	#define FILTER_SIZE filter_size
+#endif
+#ifndef IMAGE_W
+	#define IMAGE_W image_w
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H image_h
+#endif
+
+/*
+ Storage of the DoGs, float or half (-D HALF_DOGS), see image.cl
+*/
+#ifdef HALF_DOGS
+	#define DOG_T half
+	#define STORE_DOG(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define DOG_T float
+	#define STORE_DOG(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Storage of the gaussian levels and of the temporary buffer, float or half
+ (-D HALF_LEVELS), see image.cl. The raw image read by the normalizing
+ passes is always float.
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+	#define STORE_LEVEL(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+	#define STORE_LEVEL(v, i, p) (p)[(i)] = (v)
+#endif
+
 
 
 __kernel void horizontal_convolution(
-	const __global float * input, 
-	__global float * output,
+	const __global LEVEL_T * input, 
+	__global LEVEL_T * output,
 	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
-	int FILTER_SIZE,
-	int IMAGE_W,
-	int IMAGE_H
+	int filter_size,
+	int image_w,
+	int image_h
 )
 {
 	int gid1 = (int) get_global_id(1);
@@ -47,13 +88,13 @@ __kernel void horizontal_convolution(
 				//newpos= pos - c+1; //newpos - 2*c;
 				//debug = 1;	
 			}
-			sum += input[ newpos ] * filter[ fIndex  ];
+			sum += LOAD_LEVEL(newpos, input) * filter[ fIndex  ];
 			
 			fIndex += 1;
 			
 		}
 		
-		output[pos]=sum;
+		STORE_LEVEL(sum, pos, output);
 	}
 }
 
@@ -66,12 +107,12 @@ __kernel void horizontal_convolution(
 
 
 __kernel void vertical_convolution(
-	const __global float * input, 
-	__global float * output,
+	const __global LEVEL_T * input, 
+	__global LEVEL_T * output,
 	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
-	int FILTER_SIZE,
-	int IMAGE_W,
-	int IMAGE_H
+	int filter_size,
+	int image_w,
+	int image_h
 )
 {
 	
@@ -100,12 +141,12 @@ __kernel void vertical_convolution(
 			else if (gid1+r > IMAGE_H -1) {
 				newpos= (IMAGE_H-1)*IMAGE_W + gid0 + (IMAGE_H - r)*IMAGE_W - gid1*IMAGE_W;
 			}
-			sum += input[ newpos ] * filter[ fIndex   ];
+			sum += LOAD_LEVEL(newpos, input) * filter[ fIndex   ];
 			fIndex += 1;
 		
 		}
-		output[pos]=sum;
-		if (debug == 1) output[pos]=0;
+		STORE_LEVEL(sum, pos, output);
+		if (debug == 1) STORE_LEVEL(0.0f, pos, output);
 	}
 }
 
@@ -114,6 +155,405 @@ __kernel void vertical_convolution(
 /*
 */
 
+/*
+ Horizontal convolution of the raw image, normalized on the fly between 0
+ and max_out: this replaces the "normalizes" pass before the first blur.
+*/
+__kernel void horizontal_convolution_normalize(
+	const __global float * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global float * min_in,
+	const __global float * max_in,
+	float max_out
+)
+{
+	int gid1 = (int) get_global_id(1);
+	int gid0 = (int) get_global_id(0);
+	int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		float offset = min_in[0];
+		float scale = max_out / (max_in[0] - offset);
+		int pos = gid1*IMAGE_W + gid0;
+		int fIndex = 0;
+		float sum = 0.0f;
+		int c = 0;
+		int newpos = 0;
+		for (c = -HALF_FILTER_SIZE ; c < FILTER_SIZE-HALF_FILTER_SIZE ; c++) {
+			newpos = pos + c;
+			if (gid0 + c < 0) {
+				newpos= pos - 2*gid0 - c - 1;
+			}
+			else if (gid0 + c > IMAGE_W -1 ) {
+				newpos= (gid1+2)*IMAGE_W - gid0 -c -1;
+			}
+			sum += (input[ newpos ] - offset) * filter[ fIndex  ];
+			fIndex += 1;
+		}
+		STORE_LEVEL(sum * scale, pos, output);
+	}
+}
+
+
+/*
+ Tiled separable convolution with local memory
 
+ Each workgroup loads its tile and the halo of the filter into local memory
+ once, with the borders mirrored at load time, so that the inner loop only
+ reads local memory and has no branch. The tile is passed by the host as a
+ __local buffer of:
+  - horizontal: local_size(1) * (local_size(0) + filter_size - 1) floats
+  - vertical: local_size(0) * (local_size(1) * rows + filter_size - 1) floats
+*/
 
+inline int mirror(int i, int size)
+{
+	if (i < 0)
+		i = -i - 1;
+	else if (i >= size)
+		i = 2 * size - i - 1;
+	return clamp(i, 0, size - 1);
+}
 
+/*
+ The line of the tile of the work-item, its first pixel being the one at
+ x = first in the image
+*/
+inline __local float * horizontal_line(
+	__local float * tile,
+	int filter_size,
+	int * first
+)
+{
+	int ls0 = (int) get_local_size(0);
+	int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+	*first = (int) get_group_id(0) * ls0 - HALF_FILTER_SIZE;
+	return tile + get_local_id(1) * (ls0 + FILTER_SIZE - 1);
+}
+
+/*
+ Convolution of the tile, once loaded by all work-items of the group
+*/
+inline void horizontal_tile(
+	__global LEVEL_T * output,
+	__constant float * filter,
+	int filter_size,
+	int image_w,
+	int image_h,
+	__local float * local_line,
+	float scale
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	int lid0 = (int) get_local_id(0);
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		float sum = 0.0f;
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += local_line[lid0 + f] * filter[f];
+		STORE_LEVEL(sum * scale, gid1 * IMAGE_W + gid0, output);
+	}
+}
+
+__kernel void horizontal_convolution_tiled(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	__local float * tile
+)
+{
+	int x0, ls0 = (int) get_local_size(0);
+	__local float * local_line = horizontal_line(tile, filter_size, &x0);
+	const __global LEVEL_T * line = input + min((int) get_global_id(1), IMAGE_H - 1) * IMAGE_W;
+	for (int i = (int) get_local_id(0); i < ls0 + FILTER_SIZE - 1; i += ls0)
+		local_line[i] = LOAD_LEVEL(mirror(x0 + i, IMAGE_W), line);
+	horizontal_tile(output, filter, filter_size, image_w, image_h, local_line, 1.0f);
+}
+
+/*
+ Same as horizontal_convolution_normalize, with the tiled engine
+*/
+__kernel void horizontal_convolution_normalize_tiled(
+	const __global float * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global float * min_in,
+	const __global float * max_in,
+	float max_out,
+	__local float * tile
+)
+{
+	float offset = min_in[0];
+	int x0, ls0 = (int) get_local_size(0);
+	__local float * local_line = horizontal_line(tile, filter_size, &x0);
+	const __global float * line = input + min((int) get_global_id(1), IMAGE_H - 1) * IMAGE_W;
+	for (int i = (int) get_local_id(0); i < ls0 + FILTER_SIZE - 1; i += ls0)
+		local_line[i] = line[mirror(x0 + i, IMAGE_W)] - offset;
+	horizontal_tile(output, filter, filter_size, image_w, image_h, local_line,
+	                max_out / (max_in[0] - offset));
+}
+
+/*
+ Each work-item calculates "rows" pixels of a column, spaced by local_size(1),
+ so that the halo is shared by local_size(1) * rows output lines.
+*/
+inline void vertical_tile(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter,
+	int filter_size,
+	int image_w,
+	int image_h,
+	int rows,
+	__local float * tile,
+	const __global LEVEL_T * previous,
+	__global DOG_T * dogs,
+	int dog
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int lid0 = (int) get_local_id(0);
+	int lid1 = (int) get_local_id(1);
+	int ls0 = (int) get_local_size(0);
+	int ls1 = (int) get_local_size(1);
+	int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+	int block_h = ls1 * rows;
+	int tile_h = block_h + FILTER_SIZE - 1;
+	int y0 = (int) get_group_id(1) * block_h;
+	int x = min(gid0, IMAGE_W - 1);
+
+	for (int i = lid1; i < tile_h; i += ls1)
+		tile[i * ls0 + lid0] = LOAD_LEVEL(mirror(y0 - HALF_FILTER_SIZE + i, IMAGE_H) * IMAGE_W + x, input);
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	if (gid0 < IMAGE_W) {
+		for (int j = 0; j < rows; j++) {
+			int ly = lid1 + j * ls1;
+			if (y0 + ly < IMAGE_H) {
+				float sum = 0.0f;
+				int pos = (y0 + ly) * IMAGE_W + gid0;
+				for (int f = 0; f < FILTER_SIZE; f++)
+					sum += tile[(ly + f) * ls0 + lid0] * filter[f];
+				STORE_LEVEL(sum, pos, output);
+				if (dogs)
+					STORE_DOG(LOAD_LEVEL(pos, previous) - sum, dog * IMAGE_W * IMAGE_H + pos, dogs);
+			}
+		}
+	}
+}
+
+__kernel void vertical_convolution_tiled(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	int rows,
+	__local float * tile
+)
+{
+	vertical_tile(input, output, filter, filter_size, image_w, image_h, rows, tile, 0, 0, 0);
+}
+
+
+/*
+ Transposed separable convolution, for CPU devices
+
+ The horizontal pass writes its result transposed, so that the vertical
+ pass is again a convolution along contiguous lines, which writes the result
+ back in the original orientation. All reads are contiguous.
+*/
+
+inline float line_convolution(
+	const __global LEVEL_T * line,
+	__constant float * filter,
+	int filter_size,
+	int x,
+	int width
+)
+{
+	int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+	int start = x - HALF_FILTER_SIZE;
+	float sum = 0.0f;
+	if ((start >= 0) && (start + FILTER_SIZE <= width)) {
+		// inner part of the line: no border
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += LOAD_LEVEL(start + f, line) * filter[f];
+	}
+	else {
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += LOAD_LEVEL(mirror(start + f, width), line) * filter[f];
+	}
+	return sum;
+}
+
+/*
+ Same as line_convolution for a line of the raw (float) image, shifted by offset
+*/
+inline float line_convolution_normalize(
+	const __global float * line,
+	__constant float * filter,
+	int filter_size,
+	int x,
+	int width,
+	float offset
+)
+{
+	int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+	int start = x - HALF_FILTER_SIZE;
+	float sum = 0.0f;
+	if ((start >= 0) && (start + FILTER_SIZE <= width)) {
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += (line[start + f] - offset) * filter[f];
+	}
+	else {
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += (line[mirror(start + f, width)] - offset) * filter[f];
+	}
+	return sum;
+}
+
+/*
+ Horizontal convolution of an image of IMAGE_W x IMAGE_H,
+ the output is transposed (IMAGE_H x IMAGE_W).
+*/
+__kernel void horizontal_convolution_transpose(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W)
+		STORE_LEVEL(line_convolution(input + gid1 * IMAGE_W, filter, filter_size, gid0, IMAGE_W), gid0 * IMAGE_H + gid1, output);
+}
+
+__kernel void horizontal_convolution_normalize_transpose(
+	const __global float * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global float * min_in,
+	const __global float * max_in,
+	float max_out
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		float offset = min_in[0];
+		float scale = max_out / (max_in[0] - offset);
+		STORE_LEVEL(line_convolution_normalize(input + gid1 * IMAGE_W, filter, filter_size, gid0, IMAGE_W, offset) * scale,
+		            gid0 * IMAGE_H + gid1, output);
+	}
+}
+
+/*
+ Vertical convolution of an image of IMAGE_W x IMAGE_H stored transposed:
+ the input has IMAGE_W lines of IMAGE_H pixels, the output is in the
+ original orientation. To be launched on (IMAGE_H, IMAGE_W).
+*/
+__kernel void vertical_convolution_transposed(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_W && gid0 < IMAGE_H)
+		STORE_LEVEL(line_convolution(input + gid1 * IMAGE_H, filter, filter_size, gid0, IMAGE_H), gid0 * IMAGE_W + gid1, output);
+}
+
+
+/*
+ Vertical passes fused with the difference of gaussians: besides the new
+ gaussian level (output), they write previous - output into the slice dog of
+ the DoG stack, while previous (the level which was blurred) is read in the
+ same pass. This saves a full pass (two reads and one write) per level.
+*/
+
+__kernel void vertical_convolution_dog(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global LEVEL_T * previous,
+	__global DOG_T * dogs,
+	int dog
+)
+{
+	int gid1 = (int) get_global_id(1);
+	int gid0 = (int) get_global_id(0);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+		int pos = gid1 * IMAGE_W + gid0;
+		float sum = 0.0f;
+		for (int r = -HALF_FILTER_SIZE, f = 0; f < FILTER_SIZE; r++, f++)
+			sum += LOAD_LEVEL(mirror(gid1 + r, IMAGE_H) * IMAGE_W + gid0, input) * filter[f];
+		STORE_LEVEL(sum, pos, output);
+		STORE_DOG(LOAD_LEVEL(pos, previous) - sum, dog * IMAGE_W * IMAGE_H + pos, dogs);
+	}
+}
+
+__kernel void vertical_convolution_tiled_dog(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	int rows,
+	__local float * tile,
+	const __global LEVEL_T * previous,
+	__global DOG_T * dogs,
+	int dog
+)
+{
+	vertical_tile(input, output, filter, filter_size, image_w, image_h, rows, tile, previous, dogs, dog);
+}
+
+__kernel void vertical_convolution_transposed_dog(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global LEVEL_T * previous,
+	__global DOG_T * dogs,
+	int dog
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_W && gid0 < IMAGE_H) {
+		int pos = gid0 * IMAGE_W + gid1;
+		float sum = line_convolution(input + gid1 * IMAGE_H, filter, filter_size, gid0, IMAGE_H);
+		STORE_LEVEL(sum, pos, output);
+		STORE_DOG(LOAD_LEVEL(pos, previous) - sum, dog * IMAGE_W * IMAGE_H + pos, dogs);
+	}
+}
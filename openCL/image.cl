@@ -25,11 +25,80 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 128
 #endif
 
+/*
+ Storage of the DoGs: when compiled with -D HALF_DOGS, the DoGs are stored
+ as half (vload_half / vstore_half, which do not need cl_khr_fp16) and all
+ calculations are done in float.
+*/
+#ifdef HALF_DOGS
+	#define DOG_T half
+	#define LOAD_DOG(i, p) vload_half((i), (p))
+	#define STORE_DOG(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define DOG_T float
+	#define LOAD_DOG(i, p) (p)[(i)]
+	#define STORE_DOG(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Storage of the gaussian levels, of the gradient and of its orientation:
+ when compiled with -D HALF_LEVELS, they are stored as half like the DoGs.
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+	#define STORE_LEVEL(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+	#define STORE_LEVEL(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Rolling window of DoGs: when compiled with -D DOG_SLICES=3, the DoG of
+ index s is stored in the slice s % DOG_SLICES (low memory mode).
+*/
+#ifdef DOG_SLICES
+	#define DOG_SLICE(s) ((s) % DOG_SLICES)
+#else
+	#define DOG_SLICE(s) (s)
+#endif
+
 /*
  Do not use __constant memory for large (usual) images
 */
 #define MAX_CONST_SIZE 16384
 
+/*
+ Compile-time specialization: when any of the following is defined at build
+ time (i.e. -D IMAGE_W=1024), the corresponding argument of the kernels is
+ ignored and the value is folded by the compiler.
+*/
+#ifndef IMAGE_W
+	#define IMAGE_W width
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H height
+#endif
+#ifndef BORDER_DIST
+	#define BORDER_DIST border_dist
+#endif
+#ifndef PEAK_THRESH
+	#define PEAK_THRESH peak_thresh
+#endif
+#ifndef OCTSIZE
+	#define OCTSIZE octsize
+#endif
+#ifndef EDGE_THRESH0
+	#define EDGE_THRESH0 EdgeThresh0
+#endif
+#ifndef EDGE_THRESH
+	#define EDGE_THRESH EdgeThresh
+#endif
+#ifndef INIT_SIGMA
+	#define INIT_SIGMA InitSigma
+#endif
+
 /**
  * \brief Gradient of a grayscale image
  *
@@ -45,9 +114,9 @@ typedef float4 keypoint;
 
 
 __kernel void compute_gradient_orientation(
-	__global float* igray, // __attribute__((max_constant_size(MAX_CONST_SIZE))),
-	__global float *grad,
-	__global float *ori,
+	__global LEVEL_T* igray, // __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	__global LEVEL_T *grad,
+	__global LEVEL_T *ori,
 	int width,
 	int height)
 {
@@ -55,26 +124,26 @@ __kernel void compute_gradient_orientation(
 	int gid1 = (int) get_global_id(1);
 	int gid0 = (int) get_global_id(0);
 
-	if (gid1 < height && gid0 < width) {
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
 
 		float xgrad, ygrad;
-		int pos = gid1*width+gid0;
+		int pos = gid1*IMAGE_W+gid0;
 
         if (gid0 == 0)
-			xgrad = 2.0f * (igray[pos+1] - igray[pos]);
-        else if (gid0 == width-1)
-			xgrad = 2.0f * (igray[pos] - igray[pos-1]);
+			xgrad = 2.0f * (LOAD_LEVEL(pos+1, igray) - LOAD_LEVEL(pos, igray));
+        else if (gid0 == IMAGE_W-1)
+			xgrad = 2.0f * (LOAD_LEVEL(pos, igray) - LOAD_LEVEL(pos-1, igray));
         else
-			xgrad = igray[pos+1] - igray[pos-1];
+			xgrad = LOAD_LEVEL(pos+1, igray) - LOAD_LEVEL(pos-1, igray);
         if (gid1 == 0)
-			ygrad = 2.0f * (igray[pos] - igray[pos + width]);
-        else if (gid1 == height-1)
-			ygrad = 2.0f * (igray[pos - width] - igray[pos]);
+			ygrad = 2.0f * (LOAD_LEVEL(pos, igray) - LOAD_LEVEL(pos + IMAGE_W, igray));
+        else if (gid1 == IMAGE_H-1)
+			ygrad = 2.0f * (LOAD_LEVEL(pos - IMAGE_W, igray) - LOAD_LEVEL(pos, igray));
         else
-			ygrad = igray[pos - width] - igray[pos + width];
+			ygrad = LOAD_LEVEL(pos - IMAGE_W, igray) - LOAD_LEVEL(pos + IMAGE_W, igray);
 
-        grad[pos] = sqrt((xgrad * xgrad + ygrad * ygrad));
-        ori[pos] = atan2 (-ygrad,xgrad);
+        STORE_LEVEL(sqrt((xgrad * xgrad + ygrad * ygrad)), pos, grad);
+        STORE_LEVEL(atan2 (-ygrad,xgrad), pos, ori);
 
       }
 }
@@ -116,8 +185,11 @@ TODO:
 */
 
 
-__kernel void local_maxmin(
-	__global float* DOGS,
+/*
+ Search for an extremum at pixel (gid0, gid1): shared by local_maxmin and local_maxmin_masked
+*/
+inline void local_maxmin_pixel(
+	__global DOG_T* DOGS,
 	__global keypoint* output,
 	int border_dist,
 	float peak_thresh,
@@ -128,28 +200,27 @@ __kernel void local_maxmin(
 	int nb_keypoints,
 	int scale,
 	int width,
-	int height)
+	int height,
+	int gid0,
+	int gid1)
 {
-
-	int gid1 = (int) get_global_id(1);
-	int gid0 = (int) get_global_id(0);
 	/*
 		As the DOGs are contiguous, we have to test if (gid0,gid1) is actually in DOGs[s]
 	*/
 
-	if ((gid1 < height - border_dist) && (gid0 < width - border_dist) && (gid1 >= border_dist) && (gid0 >= border_dist)) {
-		int index_dog_prev = (scale-1)*(width*height);
-		int index_dog =scale*(width*height);
-		int index_dog_next =(scale+1)*(width*height);
+	if ((gid1 < IMAGE_H - BORDER_DIST) && (gid0 < IMAGE_W - BORDER_DIST) && (gid1 >= BORDER_DIST) && (gid0 >= BORDER_DIST)) {
+		int index_dog_prev = DOG_SLICE(scale-1)*(IMAGE_W*IMAGE_H);
+		int index_dog = DOG_SLICE(scale)*(IMAGE_W*IMAGE_H);
+		int index_dog_next = DOG_SLICE(scale+1)*(IMAGE_W*IMAGE_H);
 
 		float res = 0.0f;
-		float val = DOGS[index_dog + gid0 + width*gid1];
+		float val = LOAD_DOG(index_dog + gid0 + IMAGE_W*gid1, DOGS);
 
 		/*
 		The following condition is part of the keypoints refinement: we eliminate the low-contrast points
 		NOTE: "fabsf" instead of "fabs" should be used, for "fabs" if for doubles. Used "fabs" to be coherent with python
 		*/
-		if (fabs(val) > (0.8 * peak_thresh)) {
+		if (fabs(val) > (0.8 * PEAK_THRESH)) {
 
 			int c,r,pos;
 			int ismax = 0, ismin = 0;
@@ -158,11 +229,11 @@ __kernel void local_maxmin(
 			for (r = gid1  - 1; r <= gid1 + 1; r++) {
 				for (c = gid0 - 1; c <= gid0 + 1; c++) {
 				
-					pos = r*width + c;
+					pos = r*IMAGE_W + c;
 					if (ismax == 1) //if (val > 0.0)
-						if (DOGS[index_dog_prev+pos] > val || DOGS[index_dog+pos] > val || DOGS[index_dog_next+pos] > val) ismax = 0;
+						if (LOAD_DOG(index_dog_prev+pos, DOGS) > val || LOAD_DOG(index_dog+pos, DOGS) > val || LOAD_DOG(index_dog_next+pos, DOGS) > val) ismax = 0;
 					if (ismin == 1) //else
-						if (DOGS[index_dog_prev+pos] < val || DOGS[index_dog+pos] < val || DOGS[index_dog_next+pos] < val) ismin = 0;
+						if (LOAD_DOG(index_dog_prev+pos, DOGS) < val || LOAD_DOG(index_dog+pos, DOGS) < val || LOAD_DOG(index_dog_next+pos, DOGS) < val) ismin = 0;
 				}
 			}
 
@@ -175,13 +246,13 @@ __kernel void local_maxmin(
 			   Hessian eigenvalues
 			*/
 
-			pos = gid1*width+gid0;
+			pos = gid1*IMAGE_W+gid0;
 
-			float H00 = DOGS[index_dog+(gid1-1)*width+gid0] - 2.0 * DOGS[index_dog+pos] + DOGS[index_dog+(gid1+1)*width+gid0],
-			H11 = DOGS[index_dog+pos-1] - 2.0 * DOGS[index_dog+pos] + DOGS[index_dog+pos+1],
-			H01 = ( (DOGS[index_dog+(gid1+1)*width+gid0+1]
-					- DOGS[index_dog+(gid1+1)*width+gid0-1])
-					- (DOGS[index_dog+(gid1-1)*width+gid0+1] - DOGS[index_dog+(gid1-1)*width+gid0-1])) / 4.0;
+			float H00 = LOAD_DOG(index_dog+(gid1-1)*IMAGE_W+gid0, DOGS) - 2.0 * LOAD_DOG(index_dog+pos, DOGS) + LOAD_DOG(index_dog+(gid1+1)*IMAGE_W+gid0, DOGS),
+			H11 = LOAD_DOG(index_dog+pos-1, DOGS) - 2.0 * LOAD_DOG(index_dog+pos, DOGS) + LOAD_DOG(index_dog+pos+1, DOGS),
+			H01 = ( (LOAD_DOG(index_dog+(gid1+1)*IMAGE_W+gid0+1, DOGS)
+					- LOAD_DOG(index_dog+(gid1+1)*IMAGE_W+gid0-1, DOGS))
+					- (LOAD_DOG(index_dog+(gid1-1)*IMAGE_W+gid0+1, DOGS) - LOAD_DOG(index_dog+(gid1-1)*IMAGE_W+gid0-1, DOGS))) / 4.0;
 
 			float det = H00 * H11 - H01 * H01, trace = H00 + H11;
 
@@ -190,7 +261,7 @@ __kernel void local_maxmin(
 			   Note that the following "EdgeThresh" seem to be the inverse of the ratio upper limit
 			*/
 
-			float edthresh = (octsize <= 1 ? EdgeThresh0 : EdgeThresh);
+			float edthresh = (OCTSIZE <= 1 ? EDGE_THRESH0 : EDGE_THRESH);
 
 			if (det < edthresh * trace * trace)
 				res = 0.0f;
@@ -212,6 +283,226 @@ __kernel void local_maxmin(
 	}//end "in the inner image"
 }
 
+__kernel void local_maxmin(
+	__global DOG_T* DOGS,
+	__global keypoint* output,
+	int border_dist,
+	float peak_thresh,
+	int octsize,
+	float EdgeThresh0,
+	float EdgeThresh,
+	__global int* counter,
+	int nb_keypoints,
+	int scale,
+	int width,
+	int height)
+{
+	local_maxmin_pixel(DOGS, output, border_dist, peak_thresh, octsize, EdgeThresh0, EdgeThresh,
+	                   counter, nb_keypoints, scale, width, height,
+	                   (int) get_global_id(0), (int) get_global_id(1));
+}
+
+
+/**
+ * \brief Same as local_maxmin, restricted to the valid pixels of a mask
+ *
+ * Masked pixels return before reading the DoGs, so that work-groups lying
+ * in a fully masked region (beamstop, detector gaps) do nothing and masked
+ * regions do not use the keypoints vector.
+ *
+ * @param mask: Pointer to global memory with the mask of the octave (width x height): 0 for invalid pixels
+ * Other parameters are those of local_maxmin
+ */
+__kernel void local_maxmin_masked(
+	__global DOG_T* DOGS,
+	__global keypoint* output,
+	__global unsigned char* mask,
+	int border_dist,
+	float peak_thresh,
+	int octsize,
+	float EdgeThresh0,
+	float EdgeThresh,
+	__global int* counter,
+	int nb_keypoints,
+	int scale,
+	int width,
+	int height)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if ((gid0 >= IMAGE_W) || (gid1 >= IMAGE_H) || (mask[gid1 * IMAGE_W + gid0] == 0))
+		return;
+	local_maxmin_pixel(DOGS, output, border_dist, peak_thresh, octsize, EdgeThresh0, EdgeThresh,
+	                   counter, nb_keypoints, scale, width, height, gid0, gid1);
+}
+
+
+
+
+/*
+ Load the DoG "scale" of the (ls0+2) x (ls1+2) neighbourhood of the
+ work-group into a slice of the local tile (coordinates are clamped: the
+ border pixels are never tested)
+*/
+inline void load_dog_tile(
+	__global DOG_T* DOGS,
+	__local float* slice,
+	int scale,
+	int width,
+	int height)
+{
+	int lid = (int) (get_local_id(1) * get_local_size(0) + get_local_id(0));
+	int tile_w = (int) get_local_size(0) + 2;
+	int tile_size = tile_w * ((int) get_local_size(1) + 2);
+	int x0 = (int) (get_group_id(0) * get_local_size(0)) - 1;
+	int y0 = (int) (get_group_id(1) * get_local_size(1)) - 1;
+	int index_dog = DOG_SLICE(scale)*(IMAGE_W*IMAGE_H);
+	for (int i = lid; i < tile_size; i += (int) (get_local_size(0) * get_local_size(1))) {
+		int x = clamp(x0 + i % tile_w, 0, IMAGE_W - 1);
+		int y = clamp(y0 + i / tile_w, 0, IMAGE_H - 1);
+		slice[i] = LOAD_DOG(index_dog + y * IMAGE_W + x, DOGS);
+	}
+}
+
+/*
+ Same tests as local_maxmin_pixel, on the DoGs staged in local memory:
+ prev, cur and next point at the pixel (gid0, gid1) in the slices scale-1,
+ scale and scale+1 of the tile.
+*/
+inline void local_maxmin_local(
+	__local float* prev,
+	__local float* cur,
+	__local float* next,
+	int tile_w,
+	__global keypoint* output,
+	float peak_thresh,
+	int octsize,
+	float EdgeThresh0,
+	float EdgeThresh,
+	__global int* counter,
+	int nb_keypoints,
+	int scale,
+	int gid0,
+	int gid1)
+{
+	float val = cur[0];
+	if (fabs(val) > (0.8 * PEAK_THRESH)) {
+		int ismax = (val > 0.0) ? 1 : 0;
+		int ismin = 1 - ismax;
+		for (int r = -1; r <= 1; r++) {
+			for (int c = -1; c <= 1; c++) {
+				int pos = r * tile_w + c;
+				if (ismax == 1)
+					if (prev[pos] > val || cur[pos] > val || next[pos] > val) ismax = 0;
+				if (ismin == 1)
+					if (prev[pos] < val || cur[pos] < val || next[pos] < val) ismin = 0;
+			}
+		}
+		if (ismax == 1 || ismin == 1) {
+			float H00 = cur[-tile_w] - 2.0 * val + cur[tile_w],
+			H11 = cur[-1] - 2.0 * val + cur[1],
+			H01 = ((cur[tile_w + 1] - cur[tile_w - 1]) - (cur[-tile_w + 1] - cur[-tile_w - 1])) / 4.0;
+			float det = H00 * H11 - H01 * H01, trace = H00 + H11;
+			float edthresh = (OCTSIZE <= 1 ? EDGE_THRESH0 : EDGE_THRESH);
+			if (det >= edthresh * trace * trace) {
+				int old = atomic_inc(counter);
+				keypoint k = 0.0;
+				k.s0 = val;
+				k.s1 = (float) gid1;
+				k.s2 = (float) gid0;
+				k.s3 = (float) scale;
+				if (old < nb_keypoints) output[old]=k;
+			}
+		}
+	}
+}
+
+/**
+ * \brief Local minimum or maximum detection over all the scales of an octave, in one launch
+ *
+ * Each work-group keeps a rolling window of 3 DoG slices of its tile (and
+ * its 1-pixel halo) in local memory, so that every DoG is read once from
+ * global memory instead of 3 times (once per scale using it). The
+ * candidates of all scales are appended to the same vector, with their
+ * scale in s3: select_scale extracts those of one scale.
+ *
+ * @param mask: Pointer to global memory with the mask of the octave, 0 for invalid pixels, or NULL
+ * @param nb_scales: the scales 1 .. nb_scales are searched (par.Scales)
+ * @param tile: __local buffer of 3 * (local_size(0) + 2) * (local_size(1) + 2) floats
+ * Other parameters are those of local_maxmin
+ */
+__kernel void local_maxmin_octave(
+	__global DOG_T* DOGS,
+	__global keypoint* output,
+	__global unsigned char* mask,
+	int border_dist,
+	float peak_thresh,
+	int octsize,
+	float EdgeThresh0,
+	float EdgeThresh,
+	__global int* counter,
+	int nb_keypoints,
+	int nb_scales,
+	int width,
+	int height,
+	__local float* tile)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	int tile_w = (int) get_local_size(0) + 2;
+	int slice_size = tile_w * ((int) get_local_size(1) + 2);
+	int center = ((int) get_local_id(1) + 1) * tile_w + (int) get_local_id(0) + 1;
+	int active = (gid1 < IMAGE_H - BORDER_DIST) && (gid0 < IMAGE_W - BORDER_DIST)
+	             && (gid1 >= BORDER_DIST) && (gid0 >= BORDER_DIST);
+	if (active && (mask != 0))
+		active = (mask[gid1 * IMAGE_W + gid0] != 0);
+
+	load_dog_tile(DOGS, tile, 0, width, height);
+	load_dog_tile(DOGS, tile + slice_size, 1, width, height);
+	for (int scale = 1; scale <= nb_scales; scale++) {
+		load_dog_tile(DOGS, tile + ((scale + 1) % 3) * slice_size, scale + 1, width, height);
+		barrier(CLK_LOCAL_MEM_FENCE);
+		if (active)
+			local_maxmin_local(tile + ((scale - 1) % 3) * slice_size + center,
+			                   tile + (scale % 3) * slice_size + center,
+			                   tile + ((scale + 1) % 3) * slice_size + center,
+			                   tile_w, output, peak_thresh, octsize, EdgeThresh0, EdgeThresh,
+			                   counter, nb_keypoints, scale, gid0, gid1);
+		// the slice scale-1 is overwritten at the next iteration
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+}
+
+/**
+ * \brief Append the candidates of one scale found by local_maxmin_octave to the keypoints vector
+ *
+ * Launched on a fixed number of work-groups, whatever the size of the octave.
+ *
+ * @param candidates: Pointer to global memory with the candidates of all scales
+ * @param nb_candidates: Pointer to global memory with the number of candidates
+ * @param output: Pointer to global memory with the keypoints vector
+ * @param counter: pointer to the current position in keypoints vector
+ * @param nb_keypoints: Maximum number of keypoints: size of both vectors
+ * @param scale: index of the DoG
+ */
+__kernel void select_scale(
+	__global keypoint* candidates,
+	__global int* nb_candidates,
+	__global keypoint* output,
+	__global int* counter,
+	int nb_keypoints,
+	int scale)
+{
+	// a fixed number of work-groups loops over the candidates of the octave only
+	int end = min(nb_candidates[0], nb_keypoints);
+	for (int gid0 = (int) get_global_id(0); gid0 < end; gid0 += (int) get_global_size(0)) {
+		keypoint k = candidates[gid0];
+		if ((int) k.s3 == scale) {
+			int old = atomic_inc(counter);
+			if (old < nb_keypoints) output[old] = k;
+		}
+	}
+}
 
 
 
@@ -232,140 +523,187 @@ __kernel void local_maxmin(
  */
 
 
-__kernel void interp_keypoint(
-	__global float* DOGS,
+/*
+ Interpolation of the keypoint gid0, written at the same index of output:
+ shared by interp_keypoint (in place) and interp_keypoint_counters
+*/
+inline void interp_keypoint_one(
+	__global DOG_T* DOGS,
 	__global keypoint* keypoints,
-	int start_keypoints,
-	int end_keypoints,
+	__global keypoint* output,
+	int gid0,
 	float peak_thresh,
 	float InitSigma,
 	int width,
 	int height)
 {
+	keypoint k = keypoints[gid0];
+	int r = (int) k.s1;
+	int c = (int) k.s2;
+	int scale = (int) k.s3;
+	if (r != -1) {
+		int index_dog_prev = DOG_SLICE(scale-1)*(IMAGE_W*IMAGE_H);
+		int index_dog = DOG_SLICE(scale)*(IMAGE_W*IMAGE_H);
+		int index_dog_next = DOG_SLICE(scale+1)*(IMAGE_W*IMAGE_H);
 
-	//int gid1 = (int) get_global_id(1);
-	int gid0 = (int) get_global_id(0);
+		//pre-allocating variables before entering into the loop
+		float g0, g1, g2,
+			H00, H11, H22, H01, H02, H12, H10, H20, H21,
+			K00, K11, K22, K01, K02, K12, K10, K20, K21,
+			solution0, solution1, solution2, det, peakval;
+		int pos = r*IMAGE_W+c;
+		int loop = 1, movesRemain = 5;
+		int newr = r, newc = c;
 
-	if ((gid0 >= start_keypoints) && (gid0 < end_keypoints)) {
-		keypoint k = keypoints[gid0];
-		int r = (int) k.s1;
-		int c = (int) k.s2;
-		int scale = (int) k.s3;
-		if (r != -1) {
-			int index_dog_prev = (scale-1)*(width*height);
-			int index_dog =scale*(width*height);
-			int index_dog_next =(scale+1)*(width*height);
+		//this loop replaces the recursive "InterpKeyPoint"
+		while (loop == 1) {
 
-			//pre-allocating variables before entering into the loop
-			float g0, g1, g2,
-				H00, H11, H22, H01, H02, H12, H10, H20, H21,
-				K00, K11, K22, K01, K02, K12, K10, K20, K21,
-				solution0, solution1, solution2, det, peakval;
-			int pos = r*width+c;
-			int loop = 1, movesRemain = 5;
-			int newr = r, newc = c;
+			r = newr, c = newc; //values got as parameters of InterpKeyPoint()" in sift.cpp
+			pos = newr*IMAGE_W+newc;
 
-			//this loop replaces the recursive "InterpKeyPoint"
-			while (loop == 1) {
+			//Fill in the values of the gradient from pixel differences
+			g0 = (LOAD_DOG(index_dog_next+pos, DOGS) - LOAD_DOG(index_dog_prev+pos, DOGS)) / 2.0f;
+			g1 = (LOAD_DOG(index_dog+(newr+1)*IMAGE_W+newc, DOGS) - LOAD_DOG(index_dog+(newr-1)*IMAGE_W+newc, DOGS)) / 2.0f;
+			g2 = (LOAD_DOG(index_dog+pos+1, DOGS) - LOAD_DOG(index_dog+pos-1, DOGS)) / 2.0f;
 
-				r = newr, c = newc; //values got as parameters of InterpKeyPoint()" in sift.cpp
-				pos = newr*width+newc;
+			//Fill in the values of the Hessian from pixel differences
+			H00 = LOAD_DOG(index_dog_prev+pos, DOGS)   - 2.0f * LOAD_DOG(index_dog+pos, DOGS) + LOAD_DOG(index_dog_next+pos, DOGS);
+			H11 = LOAD_DOG(index_dog+(newr-1)*IMAGE_W+newc, DOGS) - 2.0f * LOAD_DOG(index_dog+pos, DOGS) + LOAD_DOG(index_dog+(newr+1)*IMAGE_W+newc, DOGS);
+			H22 = LOAD_DOG(index_dog+pos-1, DOGS) - 2.0f * LOAD_DOG(index_dog+pos, DOGS) + LOAD_DOG(index_dog+pos+1, DOGS);
 
-				//Fill in the values of the gradient from pixel differences
-				g0 = (DOGS[index_dog_next+pos] - DOGS[index_dog_prev+pos]) / 2.0f;
-				g1 = (DOGS[index_dog+(newr+1)*width+newc] - DOGS[index_dog+(newr-1)*width+newc]) / 2.0f;
-				g2 = (DOGS[index_dog+pos+1] - DOGS[index_dog+pos-1]) / 2.0f;
+			H01 = ( (LOAD_DOG(index_dog_next+(newr+1)*IMAGE_W+newc, DOGS) - LOAD_DOG(index_dog_next+(newr-1)*IMAGE_W+newc, DOGS))
+					- (LOAD_DOG(index_dog_prev+(newr+1)*IMAGE_W+newc, DOGS) - LOAD_DOG(index_dog_prev+(newr-1)*IMAGE_W+newc, DOGS))) / 4.0f;
 
-				//Fill in the values of the Hessian from pixel differences
-				H00 = DOGS[index_dog_prev+pos]   - 2.0f * DOGS[index_dog+pos] + DOGS[index_dog_next+pos];
-				H11 = DOGS[index_dog+(newr-1)*width+newc] - 2.0f * DOGS[index_dog+pos] + DOGS[index_dog+(newr+1)*width+newc];
-				H22 = DOGS[index_dog+pos-1] - 2.0f * DOGS[index_dog+pos] + DOGS[index_dog+pos+1];
+			H02 = ( (LOAD_DOG(index_dog_next+pos+1, DOGS) - LOAD_DOG(index_dog_next+pos-1, DOGS))
+					-(LOAD_DOG(index_dog_prev+pos+1, DOGS) - LOAD_DOG(index_dog_prev+pos-1, DOGS))) / 4.0f;
 
-				H01 = ( (DOGS[index_dog_next+(newr+1)*width+newc] - DOGS[index_dog_next+(newr-1)*width+newc])
-						- (DOGS[index_dog_prev+(newr+1)*width+newc] - DOGS[index_dog_prev+(newr-1)*width+newc])) / 4.0f;
+			H12 = ( (LOAD_DOG(index_dog+(newr+1)*IMAGE_W+newc+1, DOGS) - LOAD_DOG(index_dog+(newr+1)*IMAGE_W+newc-1, DOGS))
+					- (LOAD_DOG(index_dog+(newr-1)*IMAGE_W+newc+1, DOGS) - LOAD_DOG(index_dog+(newr-1)*IMAGE_W+newc-1, DOGS))) / 4.0f;
 
-				H02 = ( (DOGS[index_dog_next+pos+1] - DOGS[index_dog_next+pos-1])
-						-(DOGS[index_dog_prev+pos+1] - DOGS[index_dog_prev+pos-1])) / 4.0f;
+			H10 = H01; H20 = H02; H21 = H12;
 
-				H12 = ( (DOGS[index_dog+(newr+1)*width+newc+1] - DOGS[index_dog+(newr+1)*width+newc-1])
-						- (DOGS[index_dog+(newr-1)*width+newc+1] - DOGS[index_dog+(newr-1)*width+newc-1])) / 4.0f;
 
-				H10 = H01; H20 = H02; H21 = H12;
+			//inversion of the Hessian	: det*K = H^(-1)
 
+			det = -(H02*H11*H20) + H01*H12*H20 + H02*H10*H21 - H00*H12*H21 - H01*H10*H22 + H00*H11*H22;
 
-				//inversion of the Hessian	: det*K = H^(-1)
+			K00 = H11*H22 - H12*H21;
+			K01 = H02*H21 - H01*H22;
+			K02 = H01*H12 - H02*H11;
+			K10 = H12*H20 - H10*H22;
+			K11 = H00*H22 - H02*H20;
+			K12 = H02*H10 - H00*H12;
+			K20 = H10*H21 - H11*H20;
+			K21 = H01*H20 - H00*H21;
+			K22 = H00*H11 - H01*H10;
 
-				det = -(H02*H11*H20) + H01*H12*H20 + H02*H10*H21 - H00*H12*H21 - H01*H10*H22 + H00*H11*H22;
 
-				K00 = H11*H22 - H12*H21;
-				K01 = H02*H21 - H01*H22;
-				K02 = H01*H12 - H02*H11;
-				K10 = H12*H20 - H10*H22;
-				K11 = H00*H22 - H02*H20;
-				K12 = H02*H10 - H00*H12;
-				K20 = H10*H21 - H11*H20;
-				K21 = H01*H20 - H00*H21;
-				K22 = H00*H11 - H01*H10;
+			/*
+				x = -H^(-1)*g
+			 As the Taylor Serie is calcualted around the current keypoint,
+			 the position of the true extremum x_opt is exactly the "offset" between x and x_opt ("x" is the origin)
+			*/
+			solution0 = -(g0*K00 + g1*K01 + g2*K02)/det; //"offset" in sigma
+			solution1 = -(g0*K10 + g1*K11 + g2*K12)/det; //"offset" in r
+			solution2 = -(g0*K20 + g1*K21 + g2*K22)/det; //"offset" in c
 
+			//interpolated DoG magnitude at this peak
+			peakval = LOAD_DOG(index_dog+pos, DOGS) + 0.5f * (solution0*g0+solution1*g1+solution2*g2);
 
-				/*
-					x = -H^(-1)*g
-				 As the Taylor Serie is calcualted around the current keypoint,
-				 the position of the true extremum x_opt is exactly the "offset" between x and x_opt ("x" is the origin)
-				*/
-				solution0 = -(g0*K00 + g1*K01 + g2*K02)/det; //"offset" in sigma
-				solution1 = -(g0*K10 + g1*K11 + g2*K12)/det; //"offset" in r
-				solution2 = -(g0*K20 + g1*K21 + g2*K22)/det; //"offset" in c
 
-				//interpolated DoG magnitude at this peak
-				peakval = DOGS[index_dog+pos] + 0.5f * (solution0*g0+solution1*g1+solution2*g2);
+		/* Move to an adjacent (row,col) location if quadratic interpolation is larger than 0.6 units in some direction. 				The movesRemain counter allows only a fixed number of moves to prevent possibility of infinite loops.
+		*/
 
+			if (solution1 > 0.6f && newr < IMAGE_H - 3)
+				newr++; //if the extremum is too far (along "r" here), we get closer if we can
+			else if (solution1 < -0.6f && newr > 3)
+				newr--;
+			if (solution2 > 0.6f && newc < IMAGE_W - 3)
+				newc++;
+			else if (solution2 < -0.6f && newc > 3)
+				newc--;
 
-			/* Move to an adjacent (row,col) location if quadratic interpolation is larger than 0.6 units in some direction. 				The movesRemain counter allows only a fixed number of moves to prevent possibility of infinite loops.
+			/*
+				Loop test
 			*/
+			if (movesRemain > 0  &&  (newr != r || newc != c))
+				movesRemain--;
+			else
+				loop = 0;
 
-				if (solution1 > 0.6f && newr < height - 3)
-					newr++; //if the extremum is too far (along "r" here), we get closer if we can
-				else if (solution1 < -0.6f && newr > 3)
-					newr--;
-				if (solution2 > 0.6f && newc < width - 3)
-					newc++;
-				else if (solution2 < -0.6f && newc > 3)
-					newc--;
+		}//end of the "keypoints interpolation" big loop
 
-				/*
-					Loop test
-				*/
-				if (movesRemain > 0  &&  (newr != r || newc != c))
-					movesRemain--;
-				else
-					loop = 0;
 
-			}//end of the "keypoints interpolation" big loop
+		/* Do not create a keypoint if interpolation still remains far outside expected limits,
+			or if magnitude of peak value is below threshold (i.e., contrast is too low).
+		*/
+		keypoint ki = 0.0f; //float4
+		if (fabs(solution0) <= 1.5f && fabs(solution1) <= 1.5f && fabs(solution2) <= 1.5f && fabs(peakval) >= PEAK_THRESH) {
+			ki.s0 = peakval;
+			ki.s1 = /*k.s1*/ r + solution1;
+			ki.s2 = /*k.s2*/ c + solution2;
+			ki.s3 = INIT_SIGMA * pow(2.0f, (((float) scale) + solution0) / 3.0f); //3.0 is "par.Scales"
+		}
+		else { //the keypoint was not correctly interpolated : we reject it
+			ki.s0 = -1.0f; ki.s1 = -1.0f; ki.s2 = -1.0f; ki.s3 = -1.0f;
+		}
 
+		output[gid0]=ki;
 
-			/* Do not create a keypoint if interpolation still remains far outside expected limits,
-				or if magnitude of peak value is below threshold (i.e., contrast is too low).
-			*/
-			keypoint ki = 0.0f; //float4
-			if (fabs(solution0) <= 1.5f && fabs(solution1) <= 1.5f && fabs(solution2) <= 1.5f && fabs(peakval) >= peak_thresh) {
-				ki.s0 = peakval;
-				ki.s1 = /*k.s1*/ r + solution1;
-				ki.s2 = /*k.s2*/ c + solution2;
-				ki.s3 = InitSigma * pow(2.0f, (((float) scale) + solution0) / 3.0f); //3.0 is "par.Scales"
-			}
-			else { //the keypoint was not correctly interpolated : we reject it
-				ki.s0 = -1.0f; ki.s1 = -1.0f; ki.s2 = -1.0f; ki.s3 = -1.0f;
-			}
+	/*
+		Better return here and compute histogram in another kernel
+	*/
+	}
+	else
+		output[gid0] = k;
+}
+
+__kernel void interp_keypoint(
+	__global DOG_T* DOGS,
+	__global keypoint* keypoints,
+	int start_keypoints,
+	int end_keypoints,
+	float peak_thresh,
+	float InitSigma,
+	int width,
+	int height)
+{
 
-			keypoints[gid0]=ki;
+	//int gid1 = (int) get_global_id(1);
+	int gid0 = (int) get_global_id(0);
 
-		/*
-			Better return here and compute histogram in another kernel
-		*/
-		}
+	if ((gid0 >= start_keypoints) && (gid0 < end_keypoints))
+		interp_keypoint_one(DOGS, keypoints, keypoints, gid0, peak_thresh, InitSigma, width, height);
+}
 
-	}
+
+/**
+ * \brief Same as interp_keypoint, the range of keypoints being read from the device
+ *
+ * The kernel loops over the keypoints with a stride of the global size, so
+ * that it can be launched with a fixed size without knowing their number.
+ * The interpolated keypoints are written in output (same indices), ready
+ * for compact_count and compact_scatter.
+ *
+ * @param output: Pointer to global memory with the interpolated keypoints
+ * @param counters: Pointer to global memory with the index of the first keypoint and the end of the range
+ * @param nb_keypoints: size of the keypoints vectors
+ * Other parameters are those of interp_keypoint
+ */
+__kernel void interp_keypoint_counters(
+	__global DOG_T* DOGS,
+	__global keypoint* keypoints,
+	__global keypoint* output,
+	__global int* counters,
+	int nb_keypoints,
+	float peak_thresh,
+	float InitSigma,
+	int width,
+	int height)
+{
+	int end = min(counters[1], nb_keypoints);
+	for (int gid0 = counters[0] + (int) get_global_id(0); gid0 < end; gid0 += (int) get_global_size(0))
+		interp_keypoint_one(DOGS, keypoints, output, gid0, peak_thresh, InitSigma, width, height);
 }
 
 
@@ -12,8 +12,34 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 128
 #endif
 
+/*
+ Storage of the gradient and of its orientation, float or half
+ (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+#endif
 
 
+
+/*
+ Compile-time specialization: when IMAGE_W, IMAGE_H or OCTSIZE are defined
+ at build time, the corresponding argument of the kernels is ignored.
+*/
+#ifndef IMAGE_W
+	#define IMAGE_W grad_width
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H grad_height
+#endif
+#ifndef OCTSIZE
+	#define OCTSIZE octsize
+#endif
+
 /**
  * \brief Assign an orientation to the keypoints.  This is done by creating a Gaussian weighted histogram
  *   of the gradient directions in the region.  The histogram is smoothed and the largest peak selected.
@@ -38,8 +64,8 @@ typedef float4 keypoint;
 
 __kernel void orientation_assignment(
 	__global keypoint* keypoints,
-	__global float* grad,
-	__global float* ori,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
 	__global int* counter,
 	int octsize,
 	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
@@ -69,12 +95,12 @@ __kernel void orientation_assignment(
 	int	radius = (int) (sigma * 3.0);
 	int rmin = MAX(0,row - radius);
 	int cmin = MAX(0,col - radius);
-	int rmax = MIN(row + radius,grad_height - 2);
-	int cmax = MIN(col + radius,grad_width - 2);
+	int rmax = MIN(row + radius,IMAGE_H - 2);
+	int cmax = MIN(col + radius,IMAGE_W - 2);
 	
 	for (r = rmin; r <= rmax; r++) {
 		for (c = cmin; c <= cmax; c++) {
-			gval = grad[r*grad_width+c];
+			gval = LOAD_LEVEL(r*IMAGE_W+c, grad);
 			
 			float dif = (r - k.s1);	distsq = dif*dif;
 			dif = (c - k.s2);	distsq += dif*dif;
@@ -82,7 +108,7 @@ __kernel void orientation_assignment(
 			//distsq = (r-k.s1)*(r-k.s1) + (c-k.s2)*(c-k.s2);
 
 			if (gval > 0.0f  &&  distsq < ((float) (radius*radius)) + 0.5f) {
-				angle = ori[r*grad_width+c];
+				angle = LOAD_LEVEL(r*IMAGE_W+c, ori);
 				bin = (int) (36.0f * (angle + M_PI_F + 0.001f) / (2.0f * M_PI_F)); //why this offset ?
 				if (bin >= 0 && bin <= 36) {
 					bin = MIN(bin, 35);
@@ -136,9 +162,9 @@ __kernel void orientation_assignment(
 	angle = 2.0f * M_PI_F * (argmax + 0.5f + interp) / 36.0f - M_PI_F;
 
 
-	k.s0 = k.s2 *octsize; //c
-	k.s1 = k.s1 *octsize; //r
-	k.s2 = k.s3 *octsize; //sigma
+	k.s0 = k.s2 *OCTSIZE; //c
+	k.s1 = k.s1 *OCTSIZE; //r
+	k.s2 = k.s3 *OCTSIZE; //sigma
 	k.s3 = angle; 		  //angle
 	keypoints[gid0] = k;
 	
@@ -190,34 +216,33 @@ __kernel void orientation_assignment(
 
 
 
-__kernel void descriptor(
+/*
+ Descriptor of the keypoint gid0: shared by descriptor and descriptor_counters
+*/
+inline void descriptor_one(
 	__global keypoint* keypoints,
 	__global unsigned char *descriptors,
-	__global float* grad,
-	__global float* orim,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
 	int octsize,
-	int keypoints_start,
-	//	int keypoints_end,
-	__global int* keypoints_end, //passing counter value to avoid to read it each time
 	int grad_width,
-	int grad_height)
+	int grad_height,
+	int gid0,
+	__local volatile float* tmp_descriptors)
 {
-
-	int gid0 = get_global_id(0);
 	keypoint k = keypoints[gid0];
-	if (!(keypoints_start <= gid0 && gid0 < *keypoints_end && k.s1 >=0.0f))
+	if (!(k.s1 >=0.0f))
 		return;
 		
 	int i,j,u,v,old;
 	
-	__local volatile float tmp_descriptors[128];
 	for (i=0; i<128; i++) tmp_descriptors[i] = 0.0f;
 
 	float rx, cx;
-	float row = k.s1/octsize, col = k.s0/octsize, angle = k.s3;
+	float row = k.s1/OCTSIZE, col = k.s0/OCTSIZE, angle = k.s3;
 	int	irow = (int) (row + 0.5f), icol = (int) (col + 0.5f);
 	float sine = sin((float) angle), cosine = cos((float) angle);
-	float spacing = k.s2/octsize * 3.0f;
+	float spacing = k.s2/OCTSIZE * 3.0f;
 	int iradius = (int) ((1.414f * spacing * 2.5f) + 0.5f);
 
 	for (i = -iradius; i <= iradius; i++) { 
@@ -225,10 +250,10 @@ __kernel void descriptor(
 			 rx = ((cosine * i - sine * j) - (row - irow)) / spacing + 1.5f;
 			 cx = ((sine * i + cosine * j) - (col - icol)) / spacing + 1.5f;
 			if ((rx > -1.0f && rx < 4.0f && cx > -1.0f && cx < 4.0f
-				 && (irow +i) >= 0  && (irow +i) < grad_height && (icol+j) >= 0 && (icol+j) < grad_width)) {
-				float mag = grad[(int)(icol+j) + (int)(irow+i)*grad_width]
+				 && (irow +i) >= 0  && (irow +i) < IMAGE_H && (icol+j) >= 0 && (icol+j) < IMAGE_W)) {
+				float mag = LOAD_LEVEL((int)(icol+j) + (int)(irow+i)*IMAGE_W, grad)
 							 * exp(- 0.125f*((rx - 1.5f) * (rx - 1.5f) + (cx - 1.5f) * (cx - 1.5f)) );
-				float ori = orim[(int)(icol+j)+(int)(irow+i)*grad_width] -  angle;
+				float ori = LOAD_LEVEL((int)(icol+j)+(int)(irow+i)*IMAGE_W, orim) -  angle;
 				while (ori > 2.0f*M_PI_F) ori -= 2.0f*M_PI_F;
 				while (ori < 0.0f) ori += 2.0f*M_PI_F;
 				int	orr, rindex, cindex, oindex;
@@ -317,6 +342,46 @@ __kernel void descriptor(
 	}
 }
 
+__kernel void descriptor(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	int keypoints_start,
+	//	int keypoints_end,
+	__global int* keypoints_end, //passing counter value to avoid to read it each time
+	int grad_width,
+	int grad_height)
+{
+	int gid0 = get_global_id(0);
+	__local volatile float tmp_descriptors[128];
+	if (keypoints_start <= gid0 && gid0 < *keypoints_end)
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, gid0, tmp_descriptors);
+}
 
 
-
+/**
+ * \brief Same as descriptor, the first keypoint being read from the device
+ *
+ * @param counters: Pointer to global memory with keypoints_start
+ * @param nb_keypoints: size of the keypoints vector
+ * Other parameters are those of descriptor
+ */
+__kernel void descriptor_counters(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	__global int* counters,
+	__global int* keypoints_end,
+	int nb_keypoints,
+	int grad_width,
+	int grad_height)
+{
+	__local volatile float tmp_descriptors[128];
+	int end = min(*keypoints_end, nb_keypoints);
+	for (int gid0 = counters[0] + (int) get_global_id(0); gid0 < end; gid0 += (int) get_global_size(0))
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, gid0, tmp_descriptors);
+}
@@ -22,8 +22,34 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 128
 #endif
 
+/*
+ Storage of the gradient and of its orientation, float or half
+ (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+#endif
+
 
 
+/*
+ Compile-time specialization: when IMAGE_W, IMAGE_H or OCTSIZE are defined
+ at build time, the corresponding argument of the kernels is ignored.
+*/
+#ifndef IMAGE_W
+	#define IMAGE_W grad_width
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H grad_height
+#endif
+#ifndef OCTSIZE
+	#define OCTSIZE octsize
+#endif
+
 /*
 	
 	Descriptors kernel -- optimized for compute capability <=1.3  (GTX <= 295) 
@@ -57,38 +83,37 @@ This kernel has to be run with as (8,4,4) workgroup size
 */
 
 
-__kernel void descriptor(
+/*
+ Descriptor of the keypoint groupid: shared by descriptor and descriptor_counters
+*/
+inline void descriptor_one(
 	__global keypoint* keypoints,
 	__global unsigned char *descriptors,
-	__global float* grad,
-	__global float* orim,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
 	int octsize,
-	int keypoints_start,
-//	int keypoints_end,	
-	__global int* keypoints_end, //passing counter value to avoid to read it each time
 	int grad_width,
-	int grad_height)
+	int grad_height,
+	int groupid,
+	__local volatile float* histogram,
+	__local volatile float* hist2,
+	__local int* changed)
 {
-
 	int lid0 = get_local_id(0); //[0,8[
 	int lid1 = get_local_id(1); //[0,4[
 	int lid2 = get_local_id(2); //[0,4[
 	int lid = (lid0*4+lid1)*4+lid2; //[0,128[
-	int groupid = get_group_id(0);
 	keypoint k = keypoints[groupid];
-	if (!(keypoints_start <= groupid && groupid < *keypoints_end && k.s1 >=0.0f))
+	if (!(k.s1 >=0.0f))
 		return;
 		
 	int i,j,j2;
-	
-	__local volatile float histogram[128];
-	__local volatile float hist2[128*8];
 			
 	float rx, cx;
-	float row = k.s1/octsize, col = k.s0/octsize, angle = k.s3;
+	float row = k.s1/OCTSIZE, col = k.s0/OCTSIZE, angle = k.s3;
 	int	irow = (int) (row + 0.5f), icol = (int) (col + 0.5f);
 	float sine = sin((float) angle), cosine = cos((float) angle);
-	float spacing = k.s2/octsize * 3.0f;
+	float spacing = k.s2/OCTSIZE * 3.0f;
 	int radius = (int) ((1.414f * spacing * 2.5f) + 0.5f);
 	
 	int imin = -64 +32*lid1,
@@ -107,11 +132,11 @@ __kernel void descriptor(
 			rx = ((cosine * i - sine * j) - (row - irow)) / spacing + 1.5f;
 			cx = ((sine * i + cosine * j) - (col - icol)) / spacing + 1.5f;
 			if ((rx > -1.0f && rx < 4.0f && cx > -1.0f && cx < 4.0f
-				 && (irow +i) >= 0  && (irow +i) < grad_height && (icol+j) >= 0 && (icol+j) < grad_width)) {
+				 && (irow +i) >= 0  && (irow +i) < IMAGE_H && (icol+j) >= 0 && (icol+j) < IMAGE_W)) {
 				
-				float mag = grad[icol+j + (irow+i)*grad_width]
+				float mag = LOAD_LEVEL(icol+j + (irow+i)*IMAGE_W, grad)
 							 * exp(- 0.125f*((rx - 1.5f) * (rx - 1.5f) + (cx - 1.5f) * (cx - 1.5f)) );
-				float ori = orim[icol+j+(irow+i)*grad_width] -  angle;
+				float ori = LOAD_LEVEL(icol+j+(irow+i)*IMAGE_W, orim) -  angle;
 				
 				while (ori > 2.0f*M_PI_F) ori -= 2.0f*M_PI_F;
 				while (ori < 0.0f) ori += 2.0f*M_PI_F;
@@ -212,7 +237,6 @@ __kernel void descriptor(
 	histogram[lid] *= hist2[0];
 
 	//Threshold to 0.2 of the norm, for invariance to illumination
-	__local int changed[1];
 	if (lid == 0) changed[0] = 0;
 	if (histogram[lid] > 0.2f) {
 		histogram[lid] = 0.2f;
@@ -259,8 +283,57 @@ __kernel void descriptor(
 	
 }
 
+__kernel void descriptor(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	int keypoints_start,
+//	int keypoints_end,
+	__global int* keypoints_end, //passing counter value to avoid to read it each time
+	int grad_width,
+	int grad_height)
+{
+	int groupid = get_group_id(0);
+	__local volatile float histogram[128];
+	__local volatile float hist2[128*8];
+	__local int changed[1];
+	if (keypoints_start <= groupid && groupid < *keypoints_end)
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, groupid, histogram, hist2, changed);
+}
 
 
+/**
+ * \brief Same as descriptor, the first keypoint being read from the device
+ *
+ * Each work-group loops over the keypoints with a stride of the number of
+ * work-groups, so that the kernel can be launched with a fixed size.
+ *
+ * @param counters: Pointer to global memory with keypoints_start
+ * @param nb_keypoints: size of the keypoints vector
+ * Other parameters are those of descriptor
+ */
+__kernel void descriptor_counters(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	__global int* counters,
+	__global int* keypoints_end,
+	int nb_keypoints,
+	int grad_width,
+	int grad_height)
+{
+	__local volatile float histogram[128];
+	__local volatile float hist2[128*8];
+	__local int changed[1];
+	int end = min(*keypoints_end, nb_keypoints);
 
-
-
+	for (int groupid = counters[0] + (int) get_group_id(0); groupid < end; groupid += (int) get_num_groups(0)) {
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, groupid, histogram, hist2, changed);
+		// the local buffers are re-initialized by the next keypoint
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+}
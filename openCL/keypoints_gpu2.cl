@@ -25,10 +25,36 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 128
 #endif
 
+/*
+ Storage of the gradient and of its orientation, float or half
+ (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+#endif
+
 
 
 
 
+/*
+ Compile-time specialization: when IMAGE_W, IMAGE_H or OCTSIZE are defined
+ at build time, the corresponding argument of the kernels is ignored.
+*/
+#ifndef IMAGE_W
+	#define IMAGE_W grad_width
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H grad_height
+#endif
+#ifndef OCTSIZE
+	#define OCTSIZE octsize
+#endif
+
 /*
  *
  * \brief Compute a SIFT descriptor for each keypoint.
@@ -65,36 +91,62 @@ typedef float4 keypoint;
 
 
 
-__kernel void descriptor(
+/*
+ 1/sqrt(sum of the squares) of the 128 values of histogram, using hist2.
+ All the work-items of the group must call it: the barriers are outside of
+ the branches selecting the work-items, only the work is guarded.
+*/
+inline float inverse_norm(
+	__local volatile float* histogram,
+	__local volatile float* hist2,
+	int lid)
+{
+	if (lid < 128)
+		hist2[lid] = histogram[lid] * histogram[lid];
+	barrier(CLK_LOCAL_MEM_FENCE);
+	//parallel reduction to normalize vector
+	for (int i = 64; i > 1; i >>= 1) {
+		if (lid < i)
+			hist2[lid] += hist2[lid + i];
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+	float norm = rsqrt(hist2[0] + hist2[1]);
+	// hist2 is re-used by the caller
+	barrier(CLK_LOCAL_MEM_FENCE);
+	return norm;
+}
+
+/*
+ Descriptor of the keypoint groupid: shared by descriptor and descriptor_counters.
+ All the work-items of the group reach the same barriers (descriptor_counters
+ loops over several keypoints), only the work is restricted to lid < 128.
+*/
+inline void descriptor_one(
 	__global keypoint* keypoints,
 	__global unsigned char *descriptors,
-	__global float* grad,
-	__global float* orim,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
 	int octsize,
-	int keypoints_start,
-//	int keypoints_end,
-	__global int* keypoints_end, //passing counter value to avoid to read it each time
 	int grad_width,
-	int grad_height)
+	int grad_height,
+	int groupid,
+	__local volatile float* histogram,
+	__local volatile float* hist2,
+	__local volatile unsigned int* hist3,
+	__local int* changed)
 {
-
 	int lid0 = get_local_id(0); //[0,8[
 	int lid1 = get_local_id(1); //[0,8[
 	int lid2 = get_local_id(2); //[0,8[
 	int lid = (lid0*8+lid1)*8+lid2; //[0,512[ to limit to [0,128[
-	int groupid = get_group_id(0);
 	keypoint k = keypoints[groupid];
-	if (!(keypoints_start <= groupid && groupid < *keypoints_end && k.s1 >=0.0f))
+	if (!(k.s1 >=0.0f))
 		return;
 
 	int i,j,j2;
 	
-	__local volatile float histogram[128];		//for "final" histogram
-	__local volatile float hist2[128];		//for temporary histogram
-	__local volatile unsigned int hist3[128*8]; //for the atomic_add
-	
 	float rx, cx;
-	float one_octsize = 1.0f/octsize;
+	float one_octsize = 1.0f/OCTSIZE;
 	float row = k.s1*one_octsize, col = k.s0*one_octsize;
 	int	irow = (int) ((k.s1*one_octsize) + 0.5f), icol = (int) ((k.s0*one_octsize) + 0.5f);
 	float sine = sin((float) k.s3), cosine = cos((float) k.s3);
@@ -112,8 +164,11 @@ __kernel void descriptor(
 	}
 	if (lid < 128) {
 		histogram[lid] = 0.0f;
-	hist2[lid] = 0.0f;
+		hist2[lid] = 0.0f;
 	}
+	if (lid == 0)
+		changed[0] = 0;
+	barrier(CLK_LOCAL_MEM_FENCE);
 	for (i=imin; i < imax; i++) {
 		for (j2=jmin/8; j2 < jmax/8; j2++) {	
 			j=j2*8+lid0;
@@ -121,11 +176,11 @@ __kernel void descriptor(
 			cx = ((sine * i + cosine * j) - (col - icol)) / spacing + 1.5f;
 
 			if ((rx > -1.0f && rx < 4.0f && cx > -1.0f && cx < 4.0f
-				 && (irow +i) >= 0  && (irow +i) < grad_height && (icol+j) >= 0 && (icol+j) < grad_width)) {
+				 && (irow +i) >= 0  && (irow +i) < IMAGE_H && (icol+j) >= 0 && (icol+j) < IMAGE_W)) {
 
-				float mag = grad[icol+j + (irow+i)*grad_width]
+				float mag = LOAD_LEVEL(icol+j + (irow+i)*IMAGE_W, grad)
 							 * exp(- 0.125f*((rx - 1.5f) * (rx - 1.5f) + (cx - 1.5f) * (cx - 1.5f)) );
-				float ori = orim[icol+j+(irow+i)*grad_width] -  k.s3;
+				float ori = LOAD_LEVEL(icol+j+(irow+i)*IMAGE_W, orim) -  k.s3;
 				while (ori > 2.0f*M_PI_F) ori -= 2.0f*M_PI_F;
 				while (ori < 0.0f) ori += 2.0f*M_PI_F;
 				int	orr, rindex, cindex, oindex;
@@ -190,100 +245,84 @@ __kernel void descriptor(
 			+= (float) ((hist3[lid*8]+hist3[lid*8+1]+hist3[lid*8+2]+hist3[lid*8+3]
 			+hist3[lid*8+4]+hist3[lid*8+5]+hist3[lid*8+6]+hist3[lid*8+7])*0.00001f);
 
-
-
-	barrier(CLK_LOCAL_MEM_FENCE);
-
-	//memset of 128 values of hist2 before re-use
-	if (lid < 128) hist2[lid] = histogram[lid]*histogram[lid];
-	
 	/*
-	 	Normalization and thre work shared by the 16 threads (8 values per thread)
+	 	Normalization and threshold, the work being done by the first 128 work-items
 	*/
-	
-	//parallel reduction to normalize vector
-
-	if (lid < 64) {
-		hist2[lid] += hist2[lid+64];
-	}
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid < 32) {
-		hist2[lid] += hist2[lid+32];
-	}
-
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid < 16) {
-		hist2[lid] += hist2[lid+16];
-	}
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid < 8) {
-		hist2[lid] += hist2[lid+8];
-	}
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid < 4) {
-		hist2[lid] += hist2[lid+4];
-	}
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid < 2) {
-		hist2[lid] += hist2[lid+2];
-	}
-	barrier(CLK_LOCAL_MEM_FENCE);
-	if (lid == 0) hist2[0] = rsqrt(hist2[1]+hist2[0]);
-	barrier(CLK_LOCAL_MEM_FENCE);
-	//now we have hist2[0] = 1/sqrt(sum(hist[i]^2))
-	
+	float norm = inverse_norm(histogram, hist2, lid);
 	if (lid < 128) {
-		histogram[lid] *= hist2[0];
-
+		histogram[lid] *= norm;
 		//Threshold to 0.2 of the norm, for invariance to illumination
-		__local int changed[1];
-		if (lid == 0) changed[0] = 0;
 		if (histogram[lid] > 0.2f) {
 			histogram[lid] = 0.2f;
 			atomic_inc(changed);
 		}
-		barrier(CLK_LOCAL_MEM_FENCE);
-		//if values have changed, we have to re-normalize
-		if (changed[0]) { 
-			hist2[lid] = histogram[lid]*histogram[lid];
-			if (lid < 64) {
-				hist2[lid] += hist2[lid+64];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid < 32) {
-				hist2[lid] += hist2[lid+32];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid < 16) {
-				hist2[lid] += hist2[lid+16];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid < 8) {
-				hist2[lid] += hist2[lid+8];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid < 4) {
-				hist2[lid] += hist2[lid+4];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid < 2) {
-				hist2[lid] += hist2[lid+2];
-			}
-			barrier(CLK_LOCAL_MEM_FENCE);
-			if (lid == 0) hist2[0] = rsqrt(hist2[0]+hist2[1]);
-			barrier(CLK_LOCAL_MEM_FENCE);
-			histogram[lid] *= hist2[0];
-		}
-		
-		barrier(CLK_LOCAL_MEM_FENCE);
-		//finally, cast to integer
+	}
+	barrier(CLK_LOCAL_MEM_FENCE);
+	//if values have changed, we have to re-normalize (same decision for the whole group)
+	if (changed[0]) {
+		norm = inverse_norm(histogram, hist2, lid);
+		if (lid < 128)
+			histogram[lid] *= norm;
+	}
+	//finally, cast to integer
+	if (lid < 128)
 		descriptors[128*groupid+lid]
 			= (unsigned char) MIN(255,(unsigned char)(512.0f*histogram[lid]));
-	} //end "if lid < 128"
 }
 
+__kernel void descriptor(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	int keypoints_start,
+//	int keypoints_end,
+	__global int* keypoints_end, //passing counter value to avoid to read it each time
+	int grad_width,
+	int grad_height)
+{
+	int groupid = get_group_id(0);
+	__local volatile float histogram[128];		//for "final" histogram
+	__local volatile float hist2[128];		//for temporary histogram
+	__local volatile unsigned int hist3[128*8]; //for the atomic_add
+	__local int changed[1];
+	if (keypoints_start <= groupid && groupid < *keypoints_end)
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, groupid, histogram, hist2, hist3, changed);
+}
 
 
+/**
+ * \brief Same as descriptor, the first keypoint being read from the device
+ *
+ * Each work-group loops over the keypoints with a stride of the number of
+ * work-groups, so that the kernel can be launched with a fixed size.
+ *
+ * @param counters: Pointer to global memory with keypoints_start
+ * @param nb_keypoints: size of the keypoints vector
+ * Other parameters are those of descriptor
+ */
+__kernel void descriptor_counters(
+	__global keypoint* keypoints,
+	__global unsigned char *descriptors,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* orim,
+	int octsize,
+	__global int* counters,
+	__global int* keypoints_end,
+	int nb_keypoints,
+	int grad_width,
+	int grad_height)
+{
+	__local volatile float histogram[128];		//for "final" histogram
+	__local volatile float hist2[128];		//for temporary histogram
+	__local volatile unsigned int hist3[128*8]; //for the atomic_add
+	__local int changed[1];
+	int end = min(*keypoints_end, nb_keypoints);
 
-
-
+	for (int groupid = counters[0] + (int) get_group_id(0); groupid < end; groupid += (int) get_num_groups(0)) {
+		descriptor_one(keypoints, descriptors, grad, orim, octsize, grad_width, grad_height, groupid, histogram, hist2, hist3, changed);
+		// the local buffers are re-initialized by the next keypoint
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+}
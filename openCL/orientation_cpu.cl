@@ -12,6 +12,18 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 1
 #endif
 
+/*
+ Storage of the gradient and of its orientation, float or half
+ (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+#endif
+
 
 
 /**
@@ -38,22 +50,23 @@ typedef float4 keypoint;
  */
 
 
-__kernel void orientation_assignment(
+/*
+ Orientation of the keypoint gid0: shared by orientation_assignment and orientation_assignment_counters
+*/
+inline void orientation_one(
 	__global keypoint* keypoints,
-	__global float* grad,
-	__global float* ori,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
 	__global int* counter,
 	int octsize,
-	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	float OriSigma,
 	int nb_keypoints,
-	int keypoints_start,
-	int keypoints_end,
 	int grad_width,
-	int grad_height)
+	int grad_height,
+	int gid0)
 {
-	int gid0 = get_global_id(0);
 	keypoint k = keypoints[gid0];
-	if (!(keypoints_start <= gid0 && gid0 < keypoints_end && k.s1 >=0.0f ))
+	if (!(k.s1 >=0.0f ))
 		return;
 	int	bin, prev=0, next=0;
 	int i,j,r,c;
@@ -76,7 +89,7 @@ __kernel void orientation_assignment(
 	
 	for (r = rmin; r <= rmax; r++) {
 		for (c = cmin; c <= cmax; c++) {
-			gval = grad[r*grad_width+c];
+			gval = LOAD_LEVEL(r*grad_width+c, grad);
 			
 			float dif = (r - k.s1);	distsq = dif*dif;
 			dif = (c - k.s2);	distsq += dif*dif;
@@ -84,7 +97,7 @@ __kernel void orientation_assignment(
 			//distsq = (r-k.s1)*(r-k.s1) + (c-k.s2)*(c-k.s2);
 
 			if (gval > 0.0f  &&  distsq < ((float) (radius*radius)) + 0.5f) {
-				angle = ori[r*grad_width+c];
+				angle = LOAD_LEVEL(r*grad_width+c, ori);
 				bin = (int) (36.0f * (angle + M_PI_F + 0.001f) / (2.0f * M_PI_F)); //why this offset ?
 				if (bin >= 0 && bin <= 36) {
 					bin = MIN(bin, 35);
@@ -172,3 +185,47 @@ __kernel void orientation_assignment(
 		} //end "val >= 80%*maxval"
 	}
 }
+
+__kernel void orientation_assignment(
+	__global keypoint* keypoints,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
+	__global int* counter,
+	int octsize,
+	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	int nb_keypoints,
+	int keypoints_start,
+	int keypoints_end,
+	int grad_width,
+	int grad_height)
+{
+	int gid0 = get_global_id(0);
+	if (keypoints_start <= gid0 && gid0 < keypoints_end)
+		orientation_one(keypoints, grad, ori, counter, octsize, OriSigma, nb_keypoints,
+		                grad_width, grad_height, gid0);
+}
+
+
+/**
+ * \brief Same as orientation_assignment, the range of keypoints being read from the device
+ *
+ * @param counters: Pointer to global memory with keypoints_start and keypoints_end
+ * Other parameters are those of orientation_assignment
+ */
+__kernel void orientation_assignment_counters(
+	__global keypoint* keypoints,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
+	__global int* counter,
+	int octsize,
+	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	int nb_keypoints,
+	__global int* counters,
+	int grad_width,
+	int grad_height)
+{
+	int end = min(counters[1], nb_keypoints);
+	for (int gid0 = counters[0] + (int) get_global_id(0); gid0 < end; gid0 += (int) get_global_size(0))
+		orientation_one(keypoints, grad, ori, counter, octsize, OriSigma, nb_keypoints,
+		                grad_width, grad_height, gid0);
+}
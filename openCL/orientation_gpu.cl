@@ -23,6 +23,18 @@ typedef float4 keypoint;
 	#define WORKGROUP_SIZE 128
 #endif
 
+/*
+ Storage of the gradient and of its orientation, float or half
+ (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+#endif
+
 
 
 /**
@@ -66,25 +78,29 @@ TODO:
 
 */
 
-__kernel void orientation_assignment(
+/*
+ Orientation of the keypoint processed by the work-group: shared by
+ orientation_assignment and orientation_assignment_counters, which provide
+ the local buffers hist[36], hist2[WORKGROUP_SIZE] and pos[WORKGROUP_SIZE]
+*/
+inline void orientation_one(
 	__global keypoint* keypoints,
-	__global float* grad,
-	__global float* ori,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
 	__global int* counter,
 	int octsize,
-	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	float OriSigma,
 	int nb_keypoints,
-	int keypoints_start,
-	int keypoints_end,
 	int grad_width,
-	int grad_height)
+	int grad_height,
+	int groupid,
+	__local volatile float* hist,
+	__local volatile float* hist2,
+	__local volatile int* pos)
 {
 	int lid0 = get_local_id(0);
-	int groupid = get_group_id(0);
 
 //	Process only valid points
-	if ((groupid< keypoints_start) || (groupid >= keypoints_end))
-		return;
 	keypoint k = keypoints[groupid];
 	if (k.s1 < 0.0f )
 		return;
@@ -93,9 +109,6 @@ __kernel void orientation_assignment(
 	int old;
 	float distsq, gval, angle, interp=0.0;
 	float hist_prev,hist_curr,hist_next;
-	__local volatile float hist[36];
-	__local volatile float hist2[WORKGROUP_SIZE];
-	__local volatile int pos[WORKGROUP_SIZE];
 	float prev2,temp2;
 	float ONE_3 = 1.0f / 3.0f;
 	float ONE_18 = 1.0f / 18.0f;
@@ -127,11 +140,11 @@ __kernel void orientation_assignment(
 		pos[lid0] = -1;
 		hist2[lid0] = 0.0f; //do not forget to memset before each re-use...
 		if (c <= cmax){
-			gval = grad[r*grad_width+c];
+			gval = LOAD_LEVEL(r*grad_width+c, grad);
 			distsq = (r-k.s1)*(r-k.s1) + (c-k.s2)*(c-k.s2);
 			if (gval > 0.0f  &&  distsq < ((radius*radius) + 0.5f)) {
 				// Ori is in range of -PI to PI.
-				angle = ori[r*grad_width+c];
+				angle = LOAD_LEVEL(r*grad_width+c, ori);
 				bin = (int) (18.0f * (angle + M_PI_F) *  M_1_PI_F);
 				if (bin<0) bin+=36;
 				if (bin>35) bin-=36;
@@ -311,5 +324,64 @@ __kernel void orientation_assignment(
 	}
 }
 
+__kernel void orientation_assignment(
+	__global keypoint* keypoints,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
+	__global int* counter,
+	int octsize,
+	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	int nb_keypoints,
+	int keypoints_start,
+	int keypoints_end,
+	int grad_width,
+	int grad_height)
+{
+	int groupid = get_group_id(0);
+	__local volatile float hist[36];
+	__local volatile float hist2[WORKGROUP_SIZE];
+	__local volatile int pos[WORKGROUP_SIZE];
+
+	if ((groupid< keypoints_start) || (groupid >= keypoints_end))
+		return;
+	orientation_one(keypoints, grad, ori, counter, octsize, OriSigma, nb_keypoints,
+	                grad_width, grad_height, groupid, hist, hist2, pos);
+}
+
+
+/**
+ * \brief Same as orientation_assignment, the range of keypoints being read from the device
+ *
+ * Each work-group loops over the keypoints with a stride of the number of
+ * work-groups, so that the kernel can be launched with a fixed size.
+ *
+ * @param counters: Pointer to global memory with keypoints_start and keypoints_end
+ * Other parameters are those of orientation_assignment
+ */
+__kernel void orientation_assignment_counters(
+	__global keypoint* keypoints,
+	__global LEVEL_T* grad,
+	__global LEVEL_T* ori,
+	__global int* counter,
+	int octsize,
+	float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+	int nb_keypoints,
+	__global int* counters,
+	int grad_width,
+	int grad_height)
+{
+	__local volatile float hist[36];
+	__local volatile float hist2[WORKGROUP_SIZE];
+	__local volatile int pos[WORKGROUP_SIZE];
+	int end = min(counters[1], nb_keypoints);
+
+	for (int groupid = counters[0] + (int) get_group_id(0); groupid < end; groupid += (int) get_num_groups(0)) {
+		orientation_one(keypoints, grad, ori, counter, octsize, OriSigma, nb_keypoints,
+		                grad_width, grad_height, groupid, hist, hist2, pos);
+		// the local buffers are re-initialized by the next keypoint
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+}
+
 
 
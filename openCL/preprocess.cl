@@ -51,6 +51,19 @@
     
 #define MAX_CONST_SIZE 16384
 
+/*
+ Storage of the gaussian levels, float or half (-D HALF_LEVELS), see image.cl
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+	#define STORE_LEVEL(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+	#define STORE_LEVEL(v, i, p) (p)[(i)] = (v)
+#endif
+
 
 /**
  * \brief Cast values of an array of uint8 into a float output array.
@@ -190,6 +203,349 @@ rgb_to_float(    __global unsigned char *array_int,
 }//end kernel
 
 
+/*
+ * Conversion kernels with fused max/min reduction, stage 1
+ *
+ * These are 1D kernels, to be launched like max_min_global_stage1: each
+ * thread converts pixels in a grid-stride loop while keeping track of the
+ * maximum and the minimum. Each workgroup writes its partial (max, min) in
+ * minmax[group_id], to be reduced by max_min_global_stage2.
+ *
+ * The workgroup size has to be a power of 2, lower or equal to WORKGROUP_SIZE.
+ */
+#define REDUCE_MAX_MIN(a, b) ((float2)(fmax(a.x,b.x),fmin(a.y,b.y)))
+
+/**
+ * \brief Reduce (max, min) within a workgroup and write it in minmax[group_id]
+ *
+ * @param acc:      partial (max, min) of the thread
+ * @param ldata:    local buffer of the size of the workgroup
+ * @param minmax:   Float2 pointer to global memory with the partial results of all workgroups
+ */
+void store_max_min(float2 acc,
+                   __local float2 *ldata,
+                   __global float2 *minmax)
+{
+    int lid = get_local_id(0);
+    ldata[lid] = acc;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (int stride = get_local_size(0) / 2; stride > 0; stride /= 2){
+        if (lid < stride)
+            ldata[lid] = REDUCE_MAX_MIN(ldata[lid], ldata[lid + stride]);
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if (lid == 0)
+        minmax[get_group_id(0)] = ldata[0];
+}
+
+/**
+ * \brief Cast values of an array of uint8 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the input data as unsigned8 array
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+u8_to_float_max_min(__global unsigned char  *array_int,
+                    __global float *array_float,
+                    __global float2 *minmax,
+                    const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Cast values of an array of uint16 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the input data as unsigned16 array
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+u16_to_float_max_min(__global unsigned short  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert values of an array of int32 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the data in int
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+s32_to_float_max_min(__global int  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert values of an array of int64 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the data in long
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+s64_to_float_max_min(__global long  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert values of an array of int16 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the input data as signed16 array
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+s16_to_float_max_min(__global short  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert values of an array of uint32 into a float output array and compute max/min partials.
+ *
+ * @param array_int:     Pointer to global memory with the input data as unsigned32 array
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+u32_to_float_max_min(__global unsigned int  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+#ifdef cl_khr_fp64
+#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+/**
+ * \brief Convert values of an array of float64 into a float output array and compute max/min partials.
+ *
+ * Only available on devices with double precision support (cl_khr_fp64)
+ *
+ * @param array_int:     Pointer to global memory with the input data as double array
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+f64_to_float_max_min(__global double  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = (float) array_int[i];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+#endif
+
+/**
+ * \brief Decode a float64 (IEEE-754, little endian) stored as 2 uint32 words into the nearest float
+ *
+ * @param word: (low, high) words of the double
+ * @return: float value, rounded to nearest even
+ */
+float double_word_to_float(uint2 word)
+{
+    uint sign = word.y & 0x80000000;
+    int exponent = (word.y >> 20) & 0x7FF;
+    uint mantissa = ((word.y & 0xFFFFF) << 3) | (word.x >> 29);  // 23 upper bits of the mantissa
+    uint rest = word.x & 0x1FFFFFFF;                               // 29 discarded bits
+    int fexp = exponent - 1023 + 127;
+    if (exponent == 0){            // zero or denormal, far below the float range
+        return as_float(sign);
+    }
+    else if (exponent == 0x7FF){   // inf or nan
+        return as_float(sign | 0x7F800000 | ((mantissa | rest) ? 0x400000 : 0));
+    }
+    else if (fexp >= 0xFF){        // overflow
+        return as_float(sign | 0x7F800000);
+    }
+    else if (fexp <= 0){           // denormal float
+        if (fexp < -24)
+            return as_float(sign);
+        uint full = mantissa | 0x800000;
+        int shift = 1 - fexp;
+        uint kept = full >> shift;
+        uint lost = full & ((1u << shift) - 1);
+        uint halfway = 1u << (shift - 1);
+        if ((lost > halfway) || ((lost == halfway) && (rest || (kept & 1))))
+            kept += 1;
+        return as_float(sign | kept);
+    }
+    uint bits = sign | (((uint) fexp) << 23) | mantissa;
+    if ((rest > 0x10000000) || ((rest == 0x10000000) && (mantissa & 1)))
+        bits += 1;                 // a carry into the exponent is the correct rounding
+    return as_float(bits);
+}
+
+/**
+ * \brief Convert values of an array of float64 into a float output array and compute max/min partials.
+ *
+ * For devices without double precision: each double is read as 2 uint32 words and decoded.
+ *
+ * @param array_int:     Pointer to global memory with the input data as double array, seen as uint2
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ */
+__kernel void
+f64w_to_float_max_min(__global uint2  *array_int,
+                      __global float *array_float,
+                      __global float2 *minmax,
+                      const int SIZE
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        float value = double_word_to_float(array_int[i]);
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert RGB or RGBA of an array of uint16 into a float output array and compute max/min partials.
+ *
+ * The alpha channel, if any, is ignored.
+ *
+ * @param array_int:     Pointer to global memory with the data as unsigned16
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ * @param channels:      3 for RGB, 4 for RGBA
+ */
+__kernel void
+rgb16_to_float_max_min(__global unsigned short  *array_int,
+                       __global float *array_float,
+                       __global float2 *minmax,
+                       const int SIZE,
+                       const int channels
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        int j = channels * i;
+        float value = 0.299f*array_int[j] + 0.587f*array_int[j+1] + 0.114f*array_int[j+2];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+/**
+ * \brief Convert RGB or RGBA of an array of uint8 into a float output array and compute max/min partials.
+ *
+ * The alpha channel, if any, is ignored.
+ *
+ * @param array_int:     Pointer to global memory with the data in int
+ * @param array_float:   Pointer to global memory with the output data as float array
+ * @param minmax:        Pointer to global memory with the (max, min) of each workgroup
+ * @param SIZE:          Number of pixels of the image
+ * @param channels:      3 for RGB, 4 for RGBA
+ */
+__kernel void
+rgb_to_float_max_min(__global unsigned char  *array_int,
+                     __global float *array_float,
+                     __global float2 *minmax,
+                     const int SIZE,
+                     const int channels
+)
+{
+    __local float2 ldata[WORKGROUP_SIZE];
+    float2 acc = (float2)(-MAXFLOAT, MAXFLOAT);
+    for (int i = get_global_id(0); i < SIZE; i += get_global_size(0)){
+        int j = channels * i;
+        float value = 0.299f*array_int[j] + 0.587f*array_int[j+1] + 0.114f*array_int[j+2];
+        array_float[i] = value;
+        acc = REDUCE_MAX_MIN(acc, (float2)(value, value));
+    }
+    store_max_min(acc, ldata, minmax);
+}//end kernel
+
+
 /**
  * \brief Performs normalization of image between 0 and max_out (255) in place.
  *
@@ -218,12 +574,43 @@ normalizes(    __global       float     *image,
     };//end if in IMAGE
 };//end kernel
 
+/**
+ * \brief Normalization of the image between 0 and max_out (255) into a gaussian level.
+ *
+ * Same as normalizes, when the levels are not stored as float (-D HALF_LEVELS)
+ *
+ * @param image        Float pointer to global memory storing the image.
+ * @param level        Pointer to global memory storing the normalized image.
+ * @param min_in:     Minimum value in the input array
+ * @param max_in:     Maximum value in the input array
+ * @param max_out:     Maximum value in the output array (255 adviced)
+ * @param IMAGE_W:    Width of the image
+ * @param IMAGE_H:     Height of the image
+ *
+**/
+__kernel void
+normalizes_level(const __global float     *image,
+            __global       LEVEL_T     *level,
+            __constant        float * min_in __attribute__((max_constant_size(MAX_CONST_SIZE))),
+            __constant        float * max_in __attribute__((max_constant_size(MAX_CONST_SIZE))),
+            __constant        float * max_out __attribute__((max_constant_size(MAX_CONST_SIZE))),
+            const             int IMAGE_W,
+            const             int IMAGE_H
+)
+{
+    //Global memory guard for padding
+    if((get_global_id(0) < IMAGE_W) && (get_global_id(1)<IMAGE_H)){
+    	int i = get_global_id(0) + IMAGE_W * get_global_id(1);
+        STORE_LEVEL(max_out[0]*(image[i]-min_in[0])/(max_in[0]-min_in[0]), i, level);
+    };//end if in IMAGE
+};//end kernel
+
 /**
  * \brief shrink: Subsampling of the image_in into a smaller image_out.
  *
  *
- * @param image_in        Float pointer to global memory storing the big image.
- * @param image_ou        Float pointer to global memory storing the small image.
+ * @param image_in        Pointer to global memory storing the big image (gaussian level).
+ * @param image_ou        Pointer to global memory storing the small image (gaussian level).
  * @param scale_w:     Minimum value in the input array
  * @param scale_h:     Maximum value in the input array
  * @param IMAGE_W:    Width of the output image
@@ -231,8 +618,8 @@ normalizes(    __global       float     *image,
  *
 **/
 __kernel void
-shrink(const __global     float     *image_in,
-            __global     float     *image_out,
+shrink(const __global     LEVEL_T     *image_in,
+            __global     LEVEL_T     *image_out,
             const             int scale_w,
             const             int scale_h,
             const             int LARGE_W,
@@ -247,14 +634,14 @@ shrink(const __global     float     *image_in,
     if ((gid0 < SMALL_W) && (gid1 <SMALL_H))
     {
         j = gid0 * scale_w + gid1 * scale_h * LARGE_W;
-        image_out[i] = image_in[j];
+        STORE_LEVEL(LOAD_LEVEL(j, image_in), i, image_out);
     };//end if in IMAGE
 };//end kernel
 
 
 /**
- * \brief bin: resampling of the image_in into a smaller image_out with higher dynamics.
- *
+ * \brief bin: resampling of the image_in into a smaller image_out by averaging
+ * blocks of scale_width x scale_heigth pixels.
  *
  * @param image_in        Float pointer to global memory storing the big image.
  * @param image_ou        Float pointer to global memory storing the small image.
@@ -265,7 +652,8 @@ shrink(const __global     float     *image_in,
  * @param binned_width:   Width of the output binned image
  * @param binned_heigth:  Height of the output binned image
  *
- * Nota: this is a 2D kernel. This is non working and non TESTED !!!
+ * Nota: this is a 2D kernel, launched on the binned image.
+ * Pixels beyond the border of the original image are mirrored.
 **/
 __kernel void
 bin(        const    __global     float     *image_in,
@@ -304,6 +692,49 @@ bin(        const    __global     float     *image_in,
     };//end if in IMAGE
 };//end kernel
 
+/**
+ * \brief mask_shrink: downsampling of a validity mask, a pixel of mask_out is
+ * valid only if all pixels of the corresponding block of mask_in are valid.
+ *
+ * @param mask_in:      Pointer to global memory with the large mask (0 for invalid pixels)
+ * @param mask_out:     Pointer to global memory with the small mask
+ * @param scale_width:  Shrinking factor in horizontal
+ * @param scale_heigth: Shrinking factor in vertical
+ * @param orig_width:   Size of the large mask in horizontal
+ * @param orig_heigth:  Size of the large mask in vertical
+ * @param small_width:  Size of the small mask in horizontal
+ * @param small_heigth: Size of the small mask in vertical
+ *
+ * Nota: this is a 2D kernel, launched on the small mask.
+ * Blocks are clipped to the large mask.
+**/
+__kernel void
+mask_shrink(const    __global     unsigned char     *mask_in,
+                     __global     unsigned char     *mask_out,
+            const                 int     scale_width,
+            const                 int     scale_heigth,
+            const                 int     orig_width,
+            const                 int     orig_heigth,
+            const                 int     small_width,
+            const                 int     small_heigth
+)
+{
+    int gid0=get_global_id(0), gid1=get_global_id(1);
+    if((gid0 < small_width) && (gid1 < small_heigth)){
+        unsigned char valid = 1;
+        int h, w;
+        int h_end = min((gid1 + 1) * scale_heigth, orig_heigth);
+        int w_end = min((gid0 + 1) * scale_width, orig_width);
+        for (h = gid1 * scale_heigth; h < h_end; h++){
+            for (w = gid0 * scale_width; w < w_end; w++){
+                if (mask_in[h * orig_width + w] == 0)
+                    valid = 0;
+            }
+        }
+        mask_out[gid0 + small_width * gid1] = valid;
+    }
+}
+
 /**
  * \brief gaussian: Initialize a vector with a gaussian function.
  *
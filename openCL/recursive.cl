@@ -0,0 +1,219 @@
+/*
+    Recursive (IIR) gaussian filter, after Young and van Vliet (1995):
+    a third order causal pass followed by a third order anti-causal pass
+    approximate a gaussian of any sigma (above 0.5) with 8 multiply-add per
+    pixel and per direction, whatever the width of the gaussian.
+
+    Each work-item filters one whole line (horizontal) or one whole column
+    (vertical): the vertical pass is coalesced on GPU, the horizontal one
+    reads contiguous memory on CPU. Both passes work in place on the output.
+
+    The coefficients are calculated on the host (see utils.recursive_gaussian):
+    b is the gain, a1, a2, a3 the feedback terms, with b + a1 + a2 + a3 = 1.
+    Borders are extended with the edge value (the steady state of the filter
+    for a constant signal).
+*/
+
+#ifndef IMAGE_W
+	#define IMAGE_W image_w
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H image_h
+#endif
+
+/*
+ Storage of the DoGs, float or half (-D HALF_DOGS), see image.cl
+*/
+#ifdef HALF_DOGS
+	#define DOG_T half
+	#define STORE_DOG(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define DOG_T float
+	#define STORE_DOG(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Storage of the gaussian levels and of the temporary buffer, float or half
+ (-D HALF_LEVELS), see image.cl. The raw image read by the normalizing
+ pass is always float.
+*/
+#ifdef HALF_LEVELS
+	#define LEVEL_T half
+	#define LOAD_LEVEL(i, p) vload_half((i), (p))
+	#define STORE_LEVEL(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define LEVEL_T float
+	#define LOAD_LEVEL(i, p) (p)[(i)]
+	#define STORE_LEVEL(v, i, p) (p)[(i)] = (v)
+#endif
+
+/*
+ Filter the line of size pixels starting at output with a stride of step,
+ in place: anti-causal pass, w1 being the last value of the causal pass.
+*/
+inline void anticausal_line(
+	__global LEVEL_T * output,
+	int size,
+	int step,
+	float b,
+	float a1,
+	float a2,
+	float a3,
+	float w1
+)
+{
+	float w2, w3, w0;
+	w2 = w3 = w1;
+	for (int i = size - 1; i >= 0; i--) {
+		w0 = b * LOAD_LEVEL(i * step, output) + a1 * w1 + a2 * w2 + a3 * w3;
+		STORE_LEVEL(w0, i * step, output);
+		w3 = w2;
+		w2 = w1;
+		w1 = w0;
+	}
+}
+
+/*
+ Filter the line of size pixels starting at data with a stride of step,
+ reading from input and writing to output (which may be the same buffer).
+*/
+inline void recursive_line(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	int size,
+	int step,
+	float b,
+	float a1,
+	float a2,
+	float a3
+)
+{
+	float w1, w2, w3, w0;
+	// causal pass
+	w1 = w2 = w3 = LOAD_LEVEL(0, input);
+	for (int i = 0; i < size; i++) {
+		w0 = b * LOAD_LEVEL(i * step, input) + a1 * w1 + a2 * w2 + a3 * w3;
+		STORE_LEVEL(w0, i * step, output);
+		w3 = w2;
+		w2 = w1;
+		w1 = w0;
+	}
+	anticausal_line(output, size, step, b, a1, a2, a3, w1);
+}
+
+/*
+ Horizontal pass: one work-item per line, launched on (IMAGE_H,)
+*/
+__kernel void horizontal_recursive(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	float b,
+	float a1,
+	float a2,
+	float a3,
+	int image_w,
+	int image_h
+)
+{
+	int gid = (int) get_global_id(0);
+	if (gid < IMAGE_H)
+		recursive_line(input + gid * IMAGE_W, output + gid * IMAGE_W, IMAGE_W, 1, b, a1, a2, a3);
+}
+
+/*
+ Horizontal pass of the raw (float) image, normalized on the fly between 0 and max_out
+*/
+__kernel void horizontal_recursive_normalize(
+	const __global float * input,
+	__global LEVEL_T * output,
+	float b,
+	float a1,
+	float a2,
+	float a3,
+	int image_w,
+	int image_h,
+	const __global float * min_in,
+	const __global float * max_in,
+	float max_out
+)
+{
+	int gid = (int) get_global_id(0);
+	if (gid < IMAGE_H) {
+		float offset = min_in[0];
+		float scale = max_out / (max_in[0] - offset);
+		const __global float * line = input + gid * IMAGE_W;
+		__global LEVEL_T * out = output + gid * IMAGE_W;
+		float w1, w2, w3, w0;
+		w1 = w2 = w3 = (line[0] - offset) * scale;
+		for (int i = 0; i < IMAGE_W; i++) {
+			w0 = b * (line[i] - offset) * scale + a1 * w1 + a2 * w2 + a3 * w3;
+			STORE_LEVEL(w0, i, out);
+			w3 = w2;
+			w2 = w1;
+			w1 = w0;
+		}
+		anticausal_line(out, IMAGE_W, 1, b, a1, a2, a3, w1);
+	}
+}
+
+/*
+ Vertical pass: one work-item per column, launched on (IMAGE_W,)
+*/
+__kernel void vertical_recursive(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	float b,
+	float a1,
+	float a2,
+	float a3,
+	int image_w,
+	int image_h
+)
+{
+	int gid = (int) get_global_id(0);
+	if (gid < IMAGE_W)
+		recursive_line(input + gid, output + gid, IMAGE_H, IMAGE_W, b, a1, a2, a3);
+}
+
+/*
+ Vertical pass fused with the difference of gaussians: the anti-causal pass
+ also writes previous - output into the slice dog of the DoG stack.
+*/
+__kernel void vertical_recursive_dog(
+	const __global LEVEL_T * input,
+	__global LEVEL_T * output,
+	float b,
+	float a1,
+	float a2,
+	float a3,
+	int image_w,
+	int image_h,
+	const __global LEVEL_T * previous,
+	__global DOG_T * dogs,
+	int dog
+)
+{
+	int gid = (int) get_global_id(0);
+	if (gid < IMAGE_W) {
+		float w1, w2, w3, w0;
+		__global LEVEL_T * column = output + gid;
+		int dog_column = dog * IMAGE_W * IMAGE_H + gid;
+		w1 = w2 = w3 = LOAD_LEVEL(gid, input);
+		for (int i = 0; i < IMAGE_H; i++) {
+			w0 = b * LOAD_LEVEL(i * IMAGE_W + gid, input) + a1 * w1 + a2 * w2 + a3 * w3;
+			STORE_LEVEL(w0, i * IMAGE_W, column);
+			w3 = w2;
+			w2 = w1;
+			w1 = w0;
+		}
+		w2 = w3 = w1;
+		for (int i = IMAGE_H - 1; i >= 0; i--) {
+			w0 = b * LOAD_LEVEL(i * IMAGE_W, column) + a1 * w1 + a2 * w2 + a3 * w3;
+			STORE_LEVEL(w0, i * IMAGE_W, column);
+			STORE_DOG(LOAD_LEVEL(i * IMAGE_W + gid, previous) - w0, dog_column + i * IMAGE_W, dogs);
+			w3 = w2;
+			w2 = w1;
+			w1 = w0;
+		}
+	}
+}
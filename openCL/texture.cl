@@ -0,0 +1,309 @@
+/*
+    Scale-space kernels working on image2d_t
+
+    The gaussian levels are stored as images: the borders are handled by the
+    samplers (mirrored repeat for the convolutions, clamp to edge for the
+    gradient) instead of index arithmetic, and the neighbourhood reads go
+    through the texture cache.
+
+    The results are identical to those of convolution.cl, algebra.cl
+    (combine), image.cl (local_maxmin, compute_gradient_orientation) and
+    preprocess.cl (shrink).
+*/
+
+typedef float4 keypoint;
+
+/*
+ Storage of the DoGs, float or half (-D HALF_DOGS), see image.cl
+*/
+#ifdef HALF_DOGS
+	#define DOG_T half
+	#define STORE_DOG(v, i, p) vstore_half((v), (i), (p))
+#else
+	#define DOG_T float
+	#define STORE_DOG(v, i, p) (p)[(i)] = (v)
+#endif
+
+#define MAX_CONST_SIZE 16384
+
+/*
+ Compile-time specialization, see convolution.cl and image.cl
+*/
+#ifndef FILTER_SIZE
+	#define FILTER_SIZE filter_size
+#endif
+#ifndef IMAGE_W
+	#define IMAGE_W image_w
+#endif
+#ifndef IMAGE_H
+	#define IMAGE_H image_h
+#endif
+#ifndef BORDER_DIST
+	#define BORDER_DIST border_dist
+#endif
+#ifndef PEAK_THRESH
+	#define PEAK_THRESH peak_thresh
+#endif
+#ifndef OCTSIZE
+	#define OCTSIZE octsize
+#endif
+#ifndef EDGE_THRESH0
+	#define EDGE_THRESH0 EdgeThresh0
+#endif
+#ifndef EDGE_THRESH
+	#define EDGE_THRESH EdgeThresh
+#endif
+
+/*
+ Mirrored repeat is only available with normalized coordinates:
+ pixel -1 reads pixel 0, pixel IMAGE_W reads pixel IMAGE_W-1 (like the
+ "reflect" mode of convolution.cl)
+*/
+__constant sampler_t mirror_sampler = CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_MIRRORED_REPEAT | CLK_FILTER_NEAREST;
+__constant sampler_t pixel_sampler = CLK_NORMALIZED_COORDS_FALSE | CLK_ADDRESS_CLAMP_TO_EDGE | CLK_FILTER_NEAREST;
+
+inline float mirrored(read_only image2d_t img, int x, int y, float2 scale)
+{
+	return read_imagef(img, mirror_sampler, (float2)(((float) x + 0.5f) * scale.x, ((float) y + 0.5f) * scale.y)).x;
+}
+
+inline float pixel(read_only image2d_t img, int x, int y)
+{
+	return read_imagef(img, pixel_sampler, (int2)(x, y)).x;
+}
+
+
+/**
+ * \brief Horizontal convolution, the output image is normalized on the fly
+ * as output = (conv(input) - offset) * scale
+ */
+inline void horizontal_image(
+	read_only image2d_t input,
+	write_only image2d_t output,
+	__constant float * filter,
+	int filter_size,
+	int image_w,
+	int image_h,
+	float offset,
+	float scale
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+		float2 norm = (float2)(1.0f / IMAGE_W, 1.0f / IMAGE_H);
+		float sum = 0.0f;
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += (mirrored(input, gid0 + f - HALF_FILTER_SIZE, gid1, norm) - offset) * filter[f];
+		write_imagef(output, (int2)(gid0, gid1), (float4)(sum * scale, 0.0f, 0.0f, 0.0f));
+	}
+}
+
+__kernel void horizontal_convolution_image(
+	read_only image2d_t input,
+	write_only image2d_t output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h
+)
+{
+	horizontal_image(input, output, filter, filter_size, image_w, image_h, 0.0f, 1.0f);
+}
+
+__kernel void horizontal_convolution_normalize_image(
+	read_only image2d_t input,
+	write_only image2d_t output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h,
+	const __global float * min_in,
+	const __global float * max_in,
+	float max_out
+)
+{
+	float offset = min_in[0];
+	horizontal_image(input, output, filter, filter_size, image_w, image_h,
+	                 offset, max_out / (max_in[0] - offset));
+}
+
+__kernel void vertical_convolution_image(
+	read_only image2d_t input,
+	write_only image2d_t output,
+	__constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))),
+	int filter_size,
+	int image_w,
+	int image_h
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		int HALF_FILTER_SIZE = (FILTER_SIZE % 2 == 1 ? (FILTER_SIZE)/2 : (FILTER_SIZE+1)/2);
+		float2 norm = (float2)(1.0f / IMAGE_W, 1.0f / IMAGE_H);
+		float sum = 0.0f;
+		for (int f = 0; f < FILTER_SIZE; f++)
+			sum += mirrored(input, gid0, gid1 + f - HALF_FILTER_SIZE, norm) * filter[f];
+		write_imagef(output, (int2)(gid0, gid1), (float4)(sum, 0.0f, 0.0f, 0.0f));
+	}
+}
+
+
+/**
+ * \brief Difference of gaussians: DOGS[dog] = blur0 - blur1
+ *
+ * @param blur0: gaussian level "dog"
+ * @param blur1: gaussian level "dog+1"
+ * @param DOGS: Pointer to global memory with ALL the contiguous Differences of Gaussians
+ * @param dog: index of the DoG
+ */
+__kernel void dog_image(
+	read_only image2d_t blur0,
+	read_only image2d_t blur1,
+	__global DOG_T * DOGS,
+	int dog,
+	int image_w,
+	int image_h
+)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W)
+		STORE_DOG(pixel(blur0, gid0, gid1) - pixel(blur1, gid0, gid1), (dog * IMAGE_H + gid1) * IMAGE_W + gid0, DOGS);
+}
+
+
+/**
+ * \brief Same as local_maxmin, the three DoGs being calculated on the fly
+ * from the four gaussian levels blur0..blur3: DoG[scale-1] = blur0 - blur1,
+ * DoG[scale] = blur1 - blur2 and DoG[scale+1] = blur2 - blur3
+ */
+__kernel void local_maxmin_image(
+	read_only image2d_t blur0,
+	read_only image2d_t blur1,
+	read_only image2d_t blur2,
+	read_only image2d_t blur3,
+	__global keypoint* output,
+	int border_dist,
+	float peak_thresh,
+	int octsize,
+	float EdgeThresh0,
+	float EdgeThresh,
+	__global int* counter,
+	int nb_keypoints,
+	int scale,
+	int image_w,
+	int image_h)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+
+	if ((gid1 < IMAGE_H - BORDER_DIST) && (gid0 < IMAGE_W - BORDER_DIST) && (gid1 >= BORDER_DIST) && (gid0 >= BORDER_DIST)) {
+		float res = 0.0f;
+		float val = pixel(blur1, gid0, gid1) - pixel(blur2, gid0, gid1);
+
+		if (fabs(val) > (0.8 * PEAK_THRESH)) {
+			// 3x3x3 neighbourhood in the DoGs: prev, current, next
+			float prev[3][3], dog[3][3], next[3][3];
+			for (int r = 0; r < 3; r++) {
+				for (int c = 0; c < 3; c++) {
+					float g0 = pixel(blur0, gid0 + c - 1, gid1 + r - 1),
+						g1 = pixel(blur1, gid0 + c - 1, gid1 + r - 1),
+						g2 = pixel(blur2, gid0 + c - 1, gid1 + r - 1),
+						g3 = pixel(blur3, gid0 + c - 1, gid1 + r - 1);
+					prev[r][c] = g0 - g1;
+					dog[r][c] = g1 - g2;
+					next[r][c] = g2 - g3;
+				}
+			}
+			int ismax = 0, ismin = 0;
+			if (val > 0.0) ismax = 1;
+			else ismin = 1;
+			for (int r = 0; r < 3; r++) {
+				for (int c = 0; c < 3; c++) {
+					if (ismax == 1)
+						if (prev[r][c] > val || dog[r][c] > val || next[r][c] > val) ismax = 0;
+					if (ismin == 1)
+						if (prev[r][c] < val || dog[r][c] < val || next[r][c] < val) ismin = 0;
+				}
+			}
+
+			if (ismax == 1 || ismin == 1) res = val;
+
+			// Edge rejection with the ratio of the principal curvatures
+			float H00 = dog[0][1] - 2.0 * dog[1][1] + dog[2][1],
+			H11 = dog[1][0] - 2.0 * dog[1][1] + dog[1][2],
+			H01 = ( (dog[2][2] - dog[2][0]) - (dog[0][2] - dog[0][0])) / 4.0;
+
+			float det = H00 * H11 - H01 * H01, trace = H00 + H11;
+			float edthresh = (OCTSIZE <= 1 ? EDGE_THRESH0 : EDGE_THRESH);
+
+			if (det < edthresh * trace * trace)
+				res = 0.0f;
+
+			if (res != 0.0f) {
+				int old = atomic_inc(counter);
+				keypoint k = 0.0;
+				k.s0 = val;
+				k.s1 = (float) gid1;
+				k.s2 = (float) gid0;
+				k.s3 = (float) scale;
+				if (old < nb_keypoints) output[old]=k;
+			}
+		}
+	}
+}
+
+
+/**
+ * \brief Gradient of a gaussian level, same as compute_gradient_orientation:
+ * central differences in the interior and first differences at the
+ * boundaries (the sampler clamps to the edge, hence the factor 2).
+ */
+__kernel void compute_gradient_orientation_image(
+	read_only image2d_t igray,
+	__global float *grad,
+	__global float *ori,
+	int image_w,
+	int image_h)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+
+	if (gid1 < IMAGE_H && gid0 < IMAGE_W) {
+		int pos = gid1 * IMAGE_W + gid0;
+		float xgrad = pixel(igray, gid0 + 1, gid1) - pixel(igray, gid0 - 1, gid1);
+		float ygrad = pixel(igray, gid0, gid1 - 1) - pixel(igray, gid0, gid1 + 1);
+		if ((gid0 == 0) || (gid0 == IMAGE_W - 1))
+			xgrad *= 2.0f;
+		if ((gid1 == 0) || (gid1 == IMAGE_H - 1))
+			ygrad *= 2.0f;
+		grad[pos] = sqrt((xgrad * xgrad + ygrad * ygrad));
+		ori[pos] = atan2 (-ygrad,xgrad);
+	}
+}
+
+
+/**
+ * \brief Subsampling of a gaussian level for the next octave (like shrink)
+ *
+ * @param input: large image
+ * @param output: small image (small_width x small_heigth)
+ * @param scale_width: shrinking factor in horizontal
+ * @param scale_heigth: shrinking factor in vertical
+ */
+__kernel void shrink_image(
+	read_only image2d_t input,
+	write_only image2d_t output,
+	int scale_width,
+	int scale_heigth,
+	int small_width,
+	int small_heigth)
+{
+	int gid0 = (int) get_global_id(0);
+	int gid1 = (int) get_global_id(1);
+	if ((gid0 < small_width) && (gid1 < small_heigth))
+		write_imagef(output, (int2)(gid0, gid1), read_imagef(input, pixel_sampler, (int2)(gid0 * scale_width, gid1 * scale_heigth)));
+}
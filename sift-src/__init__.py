@@ -1,11 +1,44 @@
 """
 Module Sift for calculating SIFT keypoint using PyOpenCL
+
+Submodules (and pyopencl) are only imported when first used, so that
+"import sift" stays cheap:
+
+import sift
+siftp = sift.SiftPlan(img.shape, img.dtype)  # imports sift.plan here
 """
 version = "0.1.0"
 import os
 sift_home = os.path.dirname(os.path.abspath(__file__))
-import sys, logging
-logging.basicConfig()
-from .plan import SiftPlan
-from .match import MatchPlan
+import sys, types, logging, importlib
+logging.getLogger("sift").addHandler(logging.NullHandler())
+
+# key: public name, value: submodule defining it
+_lazy_objects = {"SiftPlan": "plan",
+                 "MatchPlan": "match"}
+_submodules = ("alignment", "cache", "match", "opencl", "param", "plan", "utils")
+__all__ = ["version", "sift_home"] + sorted(_lazy_objects)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Package module importing its submodules on first access
+    """
+    def __getattr__(self, name):
+        if name in _lazy_objects:
+            module = importlib.import_module("." + _lazy_objects[name], __name__)
+            value = getattr(module, name)
+        elif name in _submodules:
+            value = importlib.import_module("." + name, __name__)
+        else:
+            raise AttributeError("module %s has no attribute %s" % (__name__, name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy_objects) | set(_submodules))
 
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original = sys.modules[__name__]  # keeps the globals of the functions above alive
+sys.modules[__name__] = _module
@@ -40,6 +40,7 @@ FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 
 """
+import logging
 import numpy
 import pyopencl, pyopencl.array
 from .param import par
@@ -60,9 +61,9 @@ class LinearAlign(object):
         @param extra: extra space around the image, can be an integer, or a 2 tuple in YX convension
         """
         self.ref = image
-        self.sift = SiftPlan(template = image, devicetype=devicetype, profile=profile, device=device, max_workgroup_size=max_workgroup_size)
+        self.sift = SiftPlan(template = image, devicetype=devicetype, profile=profile, device=device, max_workgroup_size=max_workgroup_size, shared_queue=True)
         self.kp = self.sift.keypoints(image)
-        self.match =  MatchPlan(devicetype=devicetype, profile=profile, device=device, max_workgroup_size=max_workgroup_size, roi=roi)
+        self.match =  MatchPlan(devicetype=devicetype, profile=profile, device=self.sift.device, max_workgroup_size=max_workgroup_size, roi=roi, shared_queue=True)
         #TODO optimize match so that the keypoint2 can be optional 
     def align(self, img, extra=None):
         """
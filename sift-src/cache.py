@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+#    Project: Sift implementation in Python + OpenCL
+#             https://github.com/kif/sift_pyocl
+#
+
+"""
+Persistent on-disk cache of compiled OpenCL program binaries
+"""
+
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__license__ = "BSD"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import os, time, hashlib, logging, threading
+logger = logging.getLogger("sift.cache")
+
+try:
+    import pyopencl
+except ImportError:
+    logger.error("Unable to import pyOpenCl. Please install it from: http://pypi.python.org/pypi/pyopencl")
+    pyopencl = None
+
+
+def get_cache_dir():
+    """
+    Directory where sift keeps its persistent data (compiled kernels, ...)
+
+    Defaults to ~/.cache/sift, can be overridden with the SIFT_CACHE_DIR
+    environment variable.
+    """
+    path = os.environ.get("SIFT_CACHE_DIR")
+    if not path:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "sift")
+    return path
+
+
+class ProgramCache(object):
+    """
+    Cache of compiled OpenCL programs stored on disk.
+
+    Entries are keyed by the platform, the device, its driver version, the
+    source of the kernel and the build options, so any change in one of
+    them triggers a recompilation.
+
+    Each entry starts with a magic string and the MD5 checksum of the binary:
+    entries which do not match (truncated write, disk corruption, ...) or
+    which the driver refuses to load are discarded and rebuilt.
+
+    siftp = sift.SiftPlan(img.shape, img.dtype)
+    print(sift.cache.program_cache)
+    """
+    MAGIC = b"SIFT_CL1"
+    EXTENSION = ".bin"
+
+    def __init__(self, path=None, max_size=256 * 2 ** 20, max_age=30 * 24 * 3600, enabled=True):
+        """
+        @param path: directory where binaries are stored (default: get_cache_dir()/kernels)
+        @param max_size: maximum size of the cache in bytes, oldest entries are evicted first
+        @param max_age: entries not used for that many seconds are evicted
+        @param enabled: set to False to always build from source
+        """
+        if path is None:
+            path = os.path.join(get_cache_dir(), "kernels")
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.enabled = bool(enabled)
+        self._sem = threading.Semaphore()
+        self.hits = 0
+        self.misses = 0
+        self.corrupted = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "ProgramCache in %s: %s hits, %s misses, %s corrupted, %s evicted" % \
+            (self.path, self.hits, self.misses, self.corrupted, self.evicted)
+
+    @property
+    def stats(self):
+        """
+        Dictionary with the hit/miss counters
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "corrupted": self.corrupted,
+                "evicted": self.evicted}
+
+    def reset_stats(self):
+        """
+        Resets the hit/miss counters
+        """
+        with self._sem:
+            self.hits = self.misses = self.corrupted = self.evicted = 0
+
+    def key(self, ctx, source, options=""):
+        """
+        Calculate the key of a program in the cache
+
+        @param ctx: OpenCL context the program is built for
+        @param source: source code of the kernel
+        @param options: build options like "-D WORKGROUP_SIZE=128"
+        @return: hexadecimal string
+        """
+        if not isinstance(source, bytes):
+            source = source.encode("utf8")
+        keys = [hashlib.sha1(source).hexdigest(), str(options)]
+        for device in ctx.devices:
+            keys += [device.platform.name, device.platform.version,
+                     device.name, device.version, device.driver_version]
+        return hashlib.sha1("|".join(keys).encode("utf8")).hexdigest()
+
+    def build(self, ctx, source, options=""):
+        """
+        Return the program built for the given context, from the cache if possible.
+
+        @param ctx: OpenCL context
+        @param source: source code of the kernel
+        @param options: build options
+        @return: built pyopencl.Program
+        """
+        if not self.enabled:
+            return pyopencl.Program(ctx, source).build(options)
+        filename = os.path.join(self.path, self.key(ctx, source, options) + self.EXTENSION)
+        binaries = self._load(filename, len(ctx.devices))
+        if binaries is not None:
+            try:
+                program = pyopencl.Program(ctx, ctx.devices, binaries).build(options)
+            except (pyopencl.Error, ValueError) as error:
+                logger.warning("Discarding cached program %s: %s", filename, error)
+                with self._sem:
+                    self.corrupted += 1
+                self._remove(filename)
+            else:
+                with self._sem:
+                    self.hits += 1
+                return program
+        with self._sem:
+            self.misses += 1
+        program = pyopencl.Program(ctx, source).build(options)
+        try:
+            binaries = program.get_info(pyopencl.program_info.BINARIES)
+        except pyopencl.Error as error:
+            logger.warning("Unable to retrieve program binaries: %s", error)
+        else:
+            self._store(filename, binaries)
+            self.evict()
+        return program
+
+    def _load(self, filename, nb_devices):
+        """
+        Read an entry and check its integrity
+
+        @return: list of binaries or None if not available
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as infile:
+                data = infile.read()
+        except IOError as error:
+            logger.warning("Unable to read cached program %s: %s", filename, error)
+            return None
+        header = len(self.MAGIC) + 32
+        checksum = data[len(self.MAGIC):header].decode("ascii", "replace")
+        payload = data[header:]
+        if (not data.startswith(self.MAGIC)) or (hashlib.md5(payload).hexdigest() != checksum):
+            logger.warning("Corrupted program in cache: %s", filename)
+            with self._sem:
+                self.corrupted += 1
+            self._remove(filename)
+            return None
+        binaries = []
+        while payload:
+            size = int(payload[:16])
+            binaries.append(payload[16:16 + size])
+            payload = payload[16 + size:]
+        if len(binaries) != nb_devices:
+            logger.warning("Cached program %s has %s binaries, expected %s", filename, len(binaries), nb_devices)
+            self._remove(filename)
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return binaries
+
+    def _store(self, filename, binaries):
+        """
+        Write an entry in the cache (atomically, via a temporary file)
+        """
+        payload = b"".join(("%016i" % len(binary)).encode("ascii") + bytes(binary) for binary in binaries)
+        tmpname = "%s.%s.%s" % (filename, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(tmpname, "wb") as outfile:
+                outfile.write(self.MAGIC)
+                outfile.write(hashlib.md5(payload).hexdigest().encode("ascii"))
+                outfile.write(payload)
+            if os.name == "nt" and os.path.exists(filename):
+                os.unlink(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as error:
+            logger.warning("Unable to store program in cache %s: %s", self.path, error)
+            self._remove(tmpname)
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        @return: list of (mtime, size, filename) for all entries, oldest first
+        """
+        res = []
+        if not os.path.isdir(self.path):
+            return res
+        for name in os.listdir(self.path):
+            if name.endswith(self.EXTENSION):
+                filename = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                res.append((stat.st_mtime, stat.st_size, filename))
+        res.sort()
+        return res
+
+    def evict(self):
+        """
+        Remove entries older than max_age, then the oldest entries until the
+        cache fits in max_size.
+        """
+        entries = self.entries()
+        total = sum(i[1] for i in entries)
+        limit = time.time() - self.max_age
+        for mtime, size, filename in entries:
+            if (mtime >= limit) and (total <= self.max_size):
+                break
+            logger.debug("Evicting program %s from cache", filename)
+            self._remove(filename)
+            total -= size
+            with self._sem:
+                self.evicted += 1
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        for mtime, size, filename in self.entries():
+            self._remove(filename)
+
+program_cache = ProgramCache()
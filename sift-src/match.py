@@ -45,7 +45,7 @@ import gc
 import numpy
 import pyopencl, pyopencl.array
 from .param import par
-from .opencl import ocl
+from .opencl import ocl, LazyPrograms
 from .utils import calc_size, kernel_size, sizeof
 logger = logging.getLogger("sift.match")
 from pyopencl import mem_flags as MF
@@ -71,7 +71,7 @@ class MatchPlan(object):
                                 ('desc', (numpy.uint8, 128))
                                 ])
 
-    def __init__(self, size=16384, devicetype="CPU", profile=False, device=None, max_workgroup_size=128, roi=None):
+    def __init__(self, size=16384, devicetype="CPU", profile=False, device=None, max_workgroup_size=128, roi=None, shared_queue=False):
         """
         Contructor of the class
         """
@@ -88,11 +88,12 @@ class MatchPlan(object):
             self.device = ocl.select_device(type=devicetype, memory=self.memory, best=True)
         else:
             self.device = device
-        self.ctx = pyopencl.Context(devices=[pyopencl.get_platforms()[self.device[0]].get_devices()[self.device[1]]])
-        if profile:
-            self.queue = pyopencl.CommandQueue(self.ctx, properties=pyopencl.command_queue_properties.PROFILING_ENABLE)
+        self.devctx = ocl.get_context(*self.device)
+        self.ctx = self.devctx.ctx
+        if shared_queue:
+            self.queue = self.devctx.get_queue(profile)
         else:
-            self.queue = pyopencl.CommandQueue(self.ctx)
+            self.queue = self.devctx.create_queue(profile)
 #        self._calc_workgroups()
         self._compile_kernels()
         self._allocate_buffers()
@@ -140,24 +141,9 @@ class MatchPlan(object):
 
     def _compile_kernels(self):
         """
-        Call the OpenCL compiler
-        """
-        for kernel in self.kernels:
-            kernel_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), kernel + ".cl")
-            kernel_src = open(kernel_file).read()
-            wg_size = min(self.max_workgroup_size, self.kernels[kernel])
-            try:
-                program = pyopencl.Program(self.ctx, kernel_src).build('-D WORKGROUP_SIZE=%s' % wg_size)
-            except pyopencl.MemoryError as error:
-                raise MemoryError(error)
-            except pyopencl.RuntimeError as error:
-                if kernel == "keypoints":
-                    logger.warning("Failed compiling kernel '%s' with workgroup size %s: %s: use low_end alternative", kernel, wg_size, error)
-                    self.LOW_END = True
-                else:
-                    logger.error("Failed compiling kernel '%s' with workgroup size %s: %s", kernel, wg_size, error)
-                    raise error
-            self.programs[kernel] = program
+        Prepare the OpenCL programs, compiled on first use
+        """
+        self.programs = LazyPrograms(self.devctx, self.kernels, self.max_workgroup_size)
 
     def _free_kernels(self):
         """
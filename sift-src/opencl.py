@@ -41,8 +41,11 @@ OTHER DEALINGS IN THE SOFTWARE.
 
 """
 
-import os, logging
+import os, logging, threading, json, glob, hashlib, socket
+import numpy
 logger = logging.getLogger("sift.opencl")
+from .cache import program_cache, get_cache_dir
+from .utils import kernel_size
 
 try:
     import pyopencl
@@ -83,6 +86,7 @@ class Device(object):
         self.id = id
         if not flop_core:
             flop_core = FLOP_PER_CORE.get(type, 1)
+        self.flop_core = flop_core
         if cores and frequency:
             self.flops = cores * frequency * flop_core
         else:
@@ -130,12 +134,94 @@ class Platform(object):
         return out
 
 
+def icd_fingerprint():
+    """
+    Signature of the OpenCL installation of the host: ICD files, the
+    drivers they point to and pyopencl itself. It changes whenever a driver
+    is installed, removed or upgraded.
+
+    @return: hexadecimal string
+    """
+    keys = [socket.gethostname(), pyopencl.VERSION_TEXT, os.path.abspath(pyopencl.__file__)]
+    for env in ("OCL_ICD_VENDORS", "OCL_ICD_FILENAMES", "OPENCL_VENDOR_PATH"):
+        keys.append(os.environ.get(env, ""))
+    vendors = os.environ.get("OCL_ICD_VENDORS", "/etc/OpenCL/vendors")
+    if os.path.isdir(vendors):
+        icd_files = sorted(glob.glob(os.path.join(vendors, "*.icd")))
+    else:
+        icd_files = [vendors]
+    libraries = [os.path.dirname(os.path.dirname(os.path.abspath(pyopencl.__file__)))]
+    for icd in icd_files:
+        try:
+            library = open(icd).read().strip()
+        except IOError:
+            continue
+        keys += [icd, library]
+        if os.path.isabs(library):
+            libraries.append(library)
+        else:
+            ld_path = os.environ.get("LD_LIBRARY_PATH", "").split(os.pathsep)
+            for path in ld_path + ["/usr/lib", "/usr/lib64", "/usr/local/lib", "/usr/lib/x86_64-linux-gnu"]:
+                if path and os.path.exists(os.path.join(path, library)):
+                    libraries.append(os.path.join(path, library))
+                    break
+    for library in libraries:
+        try:
+            stat = os.stat(library)
+        except OSError:
+            continue
+        keys += [library, str(stat.st_size), str(stat.st_mtime)]
+    return hashlib.sha1("|".join(keys).encode("utf8")).hexdigest()
+
+
 class OpenCL(object):
     """
     Simple class that wraps the structure ocl_tools_extended.h
+
+    Platforms and devices are enumerated on first access to the platforms
+    attribute. The result is cached on disk, one file per host, and is
+    invalidated when the OpenCL installation changes (see icd_fingerprint).
+    Set the SIFT_DEVICE_CACHE environment variable to 0 to always probe the
+    drivers.
     """
-    platforms = []
-    if pyopencl:
+    contexts = {}  # key: (platformid, deviceid), value: DeviceContext
+    _sem = threading.Semaphore()
+
+    def __init__(self, use_cache=None):
+        """
+        @param use_cache: read/write the list of devices from/to the disk cache (default: True unless SIFT_DEVICE_CACHE=0)
+        """
+        if use_cache is None:
+            use_cache = os.environ.get("SIFT_DEVICE_CACHE", "1").lower() not in ("0", "no", "false", "off")
+        self.use_cache = bool(use_cache)
+        self._platforms = None
+        self._probe_sem = threading.Semaphore()
+
+    @property
+    def platforms(self):
+        """
+        List of Platform, enumerated on first access
+        """
+        if self._platforms is None:
+            with self._probe_sem:
+                if self._platforms is None:
+                    platforms = None
+                    if self.use_cache:
+                        platforms = self._load_cache()
+                    if platforms is None:
+                        platforms = self._probe()
+                        if self.use_cache:
+                            self._save_cache(platforms)
+                    self._platforms = platforms
+        return self._platforms
+
+    def _probe(self):
+        """
+        Ask the OpenCL drivers for all platforms and devices
+
+        @return: list of Platform
+        """
+        platforms = []
         for id, platform in enumerate(pyopencl.get_platforms()):
             pypl = Platform(platform.name, platform.vendor, platform.version, platform.extensions, id)
             for idd, device in enumerate(platform.get_devices()):
@@ -161,8 +247,68 @@ class OpenCL(object):
                                device.max_clock_frequency, flop_core, idd)
                 pypl.add_device(pydev)
             platforms.append(pypl)
-        del platform, device, pypl, devtype, extensions, pydev
+        return platforms
+
+    @staticmethod
+    def cache_file():
+        """
+        @return: name of the file where the devices of this host are cached
+        """
+        return os.path.join(get_cache_dir(), "devices_%s.json" % socket.gethostname())
+
+    def _load_cache(self):
+        """
+        Read the list of platforms from the disk cache
+
+        @return: list of Platform or None if not available or outdated
+        """
+        filename = self.cache_file()
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename) as infile:
+                data = json.load(infile)
+            if data.get("fingerprint") != icd_fingerprint():
+                logger.info("OpenCL installation changed, discarding %s", filename)
+                return None
+            platforms = []
+            for pl in data["platforms"]:
+                pypl = Platform(pl["name"], pl["vendor"], pl["version"], " ".join(pl["extensions"]), pl["id"])
+                for dev in pl["devices"]:
+                    pypl.add_device(Device(dev["name"], dev["type"], dev["version"], dev["driver_version"],
+                                           " ".join(dev["extensions"]), dev["memory"], dev["available"],
+                                           dev["cores"], dev["frequency"], dev["flop_core"], dev["id"]))
+                platforms.append(pypl)
+        except (IOError, ValueError, KeyError, TypeError) as error:
+            logger.warning("Unable to read OpenCL devices from %s: %s", filename, error)
+            return None
+        return platforms
 
+    def _save_cache(self, platforms):
+        """
+        Write the list of platforms in the disk cache
+        """
+        filename = self.cache_file()
+        data = {"fingerprint": icd_fingerprint(),
+                "platforms": [{"name": pl.name, "vendor": pl.vendor, "version": pl.version,
+                               "extensions": pl.extensions, "id": pl.id,
+                               "devices": [{"name": dev.name, "type": dev.type, "version": dev.version,
+                                            "driver_version": dev.driver_version, "extensions": dev.extensions,
+                                            "memory": dev.memory, "available": dev.available, "cores": dev.cores,
+                                            "frequency": dev.frequency, "flop_core": dev.flop_core, "id": dev.id}
+                                           for dev in pl.devices]}
+                              for pl in platforms]}
+        tmpname = "%s.%s" % (filename, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(tmpname, "w") as outfile:
+                json.dump(data, outfile, indent=1)
+            if os.name == "nt" and os.path.exists(filename):
+                os.unlink(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as error:
+            logger.warning("Unable to store OpenCL devices in %s: %s", filename, error)
 
     def __repr__(self):
         out = ["OpenCL devices:"]
@@ -219,6 +365,28 @@ class OpenCL(object):
         if best_found:
             return  best_found[0], best_found[1]
 
+    def get_context(self, platformid, deviceid):
+        """
+        Return the DeviceContext shared by all plans working on a device,
+        creating it on first request.
+
+        @param platformid: integer
+        @param deviceid: integer
+        @return: DeviceContext instance
+        """
+        key = (int(platformid), int(deviceid))
+        with self._sem:
+            if key not in self.contexts:
+                self.contexts[key] = DeviceContext(*key)
+            return self.contexts[key]
+
+    def release_contexts(self):
+        """
+        Forget all shared contexts: they are freed once no plan uses them anymore
+        """
+        with self._sem:
+            self.contexts.clear()
+
     def create_context(self, devicetype="ALL", useFp64=False, platformid=None, deviceid=None):
         """
         Choose a device and initiate a context.
@@ -245,7 +413,7 @@ class OpenCL(object):
                 platformid = ids[0]
                 deviceid = ids[1]
         if (platformid is not None) and  (deviceid is not None):
-            ctx = pyopencl.Context(devices=[pyopencl.get_platforms()[platformid].get_devices()[deviceid]])
+            ctx = self.get_context(platformid, deviceid).ctx
         else:
             logger.warn("Last chance to get an OpenCL device ... probably not the one requested")
             ctx = pyopencl.create_some_context(interactive=False)
@@ -256,3 +424,242 @@ if pyopencl:
 else:
     ocl = None
 
+
+class DeviceContext(object):
+    """
+    OpenCL context on a single device, shared by all plans (SiftPlan,
+    MatchPlan, ...) running on it, together with the programs compiled for
+    it and the command queues which can be shared as well.
+
+    Buffers allocated by one plan can be used directly by any other plan
+    obtained from the same DeviceContext.
+
+    devctx = ocl.get_context(0, 0)
+    queue = devctx.get_queue(profile=False)
+    """
+    def __init__(self, platformid, deviceid):
+        """
+        @param platformid: integer
+        @param deviceid: integer
+        """
+        self.platformid = platformid
+        self.deviceid = deviceid
+        self.device = pyopencl.get_platforms()[platformid].get_devices()[deviceid]
+        self.ctx = pyopencl.Context(devices=[self.device])
+        self.programs = {}  # key: (kernel, options), value: pyopencl.Program
+        self.queues = {}  # key: profile, value: pyopencl.CommandQueue
+        self.gaussians = {}  # key: (sigmas, cutoff), value: GaussianBank
+        self._sem = threading.Semaphore()
+
+    def __repr__(self):
+        return "DeviceContext (%s,%s) %s: %s programs, %s queues" % \
+            (self.platformid, self.deviceid, self.device.name, len(self.programs), len(self.queues))
+
+    def create_queue(self, profile=False):
+        """
+        Create a new (private) command queue on the context
+
+        @param profile: enable profiling of the queue
+        """
+        if profile:
+            return pyopencl.CommandQueue(self.ctx, properties=pyopencl.command_queue_properties.PROFILING_ENABLE)
+        else:
+            return pyopencl.CommandQueue(self.ctx)
+
+    def get_queue(self, profile=False):
+        """
+        Return the command queue shared by all plans on this context
+
+        @param profile: enable profiling of the queue
+        """
+        profile = bool(profile)
+        with self._sem:
+            if profile not in self.queues:
+                self.queues[profile] = self.create_queue(profile)
+            return self.queues[profile]
+
+    def get_program(self, kernel, options=""):
+        """
+        Return the program built from the file kernel.cl with the given
+        options, compiling it (or fetching it from the disk cache) only once
+        per context.
+
+        @param kernel: name of the kernel file, without extension
+        @param options: build options like "-D WORKGROUP_SIZE=128"
+        @return: pyopencl.Program
+        """
+        key = (kernel, options)
+        with self._sem:
+            program = self.programs.get(key)
+            if program is None:
+                kernel_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), kernel + ".cl")
+                kernel_src = open(kernel_file).read()
+                try:
+                    program = program_cache.build(self.ctx, kernel_src, options)
+                except pyopencl.RuntimeError as error:
+                    # remember the failure: no need to try again for the next plan
+                    program = error
+                self.programs[key] = program
+        if isinstance(program, Exception):
+            raise program
+        return program
+
+    def get_gaussians(self, sigmas, cutoff=4):
+        """
+        Return the bank of gaussian filters shared by all plans on this
+        context, computing it only once.
+
+        @param sigmas: list of widths of the gaussians
+        @param cutoff: the filters extend to cutoff*sigma on each side
+        @return: GaussianBank
+        """
+        key = (tuple(float(i) for i in sigmas), cutoff)
+        bank = self.gaussians.get(key)
+        if bank is None:
+            bank = GaussianBank(self, key[0], cutoff)
+            with self._sem:
+                bank = self.gaussians.setdefault(key, bank)
+        return bank
+
+
+class GaussianBank(object):
+    """
+    Normalized gaussian filters packed in a single buffer on the device.
+
+    Each filter starts on an address aligned for sub-buffers and is exposed
+    as a sub-buffer, directly usable as __constant float* by the
+    convolution kernels:
+
+    bank = devctx.get_gaussians([1.6, 2.0])
+    buf, size = bank[1.6]
+    """
+    def __init__(self, devctx, sigmas, cutoff=4):
+        """
+        @param devctx: DeviceContext
+        @param sigmas: list of widths of the gaussians
+        @param cutoff: the filters extend to cutoff*sigma on each side
+        """
+        self.sigmas = tuple(sigmas)
+        self.cutoff = cutoff
+        align = max(4, devctx.device.mem_base_addr_align // 8)  # in bytes
+        self.offsets = {}  # key: sigma, value: offset in bytes
+        self.sizes = {}  # key: sigma, value: number of coefficients
+        self.nbytes = 0
+        for sigma in self.sigmas:
+            if sigma in self.sizes:
+                continue
+            self.offsets[sigma] = self.nbytes
+            self.sizes[sigma] = kernel_size(sigma, True, cutoff)
+            self.nbytes += (4 * self.sizes[sigma] + align - 1) // align * align
+        self.buffer = pyopencl.Buffer(devctx.ctx, pyopencl.mem_flags.READ_WRITE, self.nbytes)
+        self.filters = {}  # key: sigma, value: sub-buffer
+        for sigma in self.sizes:
+            self.filters[sigma] = self.buffer.get_sub_region(self.offsets[sigma], 4 * self.sizes[sigma])
+        self._fill(devctx)
+
+    def __repr__(self):
+        return "GaussianBank with %s filters (cutoff %s) in %s bytes" % (len(self.filters), self.cutoff, self.nbytes)
+
+    def __getitem__(self, sigma):
+        """
+        @param sigma: width of the gaussian
+        @return: sub-buffer, number of coefficients
+        """
+        return self.filters[sigma], self.sizes[sigma]
+
+    def _fill(self, devctx):
+        """
+        Calculate all filters: on the device when the filter fits in a
+        workgroup, else on the host.
+
+        Same calculation done on CPU
+        x = numpy.arange(size) - (size - 1.0) / 2.0
+        gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+        gaussian /= gaussian.sum(dtype=numpy.float32)
+        """
+        queue = devctx.create_queue()
+        max_wg = min(1024, devctx.device.max_work_group_size)
+        kernel = None
+        for sigma, size in self.sizes.items():
+            wg_size = 2 ** int(numpy.ceil(numpy.log2(size)))
+            if (kernel is None) and (wg_size <= max_wg):
+                try:
+                    kernel = pyopencl.Kernel(devctx.get_program("gaussian", "-D WORKGROUP_SIZE=%s" % max_wg), "gaussian")
+                except pyopencl.RuntimeError as error:
+                    logger.warning("Unable to compile the gaussian kernel, using the host: %s", error)
+                    max_wg = 0
+                else:
+                    max_wg = min(max_wg, kernel.get_work_group_info(pyopencl.kernel_work_group_info.WORK_GROUP_SIZE, devctx.device))
+            if wg_size <= max_wg:
+                kernel(queue, (wg_size,), (wg_size,), self.filters[sigma], numpy.float32(sigma), numpy.int32(size))
+            else:
+                x = numpy.arange(size) - (size - 1.0) / 2.0
+                gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+                gaussian /= gaussian.sum(dtype=numpy.float32)
+                pyopencl.enqueue_copy(queue, self.filters[sigma], gaussian)
+        queue.finish()
+
+
+class LazyPrograms(dict):
+    """
+    Dictionary of OpenCL programs, each one is compiled on first access:
+
+    programs = LazyPrograms(ocl.get_context(0, 0), {"memset": 128})
+    programs["memset"].memset_int(queue, ...)
+
+    Only the programs actually used are built, which saves both time and
+    memory on the device. Programs are shared with all other plans using
+    the same DeviceContext.
+    """
+    def __init__(self, devctx, kernels, max_workgroup_size=None, defines=None):
+        """
+        @param devctx: DeviceContext
+        @param kernels: dict with the name of the kernel files and their maximum workgroup size
+        @param max_workgroup_size: upper limit of the workgroup size
+        @param defines: list of macros defined for all programs, like ["HALF_DOGS"]
+        """
+        dict.__init__(self)
+        self.devctx = devctx
+        self.kernels = kernels
+        self.max_workgroup_size = max_workgroup_size
+        self.defines = list(defines or [])
+
+    def __missing__(self, kernel):
+        if kernel not in self.kernels:
+            raise KeyError(kernel)
+        wg_size = self.max_workgroup_size
+        if "__len__" not in dir(self.kernels[kernel]):
+            wg_size = min(wg_size or self.kernels[kernel], self.kernels[kernel])
+        try:
+            program = self.devctx.get_program(kernel, " ".join(['-D WORKGROUP_SIZE=%s' % wg_size] + ["-D %s" % i for i in self.defines]))
+        except pyopencl.MemoryError as error:
+            raise MemoryError(error)
+        except pyopencl.RuntimeError as error:
+            logger.warning("Failed compiling kernel '%s' with workgroup size %s: %s", kernel, wg_size, error)
+            raise error
+        logger.debug("Compiled %s: %s", kernel, program_cache)
+        self[kernel] = program
+        return program
+
+    def specialized(self, kernel, defines):
+        """
+        Program compiled with additional constants defined at build time.
+        Each set of defines is compiled once per context (and cached on disk).
+
+        @param kernel: name of the kernel file
+        @param defines: dict like {"IMAGE_W": 1024, "PEAK_THRESH": 3.4}
+        @return: pyopencl.Program
+        """
+        wg_size = self.max_workgroup_size
+        if "__len__" not in dir(self.kernels[kernel]):
+            wg_size = min(wg_size or self.kernels[kernel], self.kernels[kernel])
+        options = ['-D WORKGROUP_SIZE=%s' % wg_size] + ["-D %s" % i for i in self.defines]
+        for key in sorted(defines):
+            value = defines[key]
+            if isinstance(value, (float, numpy.floating)):
+                value = "%.9ef" % value
+            options.append("-D %s=%s" % (key, value))
+        try:
+            return self.devctx.get_program(kernel, " ".join(options))
+        except pyopencl.MemoryError as error:
+            raise MemoryError(error)
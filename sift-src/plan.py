@@ -43,13 +43,14 @@ OTHER DEALINGS IN THE SOFTWARE.
 import time, math, os, logging, threading
 # import sys
 import gc
+import collections
 import numpy
 import pyopencl, pyopencl.array
 from .param import par
-from .opencl import ocl
-from .utils import calc_size, kernel_size  # , sizeof
+from .opencl import ocl, LazyPrograms
+from .utils import calc_size, kernel_size, recursive_gaussian  # , sizeof
 logger = logging.getLogger("sift.plan")
-# from pyopencl import mem_flags as MF
+from pyopencl import mem_flags as MF
 
 class SiftPlan(object):
     """
@@ -60,28 +61,98 @@ class SiftPlan(object):
 
     kp is a nx132 array. the second dimension is composed of x,y, scale and angle as well as 128 floats describing the keypoint
 
+    All plans on the same device share a single OpenCL context and the
+    compiled programs (see opencl.DeviceContext); with shared_queue=True
+    they also share the command queue.
+
+    With specialize=True, the convolution, image and descriptor kernels are
+    compiled for each octave (and each gaussian) with the image size, the
+    filter size and the SIFT parameters defined as constants.
+
+    With binning=2 (or (4, 4), or (2, 4) for an anisotropic binning), large
+    frames are binned on the device and the detection runs on the smaller
+    image, which reduces both the memory footprint and the execution time.
+    first_octave and last_octave restrict the detection to some octaves:
+    the first ones are skipped by binning the image by 2**first_octave on the
+    device, the keypoints being always returned in pixels of the full image.
+
+    With keep_scale_space=True, every octave has its own gaussian levels and
+    DoGs, which are left on the device after keypoints() and can be used by
+    other OpenCL code, see scale_space().
+
+    Masked regions (set_mask, or the mask argument of keypoints) are skipped
+    by the extremum search, so they cost neither computation nor keypoints.
+
+    The gaussian blurs use tiled kernels (local memory) on GPU and a
+    transposed vertical pass on CPU, see blur_engine. The "recursive" engine
+    (IIR filter) costs the same for all sigma, at the price of a slightly
+    different gaussian. With blur_mode="direct", all levels of an octave are
+    blurred directly from the base of the octave, concurrently on several
+    queues, instead of one after the other.
+
+    With half_dogs=True the DoGs, the largest buffer of the scale-space, are
+    stored as half floats: this halves their memory and the bandwidth of the
+    extremum search, the calculations being done in float. With
+    half_levels=True, the gaussian levels, the temporary buffers of the blurs
+    and the gradient (tmp and ori) are stored as half floats as well, which
+    halves the bandwidth of the blurs, of the orientation and of the
+    descriptors (not with images, only the raw image stays in float).
+
+    With fused_extrema=True (default), the extrema of all the scales of an
+    octave are searched in one launch, each DoG being read once through local
+    memory. Not used in low memory mode, where the DoGs are not all kept.
+
+    The keypoint buffers start with one keypoint every PIX_PER_KP pixels. An
+    overflow is detected exactly at the end of each image: the buffers are
+    enlarged and only the octaves from the first one which overflowed are
+    processed again. The capacity then follows the counts of the last
+    KP_HISTORY images, see keypoint_counts() for those of the last one.
+
+    With max_keypoints=N, the keypoints are calculated in two passes: the
+    extremum search and the refinement of all octaves, then the orientation
+    and the descriptors of the N strongest keypoints only (largest |DoG|),
+    selected on the device with a histogram of their responses. The scale
+    space is then kept on the device (keep_scale_space=True) for the second
+    pass, unless it does not fit in the memory of the device: it is then
+    calculated again. The orientation assignment adds a keypoint for each
+    secondary orientation: at most N are returned, all the selected locations
+    with their main orientation first.
+
     """
     kernels = {"convolution":1024,  # key: name value max local workgroup size
                "preprocess": 1024,
                "algebra": 1024,
                "image":1024,
-               "gaussian":1024,
                "reductions":1024,
                "orientation_cpu":1,
                "orientation_gpu":128,
                "keypoints_gpu1":(8, 4, 4),
                "keypoints_gpu2":(8, 8, 8),
                "keypoints_cpu":1,
-               "memset":128, }
+               "memset":128,
+               "texture":1024,
+               "recursive":1024, }
 #               "keypoints":128}
     converter = {numpy.dtype(numpy.uint8):"u8_to_float",
                  numpy.dtype(numpy.uint16):"u16_to_float",
+                 numpy.dtype(numpy.int16):"s16_to_float",
+                 numpy.dtype(numpy.uint32):"u32_to_float",
                  numpy.dtype(numpy.int32):"s32_to_float",
                  numpy.dtype(numpy.int64):"s64_to_float",
-#                    numpy.float64:"double_to_float",
+                 numpy.dtype(numpy.float64):"f64_to_float",  # f64w_to_float on devices without fp64
                       }
+    converter_rgb = {numpy.dtype(numpy.uint8):"rgb_to_float",
+                     numpy.dtype(numpy.uint16):"rgb16_to_float",
+                     }
+    blur_engines = ("global", "tiled", "transpose", "recursive")
+    blur_modes = ("cascade", "direct")
+    TILE_ROWS = 8  # lines calculated by each work-item of vertical_convolution_tiled
+    KP_GROUPS = 256  # work-groups of the kernels looping over the keypoints
     sigmaRatio = 2.0 ** (1.0 / par.Scales)
     PIX_PER_KP = 10  # pre_allocate buffers for keypoints
+    KP_HISTORY = 16  # number of recent images used to learn the keypoint capacity
+    KP_MARGIN = 1.25  # headroom of the keypoint capacity over the largest recent count
+    RESPONSE_BINS = 1024  # bins of the histogram of the responses used by max_keypoints
     dtype_kp = numpy.dtype([('x', numpy.float32),
                                 ('y', numpy.float32),
                                 ('scale', numpy.float32),
@@ -89,9 +160,36 @@ class SiftPlan(object):
                                 ('desc', (numpy.uint8, 128))
                                 ])
 
-    def __init__(self, shape=None, dtype=None, devicetype="CPU", template=None, profile=False, device=None, PIX_PER_KP=None, max_workgroup_size=128):
+    def __init__(self, shape=None, dtype=None, devicetype="CPU", template=None, profile=False, device=None, PIX_PER_KP=None, max_workgroup_size=128, shared_queue=False, specialize=False, binning=None, blur_engine=None, use_images=False, blur_mode="cascade", half_dogs=False, low_memory=None, first_octave=0, last_octave=None, keep_scale_space=False, fused_extrema=True, max_keypoints=None, half_levels=False):
         """
         Contructor of the class
+
+        @param binning: bin the image on the device before the detection, int
+        or 2-tuple (vertical, horizontal). Keypoints are returned in the pixel
+        coordinates of the original image.
+        @param blur_engine: convolution kernels used for the gaussian blurs:
+        "global", "tiled" (local memory), "transpose" or "recursive" (IIR
+        filter), None to select the best one for the device
+        @param use_images: store the gaussian levels as image2d_t (falls back
+        to buffers when the device has no image support)
+        @param blur_mode: "cascade" blurs each level from the previous one,
+        "direct" blurs all levels from the base of the octave in parallel
+        @param half_dogs: store the DoGs as half floats (computations stay in float)
+        @param low_memory: keep only 3 gaussian levels and 3 DoGs on the device,
+        None to enable it only when the plan would not fit on the device otherwise
+        @param first_octave: first octave processed, the image being binned by
+        2**first_octave on the device (combined with binning)
+        @param last_octave: last octave processed (counted from the full
+        resolution image), None for all of them (up to par.OctaveMax)
+        @param keep_scale_space: keep the gaussian levels and the DoGs of all
+        octaves on the device (see scale_space), instead of reusing the buffers
+        @param fused_extrema: search the extrema of all scales of an octave in one launch
+        @param max_keypoints: only the max_keypoints strongest keypoints (largest
+        |DoG|) get an orientation and a descriptor, None for all of them.
+        At most max_keypoints are returned, secondary orientations included.
+        Implies keep_scale_space when it fits on the device
+        @param half_levels: store the gaussian levels, tmp and ori as half
+        floats (computations stay in float)
         """
         self.buffers = {}
         self.programs = {}
@@ -101,49 +199,131 @@ class SiftPlan(object):
         else:
             self.shape = shape
             self.dtype = numpy.dtype(dtype)
-        if len(self.shape) == 3:
+        if len(self.shape) == 3 and self.shape[2] in (3, 4):
             self.RGB = True
+            self.channels = self.shape[2]
             self.shape = self.shape[:2]
         elif len(self.shape) == 2:
             self.RGB = False
+            self.channels = 1
         else:
             raise RuntimeError("Unable to process image of shape %s" % (tuple(self.shape,)))
+        self.input_shape = tuple(self.shape)
+        if isinstance(binning, int):
+            binning = (binning, binning)
+        self.first_octave = int(first_octave)
+        self.last_octave = last_octave
+        if (self.first_octave < 0) or ((last_octave is not None) and (last_octave < self.first_octave)):
+            raise RuntimeError("Invalid octave range %s - %s" % (first_octave, last_octave))
+        if self.first_octave:
+            binning = tuple(int(i) * 2 ** self.first_octave for i in (binning or (1, 1)))
+        if binning and tuple(binning) != (1, 1):
+            self.binning = tuple(int(i) for i in binning)
+            self.shape = tuple(int(math.ceil(float(i) / j)) for i, j in zip(self.input_shape, self.binning))
+        else:
+            self.binning = None
         if PIX_PER_KP :
             self.PIX_PER_KP = int(PIX_PER_KP)
         self.profile = bool(profile)
         self.max_workgroup_size = max_workgroup_size
+        self.specialize = bool(specialize)
+        self.use_images = bool(use_images)
+        self.half_dogs = bool(half_dogs)
+        self.half_levels = bool(half_levels)
+        self.keep_scale_space = bool(keep_scale_space)
+        self.fused_extrema = bool(fused_extrema)
+        self.max_keypoints = int(max_keypoints) if max_keypoints else None
+        keep_auto = bool(self.max_keypoints and not self.keep_scale_space and not low_memory)
+        if keep_auto:
+            # the second pass of max_keypoints reads the scale space of the first one
+            self.keep_scale_space = True
+        if self.keep_scale_space and low_memory:
+            raise RuntimeError("The scale space can not be kept in low memory mode")
+        if self.keep_scale_space and self.use_images:
+            logger.warning("The scale space is kept in buffers, not in images")
+            self.use_images = False
+        if self.half_levels and self.use_images:
+            logger.warning("Half precision levels are stored in buffers, not in images")
+            self.use_images = False
+        if blur_mode not in self.blur_modes:
+            raise RuntimeError("Unknown blur mode %s, not in %s" % (blur_mode, self.blur_modes))
+        self.blur_mode = blur_mode
+        self.blur_queues = []  # one per gaussian level in direct mode
+        self.low_memory = False
+        self.nb_levels = par.Scales + 3  # gaussian levels kept on the device
+        self.dog_slices = par.Scales + 2  # DoGs kept on the device
+        self.level_base = 0  # index of the buffer holding the level 0 of the current octave
         self.events = []
+        self.traffic = []  # (octave, event, bytes) of the scale-space kernels, when profiling
         self._sem = threading.Semaphore()
         self.scales = []  # in XY order
         self.procsize = []  # same as  procsize but with dimension in (X,Y) not (slow, fast)
         self.wgsize = []
+        self.vertical_wgsize = []  # workgroups of vertical_convolution_tiled
+        self.vertical_procsize = []
+        self.transposed_wgsize = []  # workgroups of vertical_convolution_transposed
+        self.transposed_procsize = []
         self.kpsize = None
         self.memory = None
         self.octave_max = None
         self.red_size = None
         self._calc_scales()
+        if low_memory:
+            self._set_low_memory()
         self._calc_memory()
         self.LOW_END = 0
         if device is None:
             self.device = ocl.select_device(type=devicetype, memory=self.memory, best=True)
+            if (self.device is None) and keep_auto:
+                self._drop_scale_space(use_images)
+                self.device = ocl.select_device(type=devicetype, memory=self.memory, best=True)
+            if (self.device is None) and (low_memory is None) and not self.keep_scale_space:
+                self._set_low_memory()
+                self._calc_memory()
+                self.device = ocl.select_device(type=devicetype, memory=self.memory, best=True)
         else:
             self.device = device
-        self.ctx = pyopencl.Context(devices=[pyopencl.get_platforms()[self.device[0]].get_devices()[self.device[1]]])
+            if keep_auto and (self.memory > ocl.platforms[device[0]].devices[device[1]].memory):
+                self._drop_scale_space(use_images)
+            if (low_memory is None) and (not self.keep_scale_space) and \
+                    (self.memory > ocl.platforms[device[0]].devices[device[1]].memory):
+                self._set_low_memory()
+                self._calc_memory()
+        self.devctx = ocl.get_context(*self.device)
+        self.ctx = self.devctx.ctx
         print self.ctx.devices[0]
-        if profile:
-            self.queue = pyopencl.CommandQueue(self.ctx, properties=pyopencl.command_queue_properties.PROFILING_ENABLE)
+        if shared_queue:
+            self.queue = self.devctx.get_queue(profile)
         else:
-            self.queue = pyopencl.CommandQueue(self.ctx)
-        self._calc_workgroups()
-        self._compile_kernels()
-        self._allocate_buffers()
-        self.debug = []
-        self.cnt = numpy.empty(1, dtype=numpy.int32)
+            self.queue = self.devctx.create_queue(profile)
         self.devicetype = ocl.platforms[self.device[0]].devices[self.device[1]].type
         if (self.devicetype == "CPU"):
             self.USE_CPU = True
         else:
             self.USE_CPU = False
+        self.converter_kernel = self._select_converter()
+        self.mask = None  # host copy of the mask defined by set_mask
+        self.masked = None  # which mask is on the device: None, "static" or "call"
+        self.upload_queue = None  # created by keypoints_stream
+        self.upload_events = []
+        self.stream_stats = None
+        self._calc_workgroups()
+        self.use_images = self._check_images(self.use_images)
+        if self.use_images:
+            self.blur_engine = "image"
+            if self.blur_mode == "direct":
+                logger.warning("The direct blur mode is not available with images, using the cascade")
+                self.blur_mode = "cascade"
+        else:
+            self.blur_engine = self._select_blur_engine(blur_engine)
+        if self.blur_mode == "direct":
+            self.blur_queues = [self.devctx.create_queue(profile) for i in range(par.Scales + 2)]
+        self._compile_kernels()
+        self._allocate_buffers()
+        self.debug = []
+        self.cnt = numpy.empty(1, dtype=numpy.int32)
+        self.kp_stats = numpy.zeros((self.octave_max, par.Scales + 1, 2), dtype=numpy.int32)
+        self.kp_history = collections.deque(maxlen=self.KP_HISTORY)
 
 
 
@@ -154,10 +334,164 @@ class SiftPlan(object):
         """
         self._free_kernels()
         self._free_buffers()
+        self.upload_queue = None
+        self.blur_queues = []
         self.queue = None
         self.ctx = None
         gc.collect()
 
+    def _set_low_memory(self):
+        """
+        Switch to the low-memory mode: the extrema of a scale are searched as
+        soon as the next DoG is ready, so that only a rolling window of 3
+        gaussian levels and 3 DoGs is kept on the device. Not compatible
+        with images and the direct blur mode.
+        """
+        logger.info("Low memory mode: rolling window of 3 gaussian levels and 3 DoGs")
+        self.low_memory = True
+        self.nb_levels = 3
+        self.dog_slices = 3
+        if self.use_images:
+            logger.warning("Images are not available in low memory mode, using buffers")
+            self.use_images = False
+        if self.blur_mode == "direct":
+            logger.warning("The direct blur mode is not available in low memory mode, using the cascade")
+            self.blur_mode = "cascade"
+        self.fused_extrema = False
+
+    def _drop_scale_space(self, use_images):
+        """
+        The scale space kept for max_keypoints does not fit on the device:
+        reuse the buffers of the octaves, the second pass calculating the
+        scale space again.
+
+        @param use_images: use_images as requested by the user
+        """
+        logger.warning("The scale space does not fit on the device: it is calculated again for the descriptors of the strongest keypoints")
+        self.keep_scale_space = False
+        self.use_images = bool(use_images) and not self.half_levels
+        self._calc_memory()
+
+    def _select_converter(self):
+        """
+        Select the kernel converting the raw image into float on the device,
+        so that the input is uploaded as-is.
+
+        @return: name of the conversion kernel (without the "_max_min" suffix), None for float32 images
+        """
+        if self.RGB:
+            if self.dtype not in self.converter_rgb:
+                raise RuntimeError("Unable to process RGB images of type %s" % self.dtype)
+            return self.converter_rgb[self.dtype]
+        if self.dtype == numpy.float32:
+            return None
+        if self.dtype not in self.converter:
+            raise RuntimeError("Unable to process images of type %s" % self.dtype)
+        kernel = self.converter[self.dtype]
+        if (self.dtype == numpy.float64) and ("cl_khr_fp64" not in self.ctx.devices[0].extensions):
+            logger.info("No double precision on this device: decoding float64 from 32 bits words")
+            kernel = "f64w_to_float"
+        return kernel
+
+    def _select_blur_engine(self, engine=None):
+        """
+        Select the kernels used for the gaussian blurs:
+        "tiled" (local memory) on GPU, "transpose" (contiguous accesses) on CPU
+
+        @param engine: name of the engine, None for automatic selection
+        @return: name of the engine
+        """
+        device = self.ctx.devices[0]
+        if engine is None:
+            if device.type & pyopencl.device_type.CPU:
+                engine = "transpose"
+            else:
+                engine = "tiled"
+        if engine not in self.blur_engines:
+            raise RuntimeError("Unknown blur engine %s, not in %s" % (engine, self.blur_engines))
+        if engine == "tiled":
+            filter_size = max(kernel_size(sigma, True) for sigma in self._sigmas())
+            horizontal = self.wgsize[0][1] * (self.wgsize[0][0] + filter_size - 1)
+            vertical = max(w[0] * (w[1] * self.TILE_ROWS + filter_size - 1) for w in self.vertical_wgsize)
+            if 4 * max(horizontal, vertical) > device.local_mem_size:
+                logger.warning("Not enough local memory for the tiled convolution, using the global one")
+                engine = "global"
+        logger.info("Gaussian blurs with the %s convolution engine", engine)
+        return engine
+
+    def _check_images(self, use_images):
+        """
+        Check that the device can store the gaussian levels as images
+
+        @param use_images: images requested
+        @return: True if images are used
+        """
+        if not use_images:
+            return False
+        device = self.ctx.devices[0]
+        fmt = pyopencl.ImageFormat(pyopencl.channel_order.R, pyopencl.channel_type.FLOAT)
+        if not device.image_support:
+            logger.warning("Device %s has no image support, using buffers", device.name)
+            return False
+        if fmt not in pyopencl.get_supported_image_formats(self.ctx, MF.READ_WRITE, pyopencl.mem_object_type.IMAGE2D):
+            logger.warning("Device %s does not support float images, using buffers", device.name)
+            return False
+        if (self.shape[1] > device.image2d_max_width) or (self.shape[0] > device.image2d_max_height):
+            logger.warning("Image %s is too large for device %s, using buffers", self.shape, device.name)
+            return False
+        return True
+
+    def _level(self, octave, scale):
+        """
+        @return: gaussian level of the octave: image or pyopencl array
+        """
+        if self.use_images:
+            return self.buffers[("image", octave, scale)]
+        if self.keep_scale_space:
+            return self.buffers[(octave, scale)]
+        return self._rolling_level((self.level_base + scale) % self.nb_levels)
+
+    def _rolling_level(self, index):
+        """
+        @param index: index of the buffer of the levels reused by all octaves
+        @return: pyopencl array, buffers[0] (which also receives the input
+        image) unless the levels are stored as half
+        """
+        if self.half_levels:
+            return self.buffers[("level", index)]
+        return self.buffers[index]
+
+    def _dogs(self, octave):
+        """
+        @return: pyopencl array with the DoGs of the octave
+        """
+        if self.keep_scale_space:
+            return self.buffers[("DoGs", octave)]
+        return self.buffers["DoGs"]
+
+    def _sigmas(self):
+        """
+        @return: the list of the widths of all gaussian blurs
+        """
+        sigmas = []
+        curSigma = 1.0 if par.DoubleImSize else 0.5
+        if par.InitSigma > curSigma:
+            sigmas.append(math.sqrt(par.InitSigma ** 2 - curSigma ** 2))
+        if self.blur_mode == "direct":
+            sigmas += self._direct_sigmas()
+            return sigmas
+        prevSigma = par.InitSigma
+        for i in range(par.Scales + 2):
+            sigmas.append(prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0))
+            prevSigma *= self.sigmaRatio
+        return sigmas
+
+    def _direct_sigmas(self):
+        """
+        @return: widths of the gaussians giving the levels 1..Scales+2 directly from the base of the octave
+        """
+        return [par.InitSigma * math.sqrt(self.sigmaRatio ** (2 * scale) - 1.0) for scale in range(1, par.Scales + 3)]
+
     def _calc_scales(self):
         """
         Nota scales are in XY order
@@ -169,6 +503,12 @@ class SiftPlan(object):
             shape = tuple(numpy.int32(i // 2) for i in shape)
             self.scales.append(shape)
         self.scales.pop()
+        nb_octaves = par.OctaveMax
+        if self.last_octave is not None:
+            nb_octaves = min(nb_octaves, self.last_octave - self.first_octave + 1)
+        self.scales = self.scales[:nb_octaves]
+        if not self.scales:
+            raise RuntimeError("Invalid octave range %s - %s: the image is too small" % (self.first_octave, self.last_octave))
         self.octave_max = len(self.scales)
 
     def _calc_memory(self):
@@ -180,61 +520,130 @@ class SiftPlan(object):
         size_of_float = numpy.dtype(numpy.float32).itemsize
         size_of_input = numpy.dtype(self.dtype).itemsize
         # raw images:
-        size = self.shape[0] * self.shape[1]
+        size = self.input_shape[0] * self.input_shape[1]
         self.memory += size * size_of_input  # initial_image (no raw_float)
         if self.RGB:
-            self.memory += 2 * size * (size_of_input)  # one of three was already counted
-        nr_blur = par.Scales + 3  # 3 blurs and 2 tmp
-        nr_dogs = par.Scales + 2
-        self.memory += size * (nr_blur + nr_dogs) * size_of_float
+            self.memory += (self.channels - 1) * size * (size_of_input)  # one channel was already counted
+        if self.binning and self.dtype != numpy.float32:
+            self.memory += size * size_of_float  # unbinned float image
+        size = self.shape[0] * self.shape[1]
+        nr_blur = self.nb_levels
+        nr_dogs = self.dog_slices
+        size_of_dog = 2 if self.half_dogs else size_of_float
+        size_of_level = 2 if self.half_levels else size_of_float
+        if self.use_images:
+            # input, tmp and ori buffers, one image per gaussian level and a tmp image for each octave
+            self.memory += size * 3 * size_of_float + size * nr_dogs * size_of_dog
+            self.memory += sum(int(w) * int(h) for w, h in self.scales) * (par.Scales + 4) * size_of_float
+        elif self.keep_scale_space:
+            # input, tmp and ori buffers, then the gaussian levels and the DoGs of every octave
+            self.memory += size * size_of_float + size * 2 * size_of_level
+            self.memory += sum(int(w) * int(h) for w, h in self.scales) * (nr_blur * size_of_level + nr_dogs * size_of_dog)
+            if self.blur_mode == "direct":
+                self.memory += size * (par.Scales + 2) * size_of_level  # one tmp per level
+        else:
+            # tmp and ori buffers, the levels (the first one receiving the input) and the DoGs
+            self.memory += size * (nr_blur + 2) * size_of_level + size * nr_dogs * size_of_dog
+            if self.half_levels:
+                self.memory += size * size_of_float  # input buffer
+            if self.blur_mode == "direct":
+                self.memory += size * (par.Scales + 2) * size_of_level  # one tmp per level
 
         self.kpsize = int(self.shape[0] * self.shape[1] // self.PIX_PER_KP)  # Is the number of kp independant of the octave ? int64 causes problems with pyopencl
-        self.memory += self.kpsize * size_of_float * 4 * 2  # those are array of float4 to register keypoints, we need two of them
-        self.memory += self.kpsize * 128  # stores the descriptors: 128 unsigned chars
+        self.memory += self.kpsize * self._kp_bytes()  # Kp_1, Kp_2, descriptors and the candidates of the fused search
         self.memory += 4  # keypoint index Counter
+        self.memory += 12  # start and end of the keypoints of the current scale, start of the output
+        self.memory += 4 * self.KP_GROUPS  # offsets of the work-groups of the compaction
+        self.memory += 4 * 2 * self.octave_max * (par.Scales + 1)  # keypoint counts of each scale
+        if self.fused_extrema:
+            self.memory += 4  # counter of the candidates
+        if self.max_keypoints:
+            self.memory += 4 * self.RESPONSE_BINS + 8  # histogram of the responses and threshold
         wg_float = min(self.max_workgroup_size, numpy.sqrt(self.shape[0] * self.shape[1]))
         self.red_size = 2 ** (int(math.ceil(math.log(wg_float, 2))))
         self.memory += 4 * 2 * self.red_size  # temporary storage for reduction
+        # The gaussian filters are not charged here: they live in the
+        # GaussianBank of the context, allocated once for all the plans on it.
 
-        ########################################################################
-        # Calculate space for gaussian kernels
-        ########################################################################
-        curSigma = 1.0 if par.DoubleImSize else 0.5
-        if par.InitSigma > curSigma:
-            sigma = math.sqrt(par.InitSigma ** 2 - curSigma ** 2)
-            size = kernel_size(sigma, True)
-            logger.debug("pre-Allocating %s float for init blur" % size)
-            self.memory += size * size_of_float
-        prevSigma = par.InitSigma
-        for i in range(par.Scales + 2):
-            increase = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
-            size = kernel_size(increase, True)
-            logger.debug("pre-Allocating %s float for blur sigma: %s" % (size, increase))
-            self.memory += size * size_of_float
-            prevSigma *= self.sigmaRatio
+    def _kp_bytes(self):
+        """
+        @return: device memory used by each keypoint of the capacity
+        """
+        size = 4 * 4 * 2 + 128  # Kp_1 and Kp_2 (float4) and the descriptor
+        if self.fused_extrema:
+            size += 4 * 4  # candidate of the fused extremum search
+        return size
+
+    def _kp_buffers(self):
+        """
+        @return: list of (name, width, dtype) of the buffers sized by the keypoint capacity
+        """
+        buffers = [("Kp_1", 4, numpy.float32),
+                   ("Kp_2", 4, numpy.float32),
+                   ("descriptors", 128, numpy.uint8)]
+        if self.fused_extrema:
+            buffers.append(("Kp_octave", 4, numpy.float32))
+        return buffers
 
     def _allocate_buffers(self):
         """
         All buffers are allocated here
         """
         shape = self.shape
-        if self.dtype != numpy.float32:
+        if self.binning or self.dtype != numpy.float32:
             if self.RGB:
-                rgbshape = self.shape[0], self.shape[1], 3
+                rgbshape = self.input_shape[0], self.input_shape[1], self.channels
                 self.buffers["raw"] = pyopencl.array.empty(self.queue, rgbshape, dtype=self.dtype)
             else:
-                self.buffers["raw"] = pyopencl.array.empty(self.queue, shape, dtype=self.dtype)
+                self.buffers["raw"] = pyopencl.array.empty(self.queue, self.input_shape, dtype=self.dtype)
+        if self.binning and self.dtype != numpy.float32:
+            self.buffers["unbinned"] = pyopencl.array.empty(self.queue, self.input_shape, dtype=numpy.float32)
         self.buffers[ "Kp_1" ] = pyopencl.array.empty(self.queue, (self.kpsize, 4), dtype=numpy.float32)
         self.buffers[ "Kp_2" ] = pyopencl.array.empty(self.queue, (self.kpsize, 4), dtype=numpy.float32)
         self.buffers[ "descr" ] = pyopencl.array.empty(self.queue, (self.kpsize, 128), dtype=numpy.uint8)
         self.buffers["cnt" ] = pyopencl.array.empty(self.queue, 1, dtype=numpy.int32)
+        self.buffers["counters"] = pyopencl.array.empty(self.queue, 3, dtype=numpy.int32)  # start, end, output
+        self.buffers["compact_offsets"] = pyopencl.array.empty(self.queue, self.KP_GROUPS, dtype=numpy.int32)
+        # for each octave: fused candidates and count before the octave, then for each scale:
+        # count after the extremum search and after the orientation assignment
+        self.buffers["kp_stats"] = pyopencl.array.empty(self.queue, (self.octave_max, par.Scales + 1, 2), dtype=numpy.int32)
+        if self.max_keypoints:
+            self.buffers["histogram"] = pyopencl.array.empty(self.queue, self.RESPONSE_BINS, dtype=numpy.int32)
+            self.buffers["threshold"] = pyopencl.array.empty(self.queue, 2, dtype=numpy.int32)  # bin, keypoints left in it
+        if self.fused_extrema:
+            self.buffers["Kp_octave"] = pyopencl.array.empty(self.queue, (self.kpsize, 4), dtype=numpy.float32)
+            self.buffers["cnt_octave"] = pyopencl.array.empty(self.queue, 1, dtype=numpy.int32)
         self.buffers["descriptors"] = pyopencl.array.empty(self.queue, (self.kpsize, 128), dtype=numpy.uint8)
 
-        self.buffers["tmp"] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
-        self.buffers["ori"] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
-        for scale in range(par.Scales + 3):
-            self.buffers[scale ] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
-        self.buffers["DoGs" ] = pyopencl.array.empty(self.queue, (par.Scales + 2, shape[0], shape[1]), dtype=numpy.float32)
+        level_dtype = numpy.float16 if self.half_levels else numpy.float32
+        self.buffers["tmp"] = pyopencl.array.empty(self.queue, shape, dtype=level_dtype)
+        self.buffers["ori"] = pyopencl.array.empty(self.queue, shape, dtype=level_dtype)
+        if self.use_images:
+            self.buffers[0] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
+            fmt = pyopencl.ImageFormat(pyopencl.channel_order.R, pyopencl.channel_type.FLOAT)
+            for octave, size in enumerate(self.scales):
+                size = tuple(int(i) for i in size)
+                for scale in list(range(par.Scales + 3)) + ["tmp"]:
+                    self.buffers[("image", octave, scale)] = pyopencl.Image(self.ctx, MF.READ_WRITE, fmt, shape=size)
+        elif self.keep_scale_space:
+            self.buffers[0] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
+            for octave, size in enumerate(self.scales):
+                size = int(size[1]), int(size[0])
+                for scale in range(self.nb_levels):
+                    self.buffers[(octave, scale)] = pyopencl.array.empty(self.queue, size, dtype=level_dtype)
+                self.buffers[("DoGs", octave)] = pyopencl.array.empty(self.queue, (self.dog_slices,) + size,
+                                                                      dtype=numpy.float16 if self.half_dogs else numpy.float32)
+        else:
+            if self.half_levels:
+                self.buffers[0] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
+            for scale in range(self.nb_levels):
+                self.buffers[("level", scale) if self.half_levels else scale] = pyopencl.array.empty(self.queue, shape, dtype=level_dtype)
+        if (not self.use_images) and self.blur_mode == "direct":
+            for scale in range(1, par.Scales + 3):
+                self.buffers[("tmp", scale)] = pyopencl.array.empty(self.queue, shape, dtype=level_dtype)
+        if not self.keep_scale_space:
+            self.buffers["DoGs" ] = pyopencl.array.empty(self.queue, (self.dog_slices, shape[0], shape[1]),
+                                                         dtype=numpy.float16 if self.half_dogs else numpy.float32)
         wg_float = min(512.0, numpy.sqrt(self.shape[0] * self.shape[1]))
 #        wg = 2 ** (int(math.ceil(math.log(wg_float, 2))))
         self.buffers["max_min"] = pyopencl.array.empty(self.queue, (self.red_size, 2), dtype=numpy.float32)  # temporary buffer for max/min reduction
@@ -242,51 +651,9 @@ class SiftPlan(object):
         self.buffers["max"] = pyopencl.array.empty(self.queue, (1), dtype=numpy.float32)
         self.buffers["255"] = pyopencl.array.to_device(self.queue, numpy.array([255.0], dtype=numpy.float32))
         ########################################################################
-        # Allocate space for gaussian kernels
+        # Gaussian kernels: shared by all plans on the context
         ########################################################################
-        curSigma = 1.0 if par.DoubleImSize else 0.5
-        if par.InitSigma > curSigma:
-            sigma = math.sqrt(par.InitSigma ** 2 - curSigma ** 2)
-            self._init_gaussian(sigma)
-        prevSigma = par.InitSigma
-
-        for i in range(par.Scales + 2):
-            increase = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
-            self._init_gaussian(increase)
-            prevSigma *= self.sigmaRatio
-
-
-    def _init_gaussian(self, sigma):
-        """
-        Create a buffer of the right size according to the width of the gaussian ...
-
-
-        @param  sigma: width of the gaussian, the length of the function will be 8*sigma + 1
-
-        Same calculation done on CPU
-        x = numpy.arange(size) - (size - 1.0) / 2.0
-        gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
-        gaussian /= gaussian.sum(dtype=numpy.float32)
-        """
-        name = "gaussian_%s" % sigma
-        size = kernel_size(sigma, True)
-        wg_size = 2 ** int(math.ceil(math.log(size) / math.log(2)))
-
-        logger.debug("Allocating %s float for blur sigma: %s" % (size, sigma))
-        if wg_size > self.max_workgroup_size:  # compute on CPU
-            x = numpy.arange(size) - (size - 1.0) / 2.0
-            gaus = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
-            gaus /= gaus.sum(dtype=numpy.float32)
-            gaussian_gpu = pyopencl.array.to_device(self.queue, g)
-        else:
-            gaussian_gpu = pyopencl.array.empty(self.queue, size, dtype=numpy.float32)
-            evt = self.programs["gaussian"].gaussian(self.queue, (wg_size,), (wg_size,),
-                                                gaussian_gpu.data,  # __global     float     *data,
-                                                numpy.float32(sigma),  # const        float     sigma,
-                                                numpy.int32(size))  # const        int     SIZE
-            if self.profile: self.events.append(("gaussian %s" % sigma, evt))
-        self.buffers[name] = gaussian_gpu
-
+        self.gaussians = self.devctx.get_gaussians(self._sigmas())
 
     def _free_buffers(self):
         """
@@ -302,30 +669,102 @@ class SiftPlan(object):
 
     def _compile_kernels(self):
         """
-        Call the OpenCL compiler
+        Prepare the OpenCL programs: each of them is compiled the first time
+        one of its kernels is launched, so that only the variants needed by
+        this device (CPU/GPU, LOW_END) are built.
+        """
+        defines = []
+        if self.half_dogs:
+            defines.append("HALF_DOGS")
+        if self.half_levels:
+            defines.append("HALF_LEVELS")
+        if self.low_memory:
+            defines.append("DOG_SLICES=%s" % self.dog_slices)
+        self.programs = LazyPrograms(self.devctx, self.kernels, self.max_workgroup_size, defines)
+
+    def _program(self, kernel, octave, **defines):
+        """
+        Program to be used for the given octave: when specialization is
+        enabled, it is compiled with the size of the octave and the
+        additional defines as constants.
+
+        @param kernel: name of the kernel file
+        @param octave: number of the octave
+        @param defines: extra constants, like FILTER_SIZE=9
+        @return: pyopencl.Program
         """
-        for kernel in self.kernels:
-            kernel_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), kernel + ".cl")
-            kernel_src = open(kernel_file).read()
-            if "__len__" not in dir(self.kernels[kernel]):
-                wg_size = min(self.max_workgroup_size, self.kernels[kernel])
+        if not self.specialize:
+            return self.programs[kernel]
+        defines["IMAGE_W"], defines["IMAGE_H"] = self.scales[octave]
+        if kernel in ("image", "texture"):
+            defines.update({"BORDER_DIST": par.BorderDist,
+                            "PEAK_THRESH": float(par.PeakThresh),
+                            "EDGE_THRESH0": float(par.EdgeThresh1),
+                            "EDGE_THRESH": float(par.EdgeThresh),
+                            "INIT_SIGMA": float(par.InitSigma),
+                            "OCTSIZE": 2 ** octave})
+        elif kernel.startswith("keypoints"):
+            defines["OCTSIZE"] = 2 ** octave
+        return self.programs.specialized(kernel, defines)
+
+    def _descriptor_program(self):
+        """
+        Select the program used to compute descriptors, according to the
+        device type and to the LOW_END level. If the program does not build
+        on this device, fall back on the lower-end alternative.
+
+        @return: name of the program
+        """
+        while True:
+            if self.USE_CPU or self.LOW_END >= 2:
+                return "keypoints_cpu"
+            elif self.LOW_END == 1:
+                file_to_use = "keypoints_gpu1"
             else:
-                wg_size = self.max_workgroup_size
+                file_to_use = "keypoints_gpu2"
             try:
-                program = pyopencl.Program(self.ctx, kernel_src).build('-D WORKGROUP_SIZE=%s' % wg_size)
-            except pyopencl.MemoryError as error:
-                raise MemoryError(error)
+                self.programs[file_to_use]
             except pyopencl.RuntimeError as error:
-                if kernel == "keypoints_gpu2":
-                    logger.warning("Failed compiling kernel '%s' with workgroup size %s: %s: use low_end alternative", kernel, wg_size, error)
-                    self.LOW_END += 1
-                elif kernel == "keypoints_gpu1":
-                    logger.warning("Failed compiling kernel '%s' with workgroup size %s: %s: use CPU alternative", kernel, wg_size, error)
-                    self.LOW_END += 1
-                else:
-                    logger.error("Failed compiling kernel '%s' with workgroup size %s: %s", kernel, wg_size, error)
+                logger.warning("Failed compiling kernel '%s': %s: use low_end alternative", file_to_use, error)
+                self.LOW_END += 1
+            else:
+                return file_to_use
+
+    def _compute_descriptors(self, octave, octsize):
+        """
+        Launch the descriptor kernel on keypoints [counters[0]:cnt], switching
+        to lower_end mode when the kernel fails to run.
+
+        @param octave: number of the octave
+        @param octsize: size of the octave (int32)
+        @return: OpenCL event
+        """
+        while True:
+            file_to_use = self._descriptor_program()
+            if file_to_use == "keypoints_cpu":
+                logger.info("Computing descriptors with CPU optimized kernels")
+                wgsize = self.kernels[file_to_use],
+                procsize = self.KP_GROUPS * wgsize[0],
+            else:
+                logger.info("Computing descriptors with %s-GPU optimized kernels", "older" if self.LOW_END else "newer")
+                wgsize = self.kernels[file_to_use]
+                procsize = self.KP_GROUPS * wgsize[0], wgsize[1], wgsize[2]
+            try:
+                return self._program(file_to_use, octave).descriptor_counters(self.queue, procsize, wgsize,
+                                          self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
+                                          self.buffers["descriptors"].data,  # ___global unsigned char *descriptors
+                                          self.buffers["tmp"].data,  # __global float* grad,
+                                          self.buffers["ori"].data,  # __global float* ori,
+                                          octsize,  # int octsize,
+                                          self.buffers["counters"].data,  # int* counters,
+                                          self.buffers["cnt"].data,  # int* keypoints_end,
+                                          numpy.int32(self.kpsize),  # int nb_keypoints,
+                                          *self.scales[octave])  # int grad_width, int grad_height)
+            except pyopencl.RuntimeError as error:
+                if file_to_use == "keypoints_cpu":
                     raise error
-            self.programs[kernel] = program
+                self.LOW_END += 1
+                logger.error("Descriptor failed with %s. Switching to lower_end mode" % error)
 
     def _free_kernels(self):
         """
@@ -354,104 +793,553 @@ class SiftPlan(object):
             wg = (min(2 ** int(math.ceil(math.log(shape[-1], 2))), self.max_workgroup_size), 1)
             self.wgsize.append(wg)
             self.procsize.append(calc_size(shape[-1::-1], wg))
+            # tiled vertical convolution: each work-item processes TILE_ROWS lines
+            vwg = (min(wg[0], 32), max(1, min(8, self.max_workgroup_size // min(wg[0], 32))))
+            self.vertical_wgsize.append(vwg)
+            self.vertical_procsize.append((calc_size((shape[-1],), vwg[:1])[0],
+                                           vwg[1] * int(math.ceil(float(shape[0]) / (vwg[1] * self.TILE_ROWS)))))
+            twg = (min(2 ** int(math.ceil(math.log(shape[0], 2))), self.max_workgroup_size), 1)
+            self.transposed_wgsize.append(twg)
+            self.transposed_procsize.append(calc_size(shape, twg))
             shape = tuple(i // 2 for i in shape)
 
 
 
 
-    def keypoints(self, image):
+    def keypoints(self, image, mask=None):
         """
         Calculates the keypoints of the image
         @param image: ndimage of 2D (or 3D if RGB)
+        @param mask: validity mask used for this image only (non zero for valid pixels), defaults to the one of set_mask
         """
         self.reset_timer()
         with self._sem:
-            total_size = 0
-            keypoints = []
-            descriptors = []
-            assert image.shape[:2] == self.shape
-            assert image.dtype == self.dtype
+            self._check_image(image)
             t0 = time.time()
+            self._select_mask(mask)
+            if (self.converter_kernel is None) and (self.binning is None):
+                # the image is overwritten by the scale space
+                source = self.buffers[0]
+                reload = image
+            else:
+                source = self.buffers["raw"]
+                image = numpy.ascontiguousarray(image)
+                reload = None
+            evt = pyopencl.enqueue_copy(self.queue, source.data, image)
+            if self.profile:self.events.append(("copy H->D", evt))
+            output = self._process(source, reload)
+            logger.info("Execution time: %.3fms" % (1000 * (time.time() - t0)))
+        return output
+
+    def keypoints_stream(self, frames):
+        """
+        Calculates the keypoints of a sequence of images, uploading the next
+        frame while the current one is processed.
+
+        Frames are copied into page-locked (ALLOC_HOST_PTR) staging buffers and
+        sent on a separate queue to one of two device input slots, so that the
+        transfer of frame N+1 overlaps with the scale-space and descriptor
+        stages of frame N. Once the iterator is exhausted, self.stream_stats
+        contains the number of frames, the upload time, the time the device
+        had to wait for an upload and the fraction of the upload time hidden
+        behind the computation ("overlap").
+
+        for kp in siftp.keypoints_stream(frames):
+            ...
+
+        @param frames: iterable of ndimages with the shape and dtype of the plan
+        @return: generator of keypoints (same as keypoints)
+        """
+        self._allocate_stream()
+        stats = {"frames": 0, "upload": 0.0, "stall": 0.0, "overlap": 0.0}
+        self.stream_stats = stats
+        t0 = time.time()
+        pending = None  # (slot, upload event) of the frame waiting to be processed
+        slot = 0
+        for image in frames:
+            upload = self._upload(image, slot)
+            if pending is not None:
+                yield self._process_slot(pending, stats)
+            pending = (slot, upload)
+            slot = 1 - slot
+        if pending is not None:
+            yield self._process_slot(pending, stats)
+        if stats["upload"] > 0:
+            stats["overlap"] = max(0.0, 1.0 - stats["stall"] / stats["upload"])
+        stats["total"] = time.time() - t0
+        logger.info("Streamed %i frames in %.3fms, upload %.3fms, %.1f%% overlapped with compute" %
+                    (stats["frames"], 1000 * stats["total"], 1000 * stats["upload"], 100 * stats["overlap"]))
+
+    def set_mask(self, mask):
+        """
+        Defines the mask used for all following images: no keypoint is
+        searched for in the masked regions (beamstop, detector gaps, ...)
+
+        @param mask: 2D numpy array of the shape of the images with non zero
+        where valid pixels are.
+        """
+        with self._sem:
+            self.mask = numpy.ascontiguousarray(mask != 0, numpy.uint8)
+            self._upload_mask(self.mask)
+            self.masked = "static"
+
+    def unset_mask(self):
+        """
+        Unset the mask: all pixels are valid
+        """
+        with self._sem:
+            self.mask = None
+            self.masked = None
+
+    def scale_space(self):
+        """
+        Scale space of the last image processed, when the plan was created with
+        keep_scale_space=True. The arrays stay on the device and are
+        overwritten by the next call to keypoints.
+
+        @return: list with one dict per octave: "octave", "shape" (slow, fast),
+        "pixel" (size of an octave pixel in pixels of the input image, (y, x)),
+        "sigmas" (blur of each gaussian level, in octave pixels), "gaussians"
+        (list of 2D pyopencl arrays, float16 with half_levels) and "dogs" (3D
+        pyopencl array, dogs[s] is gaussians[s] - gaussians[s + 1])
+        """
+        if not self.keep_scale_space:
+            raise RuntimeError("The scale space is only kept with keep_scale_space=True")
+        binning = self.binning or (1, 1)
+        result = []
+        for octave, size in enumerate(self.scales):
+            result.append({"octave": octave,
+                           "shape": (int(size[1]), int(size[0])),
+                           "pixel": tuple(2 ** octave * i for i in binning),
+                           "sigmas": [par.InitSigma * self.sigmaRatio ** scale for scale in range(self.nb_levels)],
+                           "gaussians": [self._level(octave, scale) for scale in range(self.nb_levels)],
+                           "dogs": self._dogs(octave)})
+        return result
+
+    def keypoint_counts(self):
+        """
+        Telemetry of the last image: number of keypoints of each octave and
+        scale, counted before any truncation by the capacity (self.kpsize).
+        With max_keypoints, those of the first pass, before the selection.
 
-            if self.dtype == numpy.float32:
-                evt = pyopencl.enqueue_copy(self.queue, self.buffers[0].data, image)
-                if self.profile:self.events.append(("copy H->D", evt))
-            elif (image.ndim == 3) and (self.dtype == numpy.uint8) and (self.RGB):
-                evt = pyopencl.enqueue_copy(self.queue, self.buffers["raw"].data, image)
-                if self.profile:self.events.append(("copy H->D", evt))
-                print self.procsize[0], self.wgsize[0]
-                evt = self.programs["preprocess"].rgb_to_float(self.queue, self.procsize[0], self.wgsize[0],
-                                                             self.buffers["raw"].data, self.buffers[0].data, *self.scales[0])
-                if self.profile:self.events.append(("RGB -> float", evt))
-
-            elif self.dtype in self.converter:
-                program = self.programs["preprocess"].__getattr__(self.converter[self.dtype])
-                evt = pyopencl.enqueue_copy(self.queue, self.buffers["raw"].data, image)
-                if self.profile:self.events.append(("copy H->D", evt))
-                evt = program(self.queue, self.procsize[0], self.wgsize[0],
-                        self.buffers["raw"].data, self.buffers[0].data, *self.scales[0])
-                if self.profile:self.events.append(("convert -> float", evt))
+        @return: array of shape (octaves, par.Scales) of int
+        """
+        ends = self.kp_stats[:, 1:, 1]
+        starts = numpy.concatenate((self.kp_stats[:, :1, 1], ends[:, :-1]), axis=1)
+        return ends - starts
+
+    def _select_mask(self, mask):
+        """
+        Upload the mask for the next image if needed
+
+        @param mask: mask for this image only, or None to use the one of set_mask
+        """
+        if mask is not None:
+            self._upload_mask(numpy.ascontiguousarray(mask != 0, numpy.uint8))
+            self.masked = "call"
+        elif self.masked == "call":
+            # restore the mask defined by set_mask
+            if self.mask is None:
+                self.masked = None
             else:
-                raise RuntimeError("invalid input format error")
+                self._upload_mask(self.mask)
+                self.masked = "static"
+
+    def _upload_mask(self, mask):
+        """
+        Send the mask to the device and shrink it for every octave: a pixel
+        of an octave is valid only if all pixels it covers are valid.
+
+        @param mask: 2D array of uint8 of the shape of the images
+        """
+        assert mask.shape == self.input_shape
+        if ("mask", "raw") not in self.buffers:
+            self.buffers[("mask", "raw")] = pyopencl.array.empty(self.queue, self.input_shape, dtype=numpy.uint8)
+            for octave, (width, height) in enumerate(self.scales):
+                self.buffers[("mask", octave)] = pyopencl.array.empty(self.queue, (height, width), dtype=numpy.uint8)
+        evt = pyopencl.enqueue_copy(self.queue, self.buffers[("mask", "raw")].data, mask)
+        if self.profile:self.events.append(("copy mask H->D", evt))
+        source = self.buffers[("mask", "raw")]
+        scale = self.binning or (1, 1)
+        height, width = self.input_shape
+        for octave in range(self.octave_max):
+            evt = self.programs["preprocess"].mask_shrink(self.queue, self.procsize[octave], self.wgsize[octave],
+                                                          source.data,
+                                                          self.buffers[("mask", octave)].data,
+                                                          numpy.int32(scale[1]), numpy.int32(scale[0]),
+                                                          numpy.int32(width), numpy.int32(height),
+                                                          *self.scales[octave])
+            if self.profile:self.events.append(("shrink mask %s" % octave, evt))
+            source = self.buffers[("mask", octave)]
+            width, height = self.scales[octave]
+            scale = (2, 2)
+
+    def _check_image(self, image):
+        """
+        Ensure the image matches the plan
+        """
+        assert image.shape[:2] == self.input_shape
+        assert image.dtype == self.dtype
+
+    def _allocate_stream(self):
+        """
+        Allocate the upload queue, the two device input slots and their
+        page-locked staging buffers used by keypoints_stream
+        """
+        if self.upload_queue is not None:
+            return
+        if self.RGB:
+            shape = self.input_shape[0], self.input_shape[1], self.channels
+        else:
+            shape = self.input_shape
+        nbytes = int(numpy.prod(shape)) * self.dtype.itemsize
+        for slot in range(2):
+            self.buffers[("input", slot)] = pyopencl.array.empty(self.queue, shape, dtype=self.dtype)
+            try:
+                pinned = pyopencl.Buffer(self.ctx, MF.READ_ONLY | MF.ALLOC_HOST_PTR, nbytes)
+                staging, evt = pyopencl.enqueue_map_buffer(self.queue, pinned, pyopencl.map_flags.WRITE,
+                                                           0, shape, self.dtype)
+            except pyopencl.Error as error:
+                logger.warning("Unable to allocate page-locked memory, using pageable memory: %s" % error)
+                pinned, staging = None, numpy.empty(shape, dtype=self.dtype)
+            self.buffers[("pinned", slot)] = pinned
+            self.buffers[("staging", slot)] = staging
+        # always profiled, to measure the upload time
+        self.upload_queue = self.devctx.create_queue(True)
+        self.upload_events = [None, None]
+
+    def _upload(self, image, slot):
+        """
+        Send an image to an input slot without waiting for the transfer
+
+        @param image: ndimage to upload
+        @param slot: index of the input slot (0 or 1)
+        @return: the event of the transfer
+        """
+        self._check_image(image)
+        if self.upload_events[slot] is not None:
+            self.upload_events[slot].wait()  # the staging buffer is still being read
+        staging = self.buffers[("staging", slot)]
+        staging[...] = image
+        evt = pyopencl.enqueue_copy(self.upload_queue, self.buffers[("input", slot)].data, staging, is_blocking=False)
+        self.upload_events[slot] = evt
+        return evt
+
+    def _process_slot(self, pending, stats):
+        """
+        Calculates the keypoints of the image uploaded in an input slot
+
+        @param pending: 2-tuple with the input slot and the event of the upload
+        @param stats: dict with the statistics of the stream, updated
+        """
+        slot, upload = pending
+        self.reset_timer()
+        with self._sem:
+            t0 = time.time()
+            upload.wait()
+            stats["stall"] += time.time() - t0
+            stats["upload"] += 1e-9 * (upload.profile.end - upload.profile.start)
+            stats["frames"] += 1
+            if self.profile:self.events.append(("copy H->D", upload))
+            self._select_mask(None)
+            output = self._process(self.buffers[("input", slot)])
+            logger.info("Execution time: %.3fms" % (1000 * (time.time() - t0)))
+        return output
+
+    def _process(self, source, image=None):
+        """
+        Calculates the keypoints of the image already on the device
+
+        When the keypoint buffers overflow, they are enlarged and the
+        keypoints are calculated again from the first octave which
+        overflowed, those of the previous octaves are kept.
+
+        @param source: pyopencl array with the raw image (or self.buffers[0] for float32 images)
+        @param image: host copy of the image, uploaded again to source if it
+        was overwritten by the scale space and the keypoints have to be calculated again
+        @return: keypoints as a record array
+        """
+        # with max_keypoints, the first pass only searches and refines the keypoints
+        stage = "extrema" if self.max_keypoints else "all"
+        octave = start = 0
+        again = False
+        while True:
+            # the keypoints of all octaves are appended to Kp_1 without any host synchronization
+            self._reset_keypoints(start)
+            self._run_octaves(source, image, stage, octave, again)
+            if self.max_keypoints:
+                self._select_strongest()
+                self._run_octaves(source, image, "describe", 0, True)
+            overflow = self._read_counts()
+            if overflow is None:
+                break
+            # the strongest keypoints are selected among those of all octaves
+            octave, start = (0, 0) if self.max_keypoints else overflow
+            needed = max(int(self.cnt[0]), int(self.kp_stats.max()))
+            if not self._grow_keypoints(max(2 * self.kpsize, int(self.KP_MARGIN * needed)), start):
+                logger.warning("Keypoint buffers overflowed in octave %s: %s keypoints lost" % (octave, needed - self.kpsize))
+                break
+            logger.warning("Keypoint buffers overflowed in octave %s, calculated again with %s keypoints" % (octave, self.kpsize))
+            again = True
+
+        ########################################################################
+        # Merge keypoints in central memory
+        ########################################################################
+        # the keypoints of the second pass follow those of the first one
+        first = int(self.kp_stats[-1, -1, 1]) if self.max_keypoints else 0
+        total_size = int(min(self.cnt[0], self.kpsize)) - first
+        logger.info("found %i kp" % total_size)
+        keypoints = numpy.empty((total_size, 4), dtype=numpy.float32)
+        descriptors = numpy.empty((total_size, 128), dtype=numpy.uint8)
+        if total_size:
+            evt = pyopencl.enqueue_copy(self.queue, keypoints, self.buffers["Kp_1"].data, device_offset=16 * first)
+            evt2 = pyopencl.enqueue_copy(self.queue, descriptors, self.buffers["descriptors"].data, device_offset=128 * first)
+            if self.profile:
+                self.events += [("copy D->H", evt),
+                                ("copy D->H", evt2)]
+        self._learn_capacity()
+        if self.max_keypoints and (total_size > self.max_keypoints):
+            keypoints, descriptors = self._cap_keypoints(keypoints, descriptors)
+            total_size = self.max_keypoints
+        output = numpy.recarray(shape=(total_size,), dtype=self.dtype_kp)
+        output.x = keypoints[:, 0]
+        output.y = keypoints[:, 1]
+        output.scale = keypoints[:, 2]
+        output.angle = keypoints[:, 3]
+        output.desc = descriptors
+        if self.binning:
+            self._unbin(output)
+#        self.count_kp(output)
+        return output
+
+    def _run_octaves(self, source, image, stage, first=0, again=False):
+        """
+        Calculate the keypoints of the octaves from first on
+
+        @param source: pyopencl array with the raw image (or self.buffers[0] for float32 images)
+        @param image: host copy of the image, or None if source is not overwritten
+        @param stage: stage of the keypoints, see _extrema
+        @param first: first octave whose keypoints are calculated
+        @param again: the scale space was already calculated: it is reused
+        when it is kept, else calculated again from the image (all octaves)
+        """
+        if again and self.keep_scale_space:
+            for octave in range(first, self.octave_max):
+                self._one_octave(octave, stage, blur=False)
+            return
+        if again and (image is not None):
+            evt = pyopencl.enqueue_copy(self.queue, source.data, image)
+            if self.profile:self.events.append(("copy H->D", evt))
+        self._first_level(source)
+        for octave in range(self.octave_max):
+            self._one_octave(octave, stage if octave >= first else None)
+
+    def _first_level(self, source):
+        """
+        Convert, bin and normalize the image into the level 0 of the first
+        octave, with the initial blur
 
+        @param source: pyopencl array with the raw image (or self.buffers[0] for float32 images)
+        """
+        self.level_base = 0
+        if self.converter_kernel is not None:
+            # conversion to float and first stage of the max/min reduction in a single pass
+            target = self.buffers["unbinned"] if self.binning else self.buffers[0]
+            program = self.programs["preprocess"].__getattr__(self.converter_kernel + "_max_min")
+            args = [source.data,
+                    target.data,
+                    self.buffers["max_min"].data,
+                    numpy.int32(self.input_shape[0] * self.input_shape[1])]
+            if self.RGB:
+                args.append(numpy.int32(self.channels))
+            k1 = program(self.queue, (self.red_size * self.red_size,), (self.red_size,), *args)
+            if self.profile:self.events.append(("convert -> float + max_min_stage1", k1))
+            source = target
+        if self.binning:
+            evt = self.programs["preprocess"].bin(self.queue, self.procsize[0], self.wgsize[0],
+                                                  source.data,
+                                                  self.buffers[0].data,
+                                                  numpy.int32(self.binning[1]), numpy.int32(self.binning[0]),
+                                                  numpy.int32(self.input_shape[1]), numpy.int32(self.input_shape[0]),
+                                                  *self.scales[0])
+            if self.profile:self.events.append(("binning %sx%s" % self.binning, evt))
+            source = self.buffers[0]
+        if (self.converter_kernel is None) or self.binning:
+            # the extrema are those of the binned image
             k1 = self.programs["reductions"].max_min_global_stage1(self.queue, (self.red_size * self.red_size,), (self.red_size,),
-                                                                   self.buffers[0].data,
+                                                                   source.data,
                                                                    self.buffers["max_min"].data,
                                                                    numpy.uint32(self.shape[0] * self.shape[1]))
-            k2 = self.programs["reductions"].max_min_global_stage2(self.queue, (self.red_size,), (self.red_size,),
-                                                                   self.buffers["max_min"].data,
-                                                                   self.buffers["max"].data,
-                                                                   self.buffers["min"].data)
-            if self.profile:
-                self.events.append(("max_min_stage1", k1))
-                self.events.append(("max_min_stage2", k2))
-            evt = self.programs["preprocess"].normalizes(self.queue, self.procsize[0], self.wgsize[0],
+            if self.profile:self.events.append(("max_min_stage1", k1))
+
+        k2 = self.programs["reductions"].max_min_global_stage2(self.queue, (self.red_size,), (self.red_size,),
+                                                               self.buffers["max_min"].data,
+                                                               self.buffers["max"].data,
+                                                               self.buffers["min"].data)
+        if self.profile:
+            self.events.append(("max_min_stage2", k2))
+
+#        octSize = 1.0
+        curSigma = 1.0 if par.DoubleImSize else 0.5
+        octave = 0
+        # float32 images are read directly from the source
+        first = source
+        if par.InitSigma > curSigma:
+            logger.debug("Bluring image to achieve std: %f", par.InitSigma)
+            sigma = math.sqrt(par.InitSigma ** 2 - curSigma ** 2)
+            # The normalization is done on the fly by the first convolution
+            if self.use_images:
+                evt = pyopencl.enqueue_copy(self.queue, self._level(0, 0), first.data, offset=0,
+                                            origin=(0, 0), region=tuple(int(i) for i in self.scales[0]))
+                if self.profile:self.events.append(("copy buffer->image", evt))
+                first = self._level(0, 0)
+            self._gaussian_convolution(first, self._level(0, 0), sigma, 0, normalize=True)
+        else:
+            if first is not self.buffers[0]:
+                evt = pyopencl.enqueue_copy(self.queue, self.buffers[0].data, first.data)
+                if self.profile:self.events.append(("copy D->D", evt))
+            if self.half_levels:
+                evt = self.programs["preprocess"].normalizes_level(self.queue, self.procsize[0], self.wgsize[0],
+                                                   self.buffers[0].data,
+                                                   self._level(0, 0).data,
+                                                   self.buffers["min"].data,
+                                                   self.buffers["max"].data,
+                                                   self.buffers["255"].data,
+                                                   *self.scales[0])
+            else:
+                evt = self.programs["preprocess"].normalizes(self.queue, self.procsize[0], self.wgsize[0],
                                                    self.buffers[0].data,
                                                    self.buffers["min"].data,
                                                    self.buffers["max"].data,
                                                    self.buffers["255"].data,
                                                    *self.scales[0])
             if self.profile:self.events.append(("normalize", evt))
+            if self.keep_scale_space and not self.half_levels:
+                evt = pyopencl.enqueue_copy(self.queue, self._level(0, 0).data, self.buffers[0].data)
+                if self.profile:self.events.append(("copy D->D", evt))
+            if self.use_images:
+                evt = pyopencl.enqueue_copy(self.queue, self._level(0, 0), self.buffers[0].data, offset=0,
+                                            origin=(0, 0), region=tuple(int(i) for i in self.scales[0]))
+                if self.profile:self.events.append(("copy buffer->image", evt))
+#        else:
+#            pyopencl.enqueue_copy(self.queue, dest=self.buffers[(0, "G_1")].data, src=self.buffers["input"].data)
+
+    def _read_counts(self):
+        """
+        Read the keypoint counter and the counts of each scale (kp_stats) in
+        a single host synchronization
 
+        The counters are incremented even when the buffers are full, so an
+        overflow is detected exactly.
 
-#            octSize = 1.0
-            curSigma = 1.0 if par.DoubleImSize else 0.5
-            octave = 0
-            if par.InitSigma > curSigma:
-                logger.debug("Bluring image to achieve std: %f", par.InitSigma)
-                sigma = math.sqrt(par.InitSigma ** 2 - curSigma ** 2)
-                self._gaussian_convolution(self.buffers[0], self.buffers[0], sigma, 0)
-    #        else:
-    #            pyopencl.enqueue_copy(self.queue, dest=self.buffers[(0, "G_1")].data, src=self.buffers["input"].data)
+        @return: None or (octave, start): the first octave which overflowed
+        the keypoint buffers and the number of keypoints found before it
+        """
+        evt1 = pyopencl.enqueue_copy(self.queue, self.kp_stats, self.buffers["kp_stats"].data, is_blocking=False)
+        evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
+        if self.profile:
+            self.events += [("copy kp_stats D->H", evt1), ("copy cnt D->H", evt)]
+        for octave in range(self.octave_max):
+            if self.kp_stats[octave].max() > self.kpsize:
+                return octave, int(self.kp_stats[octave, 0, 1])
+        if self.cnt[0] > self.kpsize:
+            # selected keypoints of max_keypoints, appended after the first pass
+            return 0, 0
+        return None
+
+    def _grow_keypoints(self, capacity, keep=0):
+        """
+        Enlarge the keypoint buffers, as far as the memory of the device allows
 
-            for octave in range(self.octave_max):
-                kp, descriptor = self._one_octave(octave)
-                logger.info("in octave %i found %i kp" % (octave, kp.shape[0]))
+        @param capacity: number of keypoints wanted
+        @param keep: number of keypoints (and descriptors) copied to the new buffers
+        @return: True if the capacity was increased
+        """
+        free = ocl.platforms[self.device[0]].devices[self.device[1]].memory - self.memory
+        capacity = min(capacity, self.kpsize + max(0, free) // self._kp_bytes())
+        if capacity <= self.kpsize:
+            return False
+        self._resize_keypoints(capacity, keep)
+        return True
+
+    def _resize_keypoints(self, capacity, keep=0):
+        """
+        Reallocate the keypoint buffers with a new capacity
 
-                if kp.shape[0] > 0:
-                    keypoints.append(kp)
-                    descriptors.append(descriptor)
-                    total_size += kp.shape[0]
+        @param capacity: number of keypoints
+        @param keep: number of keypoints (and descriptors) copied to the new buffers
+        """
+        logger.info("Keypoint capacity %s -> %s" % (self.kpsize, capacity))
+        for name, width, dtype in self._kp_buffers():
+            new = pyopencl.array.empty(self.queue, (capacity, width), dtype=dtype)
+            if keep and name in ("Kp_1", "descriptors"):
+                evt = pyopencl.enqueue_copy(self.queue, new.data, self.buffers[name].data,
+                                            byte_count=keep * width * numpy.dtype(dtype).itemsize)
+                if self.profile:
+                    self.events.append(("copy %s D->D" % name, evt))
+            self.buffers[name] = new
+        self.memory += (capacity - self.kpsize) * self._kp_bytes()
+        self.kpsize = int(capacity)
 
-            ########################################################################
-            # Merge keypoints in central memory
-            ########################################################################
-            output = numpy.recarray(shape=(total_size,), dtype=self.dtype_kp)
-            last = 0
-            for ds, desc in zip(keypoints, descriptors):
-                l = ds.shape[0]
-                if l > 0:
-                    output[last:last + l].x = ds[:, 0]
-                    output[last:last + l].y = ds[:, 1]
-                    output[last:last + l].scale = ds[:, 2]
-                    output[last:last + l].angle = ds[:, 3]
-                    output[last:last + l].desc = desc
-                    last += l
-            logger.info("Execution time: %.3fms" % (1000 * (time.time() - t0)))
-    #        self.count_kp(output)
-        return output
+    def _learn_capacity(self):
+        """
+        Adapt the keypoint capacity to the largest count of the KP_HISTORY
+        last images: the buffers grow before they are full, and shrink in low
+        memory mode when they are more than twice too large.
+        """
+        self.kp_history.append(max(int(self.cnt[0]), int(self.kp_stats.max())))
+        capacity = max(self.KP_GROUPS, int(self.KP_MARGIN * max(self.kp_history)))
+        if capacity > self.kpsize:
+            self._grow_keypoints(capacity)
+        elif self.low_memory and (2 * capacity < self.kpsize) and (len(self.kp_history) == self.KP_HISTORY):
+            self._resize_keypoints(capacity)
+
+    def _cap_keypoints(self, keypoints, descriptors):
+        """
+        Keep max_keypoints of the keypoints of the second pass of max_keypoints
+
+        The selection keeps max_keypoints locations, but the orientation
+        assignment appends a keypoint for each secondary orientation after
+        those of the scale. All the locations are kept with their main
+        orientation (their first keypoint), then the secondary orientations
+        in their order until max_keypoints.
+
+        @param keypoints: array of shape (n, 4) with x, y, scale and angle
+        @param descriptors: array of shape (n, 128)
+        @return: keypoints and descriptors, max_keypoints of them
+        """
+        location = numpy.ascontiguousarray(keypoints[:, :3]).view(numpy.dtype((numpy.void, 12))).ravel()
+        first = numpy.unique(location, return_index=True)[1]
+        keep = numpy.zeros(keypoints.shape[0], dtype=bool)
+        keep[first] = True
+        secondary = numpy.where(~keep)[0]
+        keep[secondary[:max(0, self.max_keypoints - first.size)]] = True
+        index = numpy.where(keep)[0][:self.max_keypoints]
+        logger.info("%s secondary orientations dropped" % (keypoints.shape[0] - index.size))
+        return keypoints[index], descriptors[index]
+
+    def _unbin(self, keypoints):
+        """
+        Map keypoints found on the binned image back to the pixel grid of the
+        original image (in place).
 
-    def _gaussian_convolution(self, input_data, output_data, sigma, octave=0):
+        The center of the binned pixel i is at i * b + (b - 1) / 2 in the
+        original image. With anisotropic binning, the scale is multiplied by
+        the geometric mean of the binning factors. The angle is the direction
+        of the gradient, which is (bx * gx, by * gy) in binned pixels for a
+        gradient (gx, gy) of the original image. The descriptor stays in the
+        frame of the binned image.
+
+        @param keypoints: record array with x, y, scale and angle
+        """
+        by, bx = self.binning
+        keypoints.x = keypoints.x * bx + 0.5 * (bx - 1)
+        keypoints.y = keypoints.y * by + 0.5 * (by - 1)
+        keypoints.scale = keypoints.scale * math.sqrt(bx * by)
+        if bx != by:
+            keypoints.angle = numpy.arctan2(bx * numpy.sin(keypoints.angle), by * numpy.cos(keypoints.angle))
+
+    def _gaussian_convolution(self, input_data, output_data, sigma, octave=0, normalize=False, queue=None, temp_data=None, wait_for=None, dog=None):
         """
         Calculate the gaussian convolution with precalculated kernels.
 
@@ -459,35 +1347,198 @@ class SiftPlan(object):
         @param output_data: pyopencl array with result
         @param sigma: width of the gaussian
         @param octave: related to the size on the input images
+        @param normalize: normalize input_data between 0 and 255 (using the "min" and "max" buffers)
+        @param queue: command queue, the one of the plan by default
+        @param temp_data: temporary buffer, self.buffers["tmp"] by default
+        @param wait_for: list of events to wait for before starting
+        @param dog: index of the DoG: the vertical pass also writes
+        input_data - output_data in this slice of the "DoGs" buffer (not with images)
+        @return: event of the last kernel
 
         * Uses a temporary buffer
-        * Needs gaussian kernel to be available on device
+        * The gaussian kernel is taken from the bank of the context
 
         """
-        temp_data = self.buffers["tmp"]
-        gaussian = self.buffers["gaussian_%s" % sigma]
-        k1 = self.programs["convolution"].horizontal_convolution(self.queue, self.procsize[octave], self.wgsize[octave],
-                                input_data.data, temp_data.data, gaussian.data, numpy.int32(gaussian.size), *self.scales[octave])
-        k2 = self.programs["convolution"].vertical_convolution(self.queue, self.procsize[octave], self.wgsize[octave],
-                                temp_data.data, output_data.data, gaussian.data, numpy.int32(gaussian.size), *self.scales[octave])
+        queue = queue or self.queue
+        if temp_data is None:
+            temp_data = self.buffers["tmp"]
+        if self.blur_engine == "recursive":
+            return self._recursive_convolution(input_data, output_data, sigma, octave, normalize, queue, temp_data, wait_for, dog)
+        gaussian, size = self.gaussians[sigma]
+        if self.blur_engine == "image":
+            program = self._program("texture", octave, FILTER_SIZE=size)
+        else:
+            program = self._program("convolution", octave, FILTER_SIZE=size)
+        width, height = self.scales[octave]
+        args = [gaussian, numpy.int32(size), width, height]
+        if normalize:
+            norm = [self.buffers["min"].data, self.buffers["max"].data, numpy.float32(255.0)]
+        else:
+            norm = []
+        if dog is not None:
+            fused = [input_data.data, self._dogs(octave).data, numpy.int32(dog)]
+        if self.blur_engine == "image":
+            # input_data and output_data are images
+            temp_data = self.buffers[("image", octave, "tmp")]
+            if normalize:
+                k1 = program.horizontal_convolution_normalize_image(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data, temp_data, *(args + norm), wait_for=wait_for)
+            else:
+                k1 = program.horizontal_convolution_image(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data, temp_data, *args, wait_for=wait_for)
+            k2 = program.vertical_convolution_image(queue, self.procsize[octave], self.wgsize[octave],
+                                temp_data, output_data, *args)
+        elif self.blur_engine == "tiled":
+            wg = self.wgsize[octave]
+            tile = pyopencl.LocalMemory(4 * wg[1] * (wg[0] + size - 1))
+            if normalize:
+                k1 = program.horizontal_convolution_normalize_tiled(queue, self.procsize[octave], wg,
+                                input_data.data, temp_data.data, *(args + norm + [tile]), wait_for=wait_for)
+            else:
+                k1 = program.horizontal_convolution_tiled(queue, self.procsize[octave], wg,
+                                input_data.data, temp_data.data, *(args + [tile]), wait_for=wait_for)
+            wg = self.vertical_wgsize[octave]
+            tile = pyopencl.LocalMemory(4 * wg[0] * (wg[1] * self.TILE_ROWS + size - 1))
+            if dog is None:
+                k2 = program.vertical_convolution_tiled(queue, self.vertical_procsize[octave], wg,
+                                temp_data.data, output_data.data, *(args + [numpy.int32(self.TILE_ROWS), tile]))
+            else:
+                k2 = program.vertical_convolution_tiled_dog(queue, self.vertical_procsize[octave], wg,
+                                temp_data.data, output_data.data, *(args + [numpy.int32(self.TILE_ROWS), tile] + fused))
+        elif self.blur_engine == "transpose":
+            # temp_data holds the transposed image
+            if normalize:
+                k1 = program.horizontal_convolution_normalize_transpose(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data.data, temp_data.data, *(args + norm), wait_for=wait_for)
+            else:
+                k1 = program.horizontal_convolution_transpose(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data.data, temp_data.data, *args, wait_for=wait_for)
+            if dog is None:
+                k2 = program.vertical_convolution_transposed(queue, self.transposed_procsize[octave], self.transposed_wgsize[octave],
+                                temp_data.data, output_data.data, *args)
+            else:
+                k2 = program.vertical_convolution_transposed_dog(queue, self.transposed_procsize[octave], self.transposed_wgsize[octave],
+                                temp_data.data, output_data.data, *(args + fused))
+        else:
+            if normalize:
+                k1 = program.horizontal_convolution_normalize(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data.data, temp_data.data, *(args + norm), wait_for=wait_for)
+            else:
+                k1 = program.horizontal_convolution(queue, self.procsize[octave], self.wgsize[octave],
+                                input_data.data, temp_data.data, *args, wait_for=wait_for)
+            if dog is None:
+                k2 = program.vertical_convolution(queue, self.procsize[octave], self.wgsize[octave],
+                                temp_data.data, output_data.data, *args)
+            else:
+                k2 = program.vertical_convolution_dog(queue, self.procsize[octave], self.wgsize[octave],
+                                temp_data.data, output_data.data, *(args + fused))
 
         if self.profile:
             self.events += [("Blur sigma %s octave %s" % (sigma, octave), k1), ("Blur sigma %s octave %s" % (sigma, octave), k2)]
+            # images read + written: 2 per pass (the raw image being float),
+            # one more level and a DoG when the DoG is fused
+            self._log_traffic(octave, k1, 1 if normalize else 2, floats=1 if normalize else 0)
+            self._log_traffic(octave, k2, 2 if dog is None else 3, dogs=0 if dog is None else 1)
+        return k2
+
+    def _recursive_convolution(self, input_data, output_data, sigma, octave, normalize, queue, temp_data, wait_for, dog):
+        """
+        Gaussian blur with the recursive filter: one work-item per line, then
+        one per column. Same parameters as _gaussian_convolution.
+        """
+        program = self._program("recursive", octave)
+        width, height = self.scales[octave]
+        args = list(recursive_gaussian(sigma)) + [width, height]
+        rows = calc_size((height,), self.transposed_wgsize[octave][:1])
+        columns = calc_size((width,), self.wgsize[octave][:1])
+        if normalize:
+            norm = [self.buffers["min"].data, self.buffers["max"].data, numpy.float32(255.0)]
+            k1 = program.horizontal_recursive_normalize(queue, rows, self.transposed_wgsize[octave][:1],
+                                input_data.data, temp_data.data, *(args + norm), wait_for=wait_for)
+        else:
+            k1 = program.horizontal_recursive(queue, rows, self.transposed_wgsize[octave][:1],
+                                input_data.data, temp_data.data, *args, wait_for=wait_for)
+        if dog is None:
+            k2 = program.vertical_recursive(queue, columns, self.wgsize[octave][:1],
+                                temp_data.data, output_data.data, *args)
+        else:
+            k2 = program.vertical_recursive_dog(queue, columns, self.wgsize[octave][:1],
+                                temp_data.data, output_data.data,
+                                *(args + [input_data.data, self._dogs(octave).data, numpy.int32(dog)]))
+        if self.profile:
+            self.events += [("Recursive blur sigma %s octave %s" % (sigma, octave), k1), ("Recursive blur sigma %s octave %s" % (sigma, octave), k2)]
+            # each pass reads and writes its output twice (causal and anti-causal)
+            self._log_traffic(octave, k1, 3 if normalize else 4, floats=1 if normalize else 0)
+            self._log_traffic(octave, k2, 4 if dog is None else 5, dogs=0 if dog is None else 1)
+        return k2
+
+    def _log_traffic(self, octave, event, levels, dogs=0, floats=0):
+        """
+        Record the memory traffic of a scale-space kernel for log_profile
 
-    def _one_octave(self, octave):
+        @param octave: number of the octave
+        @param event: OpenCL event of the kernel
+        @param levels: number of full gaussian levels (or tmp) of the octave read or written
+        @param dogs: number of full DoGs of the octave read or written
+        @param floats: number of full float images (the raw image) read or written
+        """
+        width, height = self.scales[octave]
+        size_of_level = 2 if self.half_levels else 4
+        size_of_dog = 2 if self.half_dogs else 4
+        size = levels * size_of_level + dogs * size_of_dog + floats * 4
+        self.traffic.append((octave, event, size * int(width) * int(height)))
+
+    def _direct_blur(self, octave):
+        """
+        Blur all levels of the octave directly from its base, each level on
+        its own queue so that the blurs run concurrently.
+
+        @param octave: number of the octave
+        @return: dict scale -> event of the blur giving this level
+        """
+        base_ready = pyopencl.enqueue_marker(self.queue)
+        events = {}
+        for scale, sigma in enumerate(self._direct_sigmas(), 1):
+            logger.info("Octave %i scale %s blur directly with sigma %s" % (octave, scale, sigma))
+            events[scale] = self._gaussian_convolution(self._level(octave, 0), self._level(octave, scale), sigma, octave,
+                                                       queue=self.blur_queues[scale - 1],
+                                                       temp_data=self.buffers[("tmp", scale)],
+                                                       wait_for=[base_ready])
+        for queue in self.blur_queues:
+            queue.flush()
+        return events
+
+    def _one_octave(self, octave, stage="all", blur=True):
         """
         Does all scales within an octave
 
         @param octave: number of the octave
+        @param stage: stage of the keypoints (see _extrema), None for the scale space only
+        @param blur: calculate the scale space, else it is already on the device (keep_scale_space)
         """
         prevSigma = par.InitSigma
         logger.info("Calculating octave %i" % octave)
-        wgsize = (128,)  # (max(self.wgsize[octave]),) #TODO: optimize
-        kpsize32 = numpy.int32(self.kpsize)
-        self._reset_keypoints()
-        octsize = numpy.int32(2 ** octave)
-        last_start = numpy.int32(0)
+        if stage in ("all", "extrema"):
+            # keypoints found before this octave: where it starts again after an overflow
+            self._record_count("cnt", octave, 0, 1)
+        if not blur:
+            self._octave_keypoints(octave, stage)
+            return
+        if self.blur_mode == "direct":
+            blurred = self._direct_blur(octave)
         for scale in range(par.Scales + 2):
+            if self.blur_mode == "direct":
+                # the levels are blurred concurrently, only the DoG waits for them
+                wait_for = [evt for evt in (blurred.get(scale), blurred[scale + 1]) if evt is not None]
+                evt = self.programs["algebra"].combine(self.queue, self.procsize[octave], self.wgsize[octave],
+                                             self._level(octave, scale + 1).data, numpy.float32(-1.0),
+                                             self._level(octave, scale).data, numpy.float32(+1.0),
+                                             self._dogs(octave).data, numpy.int32(scale),
+                                             *self.scales[octave], wait_for=wait_for)
+                if self.profile:
+                    self.events.append(("DoG %s %s" % (octave, scale), evt))
+                    self._log_traffic(octave, evt, 2, dogs=1)
+                continue
             sigma = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
             logger.info("Octave %i scale %s blur with sigma %s" % (octave, scale, sigma))
 
@@ -495,237 +1546,372 @@ class SiftPlan(object):
             # Calculate gaussian blur and DoG
             ########################################################################
 
-            self._gaussian_convolution(self.buffers[scale], self.buffers[scale + 1], sigma, octave)
             prevSigma *= self.sigmaRatio
-            evt = self.programs["algebra"].combine(self.queue, self.procsize[octave], self.wgsize[octave],
-                                             self.buffers[scale + 1].data, numpy.float32(-1.0),
-                                             self.buffers[scale].data, numpy.float32(+1.0),
-                                             self.buffers["DoGs"].data, numpy.int32(scale),
+            if self.use_images:
+                self._gaussian_convolution(self._level(octave, scale), self._level(octave, scale + 1), sigma, octave)
+                evt = self._program("texture", octave).dog_image(self.queue, self.procsize[octave], self.wgsize[octave],
+                                             self._level(octave, scale), self._level(octave, scale + 1),
+                                             self._dogs(octave).data, numpy.int32(scale),
                                              *self.scales[octave])
-            if self.profile:self.events.append(("DoG %s %s" % (octave, scale), evt))
-        for scale in range(1, par.Scales + 1):
-#                print("Before local_maxmin, cnt is %s %s %s" % (self.buffers["cnt"].get()[0], self.procsize[octave], self.wgsize[octave]))
-            evt = self.programs["image"].local_maxmin(self.queue, self.procsize[octave], self.wgsize[octave],
-                                            self.buffers["DoGs"].data,  # __global float* DOGS,
-                                            self.buffers["Kp_1"].data,  # __global keypoint* output,
-                                            numpy.int32(par.BorderDist),  # int border_dist,
-                                            numpy.float32(par.PeakThresh),  # float peak_thresh,
-                                            octsize,  # int octsize,
-                                            numpy.float32(par.EdgeThresh1),  # float EdgeThresh0,
-                                            numpy.float32(par.EdgeThresh),  # float EdgeThresh,
-                                            self.buffers["cnt"].data,  # __global int* counter,
-                                            kpsize32,  # int nb_keypoints,
-                                            numpy.int32(scale),  # int scale,
-                                            *self.scales[octave])  # int width, int height)
-            if self.profile:self.events.append(("local_maxmin %s %s" % (octave, scale), evt))
-#                print("after local_max_min:")
-#                print(self.buffers["Kp_1"].get()[:5])
-
-#                self.debug_holes("After local_maxmin %s %s" % (octave, scale))
-            procsize = calc_size((self.kpsize,), wgsize)
-#           Refine keypoints
-#                kp_counter = self.buffers["cnt"].get()[0]
-            cp_evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-#                kp_counter = self.cnt[0]
-            # TODO: modify interp_keypoint so that it reads end_keypoint from GPU memory
-            evt = self.programs["image"].interp_keypoint(self.queue, procsize, wgsize,
-                                          self.buffers["DoGs"].data,  # __global float* DOGS,
-                                          self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
-                                          last_start,  # int start_keypoint,
-                                          self.cnt[0],  # int end_keypoint,
-                                          numpy.float32(par.PeakThresh),  # float peak_thresh,
-                                          numpy.float32(par.InitSigma),  # float InitSigma,
-                                          *self.scales[octave])  # int width, int height)
-            if self.profile:
-                self.events += [("get cnt", cp_evt),
-                                ("interp_keypoint %s %s" % (octave, scale), evt)
-                                ]
-
-#                self.debug_holes("After interp_keypoint %s %s" % (octave, scale))
-            newcnt = self._compact(last_start)
-#                print("after compaction:")
-#                print(self.buffers["Kp_1"].get()[:5])
-#                self.debug_holes("After compact %s %s" % (octave, scale))
-#                self.debug.append(self.buffers[ scale)].get())
-            evt = self.programs["image"].compute_gradient_orientation(self.queue, self.procsize[octave], self.wgsize[octave],
-                               self.buffers[scale].data,  # __global float* igray,
-                               self.buffers["tmp"].data,  # __global float *grad,
-                               self.buffers["ori"].data,  # __global float *ori,
-                               *self.scales[octave])  # int width,int height
-            if self.profile:self.events.append(("compute_gradient_orientation %s %s" % (octave, scale), evt))
-
-#           Orientation assignement: 1D kernel, rather heavy kernel
-            if newcnt and newcnt > last_start:  # launch kernel only if neededwgsize = (128,)
-
-                if self.USE_CPU:
-                    file_to_use = "orientation_cpu"
-#                    logger.info("Computing orientation with CPU-optimized kernels")
-                else:
-                    file_to_use = "orientation_gpu"
-
-                wgsize2 = self.kernels[file_to_use],
-                procsize = int(newcnt * wgsize2[0]),
-#                print "orientation_assignment:", procsize, wgsize2, last_start, self.buffers["cnt"].get()[0], newcnt
-#                self.debug.append(grad.get())
-#                self.debug.append(ori.get())
-                evt = self.programs[file_to_use].orientation_assignment(self.queue, procsize, wgsize2,
-                                      self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
-                                      self.buffers["tmp"].data,  # __global float* grad,
-                                      self.buffers["ori"].data,  # __global float* ori,
-                                      self.buffers["cnt"].data,  # __global int* counter,
-                                      octsize,  # int octsize,
-                                      numpy.float32(par.OriSigma),  # float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
-                                      kpsize32,  # int max of nb_keypoints,
-                                      numpy.int32(last_start),  # int keypoints_start,
-                                      newcnt,  # int keypoints_end,
-                                      *self.scales[octave])  # int grad_width, int grad_height)
-                # newcnt = self.buffers["cnt"].get()[0] #do not forget to update numbers of keypoints, modified above !
-                evt_cp = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-                newcnt = self.cnt[0]  # do not forget to update numbers of keypoints, modified above !
-
-                if self.USE_CPU or self.LOW_END == 2:
-                    file_to_use = "keypoints_cpu"
-                    logger.info("Computing descriptors with CPU optimized kernels")
-                    wgsize2 = self.kernels[file_to_use],
-                    procsize2 = int(newcnt * wgsize2[0]),
-
-                else:
-                    if self.LOW_END == 1 :
-                        file_to_use = "keypoints_gpu1"
-                        logger.info("Computing descriptors with older-GPU optimized kernels")
-                        wgsize2 = self.kernels[file_to_use]
-                    else:
-                        file_to_use = "keypoints_gpu2"
-                        logger.info("Computing descriptors with newer-GPU optimized kernels")
-                        wgsize2 = self.kernels[file_to_use]
-                    procsize2 = int(newcnt * wgsize2[0]), wgsize2[1], wgsize2[2]
-                try:
-                    evt2 = self.programs[file_to_use].descriptor(self.queue, procsize2, wgsize2,
-                                          self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
-                                          self.buffers["descriptors"].data,  # ___global unsigned char *descriptors
-                                          self.buffers["tmp"].data,  # __global float* grad,
-                                          self.buffers["ori"].data,  # __global float* ori,
-                                          octsize,  # int octsize,
-                                          numpy.int32(last_start),  # int keypoints_start,
-                                          self.buffers["cnt"].data,  # int* keypoints_end,
-                                          *self.scales[octave])  # int grad_width, int grad_height)
-                except pyopencl.RuntimeError as error:
-                    self.LOW_END += 1
-                    logger.error("Descriptor failed with %s. Switching to lower_end mode" % error)
-                    if self.USE_CPU or self.LOW_END == 2:
-                        file_to_use = "keypoints_cpu"
-                        logger.info("Computing descriptors with CPU optimized kernels")
-                        wgsize2 = self.kernels[file_to_use],
-                        procsize2 = int(newcnt * wgsize2[0]),
-
-                    else:
-                        if self.LOW_END == 1 :
-                            file_to_use = "keypoints_gpu1"
-                            logger.info("Computing descriptors with older-GPU optimized kernels")
-                            wgsize2 = self.kernels[file_to_use]
-                        else:
-                            file_to_use = "keypoints_gpu2"
-                            logger.info("Computing descriptors with newer-GPU optimized kernels")
-                            wgsize2 = self.kernels[file_to_use]
-                        procsize2 = int(newcnt * wgsize2[0]), wgsize2[1], wgsize2[2]
-
-                    evt2 = self.programs[file_to_use].descriptor(self.queue, procsize2, wgsize2,
-                                          self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
-                                          self.buffers["descriptors"].data,  # ___global unsigned char *descriptors
-                                          self.buffers["tmp"].data,  # __global float* grad,
-                                          self.buffers["ori"].data,  # __global float* ori,
-                                          octsize,  # int octsize,
-                                          numpy.int32(last_start),  # int keypoints_start,
-                                          self.buffers["cnt"].data,  # int* keypoints_end,
-                                          *self.scales[octave])  # int grad_width, int grad_height)
                 if self.profile:
-                    self.events += [("orientation_assignment %s %s" % (octave, scale), evt),
-                                    ("copy cnt D->H", evt_cp),
-                                    ("descriptors %s %s" % (octave, scale), evt2)]
-
-#                self.debug_holes("After orientation %s %s" % (octave, scale))
-#                last_start = self.buffers["cnt"].get()[0]
-            evt_cp = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-            last_start = self.cnt[0]
-            if self.profile:
-                self.events.append(("copy cnt D->H", evt_cp))
+                    self.events.append(("DoG %s %s" % (octave, scale), evt))
+                    self._log_traffic(octave, evt, 2, dogs=1)
+            else:
+                # the DoG is written by the vertical pass of the blur
+                self._gaussian_convolution(self._level(octave, scale), self._level(octave, scale + 1), sigma, octave,
+                                           dog=scale % self.dog_slices)
+            if self.low_memory and stage and scale >= 2:
+                # the DoGs scale-2 .. scale are ready: search the extrema of scale-1
+                self._extrema(octave, scale - 1, stage)
+        if stage and not self.low_memory:
+            self._octave_keypoints(octave, stage)
 
         ########################################################################
         # Rescale all images to populate all octaves
         ########################################################################
-        if octave < self.octave_max - 1:
+        if octave < self.octave_max - 1 and self.use_images:
+            evt = self._program("texture", octave).shrink_image(self.queue, self.procsize[octave + 1], self.wgsize[octave + 1],
+                                                    self._level(octave, par.Scales),
+                                                    self._level(octave + 1, 0),
+                                                    numpy.int32(2), numpy.int32(2),
+                                                    *self.scales[octave + 1])
+            if self.profile:
+                self.events.append(("shrink %s->%s" % (self.scales[octave], self.scales[octave + 1]), evt))
+        elif octave < self.octave_max - 1:
+            if self.low_memory:
+                # the level Scales+1 is not used anymore: it becomes the base of the next octave
+                base = (self.level_base + par.Scales + 1) % self.nb_levels
+            else:
+                base = 0
+            target = self._level(octave + 1, 0) if self.keep_scale_space else self._rolling_level(base)
             evt = self.programs["preprocess"].shrink(self.queue, self.procsize[octave + 1], self.wgsize[octave + 1],
-                                                    self.buffers[par.Scales].data,
-                                                    self.buffers[0].data,
+                                                    self._level(octave, par.Scales).data,
+                                                    target.data,
                                                     numpy.int32(2), numpy.int32(2),
                                                     self.scales[octave][0], self.scales[octave][1],
                                                     *self.scales[octave + 1])
+            self.level_base = base
             if self.profile:
                 self.events.append(("shrink %s->%s" % (self.scales[octave], self.scales[octave + 1]), evt))
-        results = numpy.empty((last_start, 4), dtype=numpy.float32)
-        descriptors = numpy.empty((last_start, 128), dtype=numpy.uint8)
-        if last_start:
-            evt = pyopencl.enqueue_copy(self.queue, results, self.buffers["Kp_1"].data)
-            evt2 = pyopencl.enqueue_copy(self.queue, descriptors, self.buffers["descriptors"].data)
-            if self.profile:
-                self.events += [("copy D->H", evt),
-                                ("copy D->H", evt2)]
-        return results, descriptors
 
-    def _compact(self, start=numpy.int32(0)):
+    def _octave_keypoints(self, octave, stage="all"):
         """
-        Compact the vector of keypoints starting from start
+        Keypoints of all the scales of the octave, once its DoGs are calculated
 
-        @param start: start compacting at this adress. Before just copy
-        @type start: numpy.int32
+        @param octave: number of the octave
+        @param stage: stage of the keypoints, see _extrema
+        """
+        if self.fused_extrema and stage != "describe":
+            self._octave_extrema(octave)
+        for scale in range(1, par.Scales + 1):
+            self._extrema(octave, scale, stage)
+
+    def _octave_extrema(self, octave):
+        """
+        Search the extrema of all the scales of the octave in one launch: the
+        candidates are stored in Kp_octave, with their scale, for _extrema
+
+        @param octave: number of the octave
         """
-        wgsize = self.max_workgroup_size,  # (max(self.wgsize[0]),) #TODO: optimize
+        wg = self.vertical_wgsize[octave]
+        procsize = calc_size(tuple(int(i) for i in self.scales[octave]), wg)
+        tile = pyopencl.LocalMemory(4 * 3 * (wg[0] + 2) * (wg[1] + 2))
+        evt1 = self.programs["memset"].memset_int(self.queue, (1,), (1,), self.buffers["cnt_octave"].data, numpy.int32(0), numpy.int32(1))
+        mask = self.buffers[("mask", octave)].data if self.masked else None
+        evt = self._program("image", octave).local_maxmin_octave(self.queue, procsize, wg,
+                                self._dogs(octave).data,  # __global float* DOGS,
+                                self.buffers["Kp_octave"].data,  # __global keypoint* output,
+                                mask,  # __global unsigned char* mask,
+                                numpy.int32(par.BorderDist),  # int border_dist,
+                                numpy.float32(par.PeakThresh),  # float peak_thresh,
+                                numpy.int32(2 ** octave),  # int octsize,
+                                numpy.float32(par.EdgeThresh1),  # float EdgeThresh0,
+                                numpy.float32(par.EdgeThresh),  # float EdgeThresh,
+                                self.buffers["cnt_octave"].data,  # __global int* counter,
+                                numpy.int32(self.kpsize),  # int nb_keypoints,
+                                numpy.int32(par.Scales),  # int nb_scales,
+                                self.scales[octave][0], self.scales[octave][1],  # int width, int height
+                                tile)  # __local float* tile
+        if self.profile:
+            self.events += [("memset cnt_octave", evt1), ("local_maxmin_octave %s" % octave, evt)]
+            self._log_traffic(octave, evt, 0, dogs=par.Scales + 2)
+        self._record_count("cnt_octave", octave, 0, 0)
+
+    def _search_keypoints(self, octave, scale):
+        """
+        Extremum search in the DoGs scale-1, scale and scale+1 and refinement:
+        the keypoints (peak, r, c, sigma) are appended to Kp_1 from counters[0]
+
+        @param octave: number of the octave
+        @param scale: index of the DoG
+        """
+        wgsize = (128,)  # (max(self.wgsize[octave]),) #TODO: optimize
         kpsize32 = numpy.int32(self.kpsize)
-#        kp_counter = self.buffers["cnt"].get()[0]
-        cp0_evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-        kp_counter = self.cnt[0]
-        procsize = calc_size((self.kpsize,), wgsize)
-
-        if kp_counter > 0.9 * self.kpsize:
-            logger.warning("Keypoint counter overflow risk: counted %s / %s" % (kp_counter, self.kpsize))
-        logger.info("Compact %s -> %s / %s" % (start, kp_counter, self.kpsize))
-#        self.buffers["cnt"].set(numpy.array([start], dtype=numpy.int32))
-        self.cnt[0] = start
-        cp1_evt = pyopencl.enqueue_copy(self.queue, self.buffers["cnt"].data, self.cnt)
-        evt = self.programs["algebra"].compact(self.queue, procsize, wgsize,
+        octsize = numpy.int32(2 ** octave)
+#                print("Before local_maxmin, cnt is %s %s %s" % (self.buffers["cnt"].get()[0], self.procsize[octave], self.wgsize[octave]))
+        args = [self._dogs(octave).data,  # __global float* DOGS,
+                self.buffers["Kp_1"].data,  # __global keypoint* output,
+                numpy.int32(par.BorderDist),  # int border_dist,
+                numpy.float32(par.PeakThresh),  # float peak_thresh,
+                octsize,  # int octsize,
+                numpy.float32(par.EdgeThresh1),  # float EdgeThresh0,
+                numpy.float32(par.EdgeThresh),  # float EdgeThresh,
+                self.buffers["cnt"].data,  # __global int* counter,
+                kpsize32,  # int nb_keypoints,
+                numpy.int32(scale),  # int scale,
+                self.scales[octave][0], self.scales[octave][1]]  # int width, int height)
+        if self.fused_extrema:
+            # the candidates were found by _octave_extrema
+            evt = self._program("image", octave).select_scale(self.queue, (self.KP_GROUPS * wgsize[0],), wgsize,
+                                self.buffers["Kp_octave"].data,  # __global keypoint* candidates,
+                                self.buffers["cnt_octave"].data,  # __global int* nb_candidates,
+                                self.buffers["Kp_1"].data,  # __global keypoint* output,
+                                self.buffers["cnt"].data,  # __global int* counter,
+                                kpsize32,  # int nb_keypoints,
+                                numpy.int32(scale))  # int scale
+        elif self.masked:
+            args.insert(2, self.buffers[("mask", octave)].data)  # __global unsigned char* mask,
+            evt = self._program("image", octave).local_maxmin_masked(self.queue, self.procsize[octave], self.wgsize[octave], *args)
+        elif self.use_images:
+            # the DoGs are calculated on the fly from the gaussian levels scale-1 .. scale+2
+            levels = [self._level(octave, i) for i in range(scale - 1, scale + 3)]
+            evt = self._program("texture", octave).local_maxmin_image(self.queue, self.procsize[octave], self.wgsize[octave], *(levels + args[1:]))
+        else:
+            evt = self._program("image", octave).local_maxmin(self.queue, self.procsize[octave], self.wgsize[octave], *args)
+        if self.profile:self.events.append(("%s %s %s" % ("select_scale" if self.fused_extrema else "local_maxmin", octave, scale), evt))
+        procsize = (self.KP_GROUPS * wgsize[0],)
+        self._copy_counter("cnt", 0, "counters", 1)
+        self._record_count("cnt", octave, scale, 0)
+        evt = self._program("image", octave).interp_keypoint_counters(self.queue, procsize, wgsize,
+                                      self._dogs(octave).data,  # __global float* DOGS,
+                                      self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
+                                      self.buffers["Kp_2"].data,  # __global keypoint* output,
+                                      self.buffers["counters"].data,  # __global int* counters,
+                                      kpsize32,  # int nb_keypoints,
+                                      numpy.float32(par.PeakThresh),  # float peak_thresh,
+                                      numpy.float32(par.InitSigma),  # float InitSigma,
+                                      *self.scales[octave])  # int width, int height)
+        if self.profile:
+            self.events.append(("interp_keypoint %s %s" % (octave, scale), evt))
+        self._compact()
+
+    def _extrema(self, octave, scale, stage="all"):
+        """
+        Keypoints of one scale of the octave: extremum search in the DoGs
+        scale-1, scale and scale+1, refinement, orientation and descriptors.
+
+        Nothing is read back: the keypoints of the scale are appended after
+        counters[0] and the kernels read their range from the device.
+
+        @param octave: number of the octave
+        @param scale: index of the DoG
+        @param stage: "all" for the whole calculation, "extrema" for the
+        search and the refinement only (first pass of max_keypoints),
+        "describe" for the orientation and the descriptors of the keypoints
+        of the first pass selected by _select_strongest
+        """
+        kpsize32 = numpy.int32(self.kpsize)
+        octsize = numpy.int32(2 ** octave)
+        if stage == "describe":
+            self._select_keypoints(octave, scale)
+        else:
+            self._search_keypoints(octave, scale)
+        if stage == "extrema":
+            # end of the range of the scale, read by _select_keypoints
+            self._copy_counter("cnt", 0, "counters", 0)
+            self._record_count("cnt", octave, scale, 1)
+            return
+        if self.use_images:
+            evt = self._program("texture", octave).compute_gradient_orientation_image(self.queue, self.procsize[octave], self.wgsize[octave],
+                           self._level(octave, scale),  # image2d_t igray,
+                           self.buffers["tmp"].data,  # __global float *grad,
+                           self.buffers["ori"].data,  # __global float *ori,
+                           *self.scales[octave])  # int width,int height
+        else:
+            evt = self._program("image", octave).compute_gradient_orientation(self.queue, self.procsize[octave], self.wgsize[octave],
+                           self._level(octave, scale).data,  # __global float* igray,
+                           self.buffers["tmp"].data,  # __global float *grad,
+                           self.buffers["ori"].data,  # __global float *ori,
+                           *self.scales[octave])  # int width,int height
+        if self.profile:self.events.append(("compute_gradient_orientation %s %s" % (octave, scale), evt))
+
+#           Orientation assignement: 1D kernel, rather heavy kernel
+        if self.USE_CPU:
+            file_to_use = "orientation_cpu"
+        else:
+            file_to_use = "orientation_gpu"
+        wgsize2 = self.kernels[file_to_use],
+        # the keypoints added with a second orientation (after counters[1]) are already complete
+        self._copy_counter("cnt", 0, "counters", 1)
+        evt = self.programs[file_to_use].orientation_assignment_counters(self.queue, (self.KP_GROUPS * wgsize2[0],), wgsize2,
+                              self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
+                              self.buffers["tmp"].data,  # __global float* grad,
+                              self.buffers["ori"].data,  # __global float* ori,
+                              self.buffers["cnt"].data,  # __global int* counter,
+                              octsize,  # int octsize,
+                              numpy.float32(par.OriSigma),  # float OriSigma, //WARNING: (1.5), it is not "InitSigma (=1.6)"
+                              kpsize32,  # int max of nb_keypoints,
+                              self.buffers["counters"].data,  # __global int* counters,
+                              *self.scales[octave])  # int grad_width, int grad_height)
+        evt2 = self._compute_descriptors(octave, octsize)
+        if self.profile:
+            self.events += [("orientation_assignment %s %s" % (octave, scale), evt),
+                            ("descriptors %s %s" % (octave, scale), evt2)]
+        # the next scale starts after the keypoints of this one
+        self._copy_counter("cnt", 0, "counters", 0)
+        if stage == "all":
+            self._record_count("cnt", octave, scale, 1)
+
+    def _select_strongest(self):
+        """
+        Threshold on the response of the keypoints of the first pass keeping
+        max_keypoints of them, calculated on the device from the histogram of
+        their responses
+        """
+        wg = self._kp_workgroup()
+        nb_bins = numpy.int32(self.RESPONSE_BINS)
+        evt1 = self.programs["memset"].memset_int(self.queue, (self.RESPONSE_BINS,), wg, self.buffers["histogram"].data, numpy.int32(0), nb_bins)
+        evt2 = self.programs["algebra"].response_histogram(self.queue, (self.KP_GROUPS * wg[0],), wg,
+                        self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
+                        self.buffers["cnt"].data,  # __global int* counter,
+                        self.buffers["histogram"].data,  # __global int* histogram,
+                        numpy.int32(self.kpsize),  # int nb_keypoints,
+                        numpy.float32(par.PeakThresh),  # float peak_thresh,
+                        nb_bins,  # int nb_bins,
+                        pyopencl.LocalMemory(4 * self.RESPONSE_BINS))  # __local int* hist
+        evt3 = self.programs["algebra"].response_threshold(self.queue, (1,), (1,),
+                        self.buffers["histogram"].data,  # __global int* histogram,
+                        nb_bins,  # int nb_bins,
+                        numpy.int32(self.max_keypoints),  # int budget,
+                        self.buffers["threshold"].data)  # __global int* threshold
+        if self.profile:
+            self.events += [("memset histogram", evt1),
+                            ("response histogram", evt2),
+                            ("response threshold", evt3)]
+
+    def _select_keypoints(self, octave, scale):
+        """
+        Append the keypoints of the scale selected by _select_strongest
+        after those already found, from counters[0]
+
+        @param octave: number of the octave
+        @param scale: index of the DoG
+        """
+        wg = self._kp_workgroup()
+        evt = self.programs["algebra"].select_keypoints(self.queue, (self.KP_GROUPS * wg[0],), wg,
                         self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
                         self.buffers["Kp_2"].data,  # __global keypoint* output,
+                        self.buffers["kp_stats"].data,  # __global int* bounds,
+                        numpy.int32(self._stat_index(octave, scale - 1, 1)),  # int first,
+                        numpy.int32(self._stat_index(octave, scale, 1)),  # int last,
                         self.buffers["cnt"].data,  # __global int* counter,
-                        start,  # int start,
-                        kp_counter)  # int nbkeypoints
-#        newcnt = self.buffers["cnt"].get()[0]
-        cp2_evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-        # print("After compaction, %i (-%i)" % (newcnt, kp_counter - newcnt))
-        # swap keypoints:
-        self.buffers["Kp_1"], self.buffers["Kp_2"] = self.buffers["Kp_2"], self.buffers["Kp_1"]
-        # memset buffer Kp_2
-#        self.buffers["Kp_2"].fill(-1, self.queue)
-        mem_evt = self.programs["memset"].memset_float(self.queue, calc_size((4 * self.kpsize,), wgsize), wgsize, self.buffers["Kp_2"].data, numpy.float32(-1), numpy.int32(4 * self.kpsize))
+                        self.buffers["counters"].data,  # __global int* counters,
+                        self.buffers["threshold"].data,  # __global int* threshold,
+                        numpy.int32(self.kpsize),  # int nb_keypoints,
+                        numpy.float32(par.PeakThresh),  # float peak_thresh,
+                        numpy.int32(self.RESPONSE_BINS))  # int nb_bins
+        if self.profile:
+            self.events.append(("select_keypoints %s %s" % (octave, scale), evt))
+        self._compact(output_start=2)
+        self._copy_counter("counters", 2, "counters", 0)
+
+    def _copy_counter(self, src, src_index, dest, dest_index):
+        """
+        Copy a keypoint counter on the device, without synchronizing the host
+
+        @param src: name of the source buffer ("cnt" or "counters")
+        @param src_index: index of the value in the source buffer
+        @param dest: name of the destination buffer
+        @param dest_index: index of the value in the destination buffer
+        """
+        evt = pyopencl.enqueue_copy(self.queue, self.buffers[dest].data, self.buffers[src].data, byte_count=4,
+                                    src_offset=4 * src_index, dst_offset=4 * dest_index)
         if self.profile:
-            self.events += [("copy cnt D->H", cp0_evt),
-                            ("copy cnt H->D", cp1_evt),
-                            ("compact", evt),
-                            ("copy cnt D->H", cp2_evt),
-                            ("memset 2", mem_evt)
-                            ]
-        return self.cnt[0]
+            self.events.append(("copy %s[%s] D->D" % (src, src_index), evt))
 
+    def _record_count(self, src, octave, scale, index):
+        """
+        Store a keypoint counter in kp_stats, on the device
+
+        @param src: name of the counter ("cnt" or "cnt_octave")
+        @param octave: number of the octave
+        @param scale: scale, 0 for the counts of the whole octave
+        @param index: 0 after the extremum search, 1 after the orientation assignment
+        """
+        self._copy_counter(src, 0, "kp_stats", self._stat_index(octave, scale, index))
 
-    def _reset_keypoints(self):
+    def _stat_index(self, octave, scale, index):
+        """
+        @return: index of a count in the flattened kp_stats buffer
+        """
+        return (octave * (par.Scales + 1) + scale) * 2 + index
+
+    def _kp_workgroup(self):
+        """
+        @return: work-group of the kernels scanning the keypoints (power of 2)
+        """
+        return 2 ** int(math.log(min(self.max_workgroup_size, 256), 2)),
+
+    def _compact(self, output_start=0):
+        """
+        Compact the interpolated keypoints of Kp_2 between counters[0] and
+        counters[1] into Kp_1, from counters[output_start], keeping their order.
+
+        Stream compaction by prefix sums: each of the KP_GROUPS work-groups
+        counts the valid keypoints of its chunk of the range, the counts are
+        scanned into offsets, then each work-group scatters its keypoints.
+        Only the range is read and written and the counter is set on the
+        device.
+
+        @param output_start: index in counters of the start of the output:
+        0 to compact in place, 2 to append the keypoints (max_keypoints)
+        """
+        wg = self._kp_workgroup()  # the scan needs a power of 2
+        kpsize32 = numpy.int32(self.kpsize)
+        scan = pyopencl.LocalMemory(4 * wg[0])
+        procsize = self.KP_GROUPS * wg[0],
+        evt1 = self.programs["algebra"].compact_count(self.queue, procsize, wg,
+                        self.buffers["Kp_2"].data,  # __global keypoint* keypoints,
+                        self.buffers["counters"].data,  # __global int* counters,
+                        self.buffers["compact_offsets"].data,  # __global int* group_counts,
+                        kpsize32,  # int nb_keypoints,
+                        scan)  # __local int* scan
+        evt2 = self.programs["algebra"].compact_offsets(self.queue, wg, wg,
+                        self.buffers["compact_offsets"].data,  # __global int* group_counts,
+                        numpy.int32(self.KP_GROUPS),  # int nb_groups,
+                        self.buffers["counters"].data,  # __global int* counters,
+                        numpy.int32(output_start),  # int output_start,
+                        self.buffers["cnt"].data,  # __global int* counter,
+                        scan)  # __local int* scan
+        evt3 = self.programs["algebra"].compact_scatter(self.queue, procsize, wg,
+                        self.buffers["Kp_2"].data,  # __global keypoint* keypoints,
+                        self.buffers["Kp_1"].data,  # __global keypoint* output,
+                        self.buffers["counters"].data,  # __global int* counters,
+                        numpy.int32(output_start),  # int output_start,
+                        self.buffers["compact_offsets"].data,  # __global int* group_offsets,
+                        kpsize32,  # int nb_keypoints,
+                        scan)  # __local int* scan
+        if self.profile:
+            self.events += [("compact count", evt1),
+                            ("compact offsets", evt2),
+                            ("compact scatter", evt3)]
+
+    def _reset_keypoints(self, start=0):
         """
         Todo: implement directly in OpenCL instead of relying on pyOpenCL
+
+        @param start: number of keypoints kept, those of the octaves before an overflow
         """
-        wg_size = min(self.max_workgroup_size, self.kernels["memset"]),
-        evt1 = self.programs["memset"].memset_float(self.queue, calc_size((4 * self.kpsize,), wg_size), wg_size, self.buffers["Kp_1"].data, numpy.float32(-1), numpy.int32(4 * self.kpsize))
-#        evt2 = self.programs["memset"].memset_float(self.queue, calc_size((4 * self.kpsize,), wg_size), wg_size, self.buffers["Kp_2"].data, numpy.float32(-1), numpy.int32(4 * self.kpsize))
-        evt3 = self.programs["memset"].memset_int(self.queue, (1,), (1,), self.buffers["cnt"].data, numpy.int32(0), numpy.int32(1))
+        # the keypoint vectors are not cleared: only the ranges given by the counters are read
+        evt3 = self.programs["memset"].memset_int(self.queue, (1,), (1,), self.buffers["cnt"].data, numpy.int32(start), numpy.int32(1))
+        evt4 = self.programs["memset"].memset_int(self.queue, (2,), (2,), self.buffers["counters"].data, numpy.int32(start), numpy.int32(2))
         if self.profile:
-            self.events += [("memset 1", evt1), ("memset cnt", evt3)]
+            self.events += [("memset cnt", evt3), ("memset counters", evt4)]
+        if not start:
+            size = self.buffers["kp_stats"].size
+            evt5 = self.programs["memset"].memset_int(self.queue, (size,), (1,), self.buffers["kp_stats"].data, numpy.int32(0), numpy.int32(size))
+            if self.profile:
+                self.events.append(("memset kp_stats", evt5))
 #        self.buffers["Kp_1"].fill(-1, self.queue)
 #        self.buffers["Kp_2"].fill(-1, self.queue)
 #        self.buffers["cnt"].fill(0, self.queue)
@@ -767,6 +1953,14 @@ class SiftPlan(object):
         print("%50s:\t%.3fms" % ("Total execution time", t))
         print("%50s:\t%.3fms" % ("Total Orientation assignment", orient))
         print("%50s:\t%.3fms" % ("Total Descriptors", descr))
+        if self.profile:
+            print("%50s:\t%i" % ("Host synchronizations (copy cnt D->H)", len([e for e in self.events if e[0] == "copy cnt D->H"])))
+        if self.profile and self.traffic:
+            print("_"*80)
+            for octave in sorted(set(i[0] for i in self.traffic)):
+                et = sum(1e-6 * (e.profile.end - e.profile.start) for o, e, b in self.traffic if o == octave)
+                size = sum(b for o, e, b in self.traffic if o == octave)
+                print("%50s:\t%.3fms\t%.1fMB\t%.2fGB/s" % ("Blur and DoG octave %s" % octave, et, 1e-6 * size, 1e-6 * size / et if et else 0.0))
 
     def reset_timer(self):
         """
@@ -774,6 +1968,7 @@ class SiftPlan(object):
         """
         with self._sem:
             self.events = []
+            self.traffic = []
 
 if __name__ == "__main__":
     # Prepare debugging
@@ -66,6 +66,25 @@ def kernel_size(sigma, odd=False, cutoff=4):
         size += 1
     return size
 
+def recursive_gaussian(sigma):
+    """
+    Coefficients of the recursive gaussian filter of Young and van Vliet
+    (Signal Processing 44, 1995) used by the "recursive" blur engine
+
+    @param sigma: width of the gaussian (valid above 0.5)
+    @return: gain b and feedback a1, a2, a3 as float32, with b + a1 + a2 + a3 = 1
+    """
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * numpy.sqrt(1.0 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+    b2 = -1.4281 * q ** 2 - 1.26661 * q ** 3
+    b3 = 0.422205 * q ** 3
+    a1, a2, a3 = b1 / b0, b2 / b0, b3 / b0
+    return tuple(numpy.float32(i) for i in (1.0 - a1 - a2 - a3, a1, a2, a3))
+
 def sizeof(shape, dtype="uint8"):
     """
     Calculate the number of bytes needed to allocate for a given structure
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark and accuracy of the blur modes of SiftPlan
+
+python bench_blur_mode.py --sizes 256,2048
+compares the cascaded blurs (each level from the previous one) with the
+direct blurs (all levels from the base of the octave, concurrently) on small
+and large frames: speed, gaussian levels and keypoints
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from sift.param import par
+from bench_plan import frame, bench, matching
+
+
+def levels(plan):
+    """
+    @return: the gaussian levels 1..Scales+2 of the last octave processed by the plan
+    """
+    plan.queue.finish()
+    return [plan.buffers[scale].get() for scale in range(1, par.Scales + 3)]
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of the direct blur mode of SiftPlan against the cascade")
+    parser.add_option("-s", "--sizes", dest="sizes", default="256,2048",
+                      help="comma separated sizes of the square frames")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--platform", dest="platform", type="int", default=None,
+                      help="platform number")
+    parser.add_option("-i", "--device", dest="device", type="int", default=None,
+                      help="device number")
+    options, args = parser.parse_args()
+    device = None
+    if (options.platform is not None) and (options.device is not None):
+        device = (options.platform, options.device)
+    for size in [int(i) for i in options.sizes.split(",")]:
+        img = frame((size, size), options.dtype)
+        results = {}
+        for mode in sift.SiftPlan.blur_modes:
+            setup, best, kp = bench(img, {"blur_mode": mode}, options.repeat, options.devicetype, device)
+            plan = sift.SiftPlan(template=img, devicetype=options.devicetype, device=device, blur_mode=mode)
+            plan.keypoints(img)
+            results[mode] = best, kp, levels(plan)
+            print("%5i %-8s setup+first run: %8.1f ms\tbest run: %8.1f ms\t%i keypoints" % (size, mode, 1000 * setup, 1000 * best, kp.size))
+        ref_time, ref_kp, ref_levels = results["cascade"]
+        best, kp, lvl = results["direct"]
+        print("%5i speed-up: %.3fx" % (size, ref_time / best))
+        for scale, (ref, res) in enumerate(zip(ref_levels, lvl), 1):
+            print("%5i level %i: max abs error %.4f, mean abs error %.5f (levels in 0..255)" % (size, scale, abs(ref - res).max(), abs(ref - res).mean()))
+        common = matching(ref_kp, kp)
+        print("%5i keypoints: %i cascade, %i direct, %i in common" % (size, ref_kp.size, kp.size, common))
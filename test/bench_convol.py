@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark of the convolution engines used for the gaussian blurs of SiftPlan
+
+python bench_convol.py --size 2048
+times every gaussian blur of SiftPlan (all sigma, all octaves) with the
+"global", "tiled" and "transpose" engines
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+import pyopencl
+
+
+def bench(plan, sigma, octave, repeat=5):
+    """
+    Time one gaussian blur of the plan with the profiling events
+
+    @return: best execution time in ms
+    """
+    best = None
+    for i in range(repeat):
+        plan.events = []
+        plan._gaussian_convolution(plan.buffers[0], plan.buffers[1], sigma, octave)
+        plan.queue.finish()
+        t = sum(1e-6 * (evt.profile.end - evt.profile.start) for name, evt in plan.events)
+        if best is None or t < best:
+            best = t
+    return best
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of the convolution engines of SiftPlan")
+    parser.add_option("-s", "--size", dest="size", type="int", default=2048,
+                      help="size of the square image")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--platform", dest="platform", type="int", default=None,
+                      help="platform number")
+    parser.add_option("-i", "--device", dest="device", type="int", default=None,
+                      help="device number")
+    options, args = parser.parse_args()
+    device = None
+    if (options.platform is not None) and (options.device is not None):
+        device = (options.platform, options.device)
+    img = numpy.random.random((options.size, options.size)).astype(numpy.float32) * 255
+    results = {}
+    for engine in sift.SiftPlan.blur_engines:
+        plan = sift.SiftPlan(img.shape, img.dtype, devicetype=options.devicetype, device=device, profile=True, blur_engine=engine)
+        pyopencl.enqueue_copy(plan.queue, plan.buffers[0].data, img)
+        for sigma in plan._sigmas():
+            for octave in range(plan.octave_max):
+                bench(plan, sigma, octave, 1)  # warm-up: compilation
+                results[engine, sigma, octave] = bench(plan, sigma, octave, options.repeat)
+        auto = sift.SiftPlan(img.shape, img.dtype, devicetype=options.devicetype, device=device).blur_engine
+    print("Automatic selection: %s" % auto)
+    print("%8s %6s" % ("sigma", "octave") + "".join("%12s" % engine for engine in sift.SiftPlan.blur_engines))
+    for sigma in plan._sigmas():
+        for octave in range(plan.octave_max):
+            print("%8.3f %6i" % (sigma, octave) + "".join("%10.3fms" % results[engine, sigma, octave] for engine in sift.SiftPlan.blur_engines))
+    print("%15s" % "Total" + "".join("%10.3fms" % sum(v for k, v in results.items() if k[0] == engine) for engine in sift.SiftPlan.blur_engines))
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark of the time needed to import sift and to discover OpenCL devices
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, os, subprocess
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+
+# Each snippet is run in a fresh interpreter, and prints its own timing
+SNIPPETS = [("import sift", "import sift"),
+            ("import sift.plan", "import sift.plan"),
+            ("ocl.platforms (probe)", "from sift.opencl import ocl; ocl.use_cache = False; ocl.platforms"),
+            ("ocl.platforms (cached)", "from sift.opencl import ocl; ocl.platforms"),
+            ]
+TEMPLATE = """
+import sys, time
+sys.path.insert(0, %r)
+t0 = time.time()
+%s
+sys.stdout.write("%%.6f" %% (time.time() - t0))
+"""
+
+
+def bench(code, repeat=5):
+    """
+    Run code in a new interpreter repeat times
+
+    @return: best time in seconds
+    """
+    res = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", TEMPLATE % (UtilsTest.sift_home, code)])
+        res.append(float(out.split()[-1]))
+    return min(res)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of the import time of sift")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    options, args = parser.parse_args()
+    # populate the device cache first
+    bench(SNIPPETS[-1][1], 1)
+    for label, code in SNIPPETS:
+        print("%-25s %8.3f ms" % (label, 1000.0 * bench(code, options.repeat)))
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark of the keypoint budget of SiftPlan
+
+python bench_max_keypoints.py --size 2048 --budgets 1000,4000
+compares the plan keeping all keypoints with plans keeping only the
+strongest ones (max_keypoints): speed, number of keypoints and how many of
+the selected keypoints are also found by the full plan
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from bench_plan import frame, bench, matching
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of the max_keypoints option of SiftPlan")
+    parser.add_option("-s", "--size", dest="size", type="int", default=2048,
+                      help="size of the square frame")
+    parser.add_option("-b", "--budgets", dest="budgets", default="1000,4000",
+                      help="comma separated values of max_keypoints")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                      help="keep the scale space of the plan keeping all keypoints too (always kept with max_keypoints when it fits)")
+    options, args = parser.parse_args()
+    img = frame((options.size, options.size), options.dtype)
+    setup, ref_time, ref_kp = bench(img, {"keep_scale_space": options.keep}, options.repeat, options.devicetype)
+    print("%-10s setup+first run: %8.1f ms\tbest run: %8.1f ms\t%i keypoints" % ("all", 1000 * setup, 1000 * ref_time, ref_kp.size))
+    for budget in [int(i) for i in options.budgets.split(",")]:
+        setup, best, kp = bench(img, {"max_keypoints": budget}, options.repeat, options.devicetype)
+        print("%-10s setup+first run: %8.1f ms\tbest run: %8.1f ms\t%i keypoints\tspeed-up %.3fx" %
+              (budget, 1000 * setup, 1000 * best, kp.size, ref_time / best))
+        print("%-10s %i keypoints in common with the full set" % (budget, matching(kp, ref_kp)))
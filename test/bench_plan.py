@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark of SiftPlan options on detector-like frames
+
+python bench_plan.py --size 2048 specialize=True
+compares the default plan with a plan built with specialize=True
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+import scipy.ndimage
+
+
+def frame(shape, dtype="uint16", seed=0):
+    """
+    Synthetic detector frame: smoothed noise with a few sharp peaks
+
+    @param shape: 2-tuple
+    @param dtype: numpy dtype of the frame
+    """
+    rnd = numpy.random.RandomState(seed)
+    img = scipy.ndimage.gaussian_filter(rnd.random_sample(shape), 4)
+    img = (img - img.min()) / (img.max() - img.min()) * 1000
+    peaks = rnd.randint(0, min(shape), size=(shape[0] * shape[1] // 10000, 2))
+    img[peaks[:, 0], peaks[:, 1]] += 5000
+    return scipy.ndimage.gaussian_filter(img, 1).astype(dtype)
+
+
+def matching(kp1, kp2, tol=1.0):
+    """
+    @return: number of keypoints of kp1 with a keypoint of kp2 closer than tol pixel and the same scale within 10%
+    """
+    found = 0
+    for kp in kp1:
+        d2 = (kp2.x - kp.x) ** 2 + (kp2.y - kp.y) ** 2
+        close = (d2 < tol ** 2) & (abs(kp2.scale - kp.scale) < 0.1 * kp.scale)
+        if close.any():
+            found += 1
+    return found
+
+
+def parse(option):
+    """
+    Convert key=value in a keyword argument
+    """
+    key, value = option.split("=", 1)
+    try:
+        value = eval(value, {}, {})
+    except Exception:
+        pass
+    return key, value
+
+
+def bench(img, kwargs, repeat=5, devicetype="GPU", device=None):
+    """
+    Build a plan with the given options and time it
+
+    @return: plan build time, best execution time, keypoints
+    """
+    t0 = time.time()
+    plan = sift.SiftPlan(template=img, devicetype=devicetype, device=device, **kwargs)
+    kp = plan.keypoints(img)  # warm-up: includes compilation of the lazy kernels
+    t1 = time.time()
+    best = None
+    for i in range(repeat):
+        t2 = time.time()
+        kp = plan.keypoints(img)
+        t3 = time.time()
+        if best is None or (t3 - t2) < best:
+            best = t3 - t2
+    return t1 - t0, best, kp
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] key=value ...", version="1.0",
+                          description="Benchmark of SiftPlan options against the default plan")
+    parser.add_option("-s", "--size", dest="size", type="int", default=2048,
+                      help="size of the square frame")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--platform", dest="platform", type="int", default=None,
+                      help="platform number")
+    parser.add_option("-i", "--device", dest="device", type="int", default=None,
+                      help="device number")
+    options, args = parser.parse_args()
+    device = None
+    if (options.platform is not None) and (options.device is not None):
+        device = (options.platform, options.device)
+    img = frame((options.size, options.size), options.dtype)
+    kwargs = dict(parse(i) for i in args)
+    ref = None
+    for label, kw in (("default", {}), (" ".join(args) or "default", kwargs)):
+        setup, best, kp = bench(img, kw, options.repeat, options.devicetype, device)
+        print("%-30s setup+first run: %8.1f ms\tbest run: %8.1f ms\t%i keypoints" % (label, 1000 * setup, 1000 * best, kp.size))
+        if ref is None:
+            ref, ref_kp = best, kp
+        else:
+            print("Speed-up: %.3fx" % (ref / best))
+            common = matching(ref_kp, kp)
+            print("Repeatability: %i keypoints in common (%.1f%%)" % (common, 100.0 * common / max(1, ref_kp.size)))
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Accuracy and throughput of the recursive (IIR) gaussian engine of SiftPlan
+
+python bench_recursive.py -d CPU
+compares the "recursive" blur engine with the FIR engine selected for the
+device: keypoint repeatability on the test images and throughput of every
+gaussian blur (Mpixel/s) per sigma
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+import scipy.misc
+import pyopencl
+from bench_convol import bench as bench_blur
+from bench_plan import matching
+
+
+def images():
+    """
+    @return: dict name -> grayscale test image
+    """
+    result = {"lena": scipy.misc.lena().astype(numpy.float32)}
+    rgb = scipy.misc.imread(UtilsTest.getimage("wikipedia/commons/9/94/Esrf_grenoble.jpg"))
+    result["esrf"] = (0.299 * rgb[:, :, 0] + 0.587 * rgb[:, :, 1] + 0.114 * rgb[:, :, 2]).astype(numpy.float32)
+    return result
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of the recursive blur engine of SiftPlan against the FIR one")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs, the best one is reported")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--platform", dest="platform", type="int", default=None,
+                      help="platform number")
+    parser.add_option("-i", "--device", dest="device", type="int", default=None,
+                      help="device number")
+    options, args = parser.parse_args()
+    device = None
+    if (options.platform is not None) and (options.device is not None):
+        device = (options.platform, options.device)
+    for name, img in images().items():
+        fir = sift.SiftPlan(template=img, devicetype=options.devicetype, device=device, profile=True)
+        iir = sift.SiftPlan(template=img, devicetype=options.devicetype, device=device, profile=True, blur_engine="recursive")
+        ref = fir.keypoints(img)
+        kp = iir.keypoints(img)
+        common = matching(ref, kp)
+        print("%s %s: %i keypoints with %s, %i with recursive, %i in common (repeatability %.1f%%)" %
+              (name, img.shape, ref.size, fir.blur_engine, kp.size, common, 100.0 * common / max(1, ref.size)))
+        pixels = 1e-3 * img.shape[0] * img.shape[1]  # in Mpixel, times are in ms
+        print("%8s %12s %12s" % ("sigma", fir.blur_engine, "recursive"))
+        for plan in (fir, iir):
+            pyopencl.enqueue_copy(plan.queue, plan.buffers[0].data, img)
+        for sigma in fir._sigmas():
+            t_fir = bench_blur(fir, sigma, 0, options.repeat)
+            t_iir = bench_blur(iir, sigma, 0, options.repeat)
+            print("%8.3f %7.1fMpx/s %7.1fMpx/s" % (sigma, pixels / t_fir, pixels / t_iir))
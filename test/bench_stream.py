@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Benchmark of the streaming API of SiftPlan
+
+python bench_stream.py --size 2048 --frames 20
+compares keypoints called frame by frame with keypoints_stream, where the
+upload of the next frame overlaps with the processing of the current one
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys, time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from bench_plan import frame
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Benchmark of SiftPlan.keypoints_stream")
+    parser.add_option("-s", "--size", dest="size", type="int", default=2048,
+                      help="size of the square frames")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frames")
+    parser.add_option("-f", "--frames", dest="frames", type="int", default=20,
+                      help="number of frames in the stream")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--platform", dest="platform", type="int", default=None,
+                      help="platform number")
+    parser.add_option("-i", "--device", dest="device", type="int", default=None,
+                      help="device number")
+    options, args = parser.parse_args()
+    device = None
+    if (options.platform is not None) and (options.device is not None):
+        device = (options.platform, options.device)
+    frames = [frame((options.size, options.size), options.dtype, seed) for seed in range(options.frames)]
+    plan = sift.SiftPlan(template=frames[0], devicetype=options.devicetype, device=device)
+    plan.keypoints(frames[0])  # warm-up: includes compilation of the lazy kernels
+
+    t0 = time.time()
+    ref = [plan.keypoints(img) for img in frames]
+    t1 = time.time()
+    res = list(plan.keypoints_stream(frames))
+    t2 = time.time()
+    stats = plan.stream_stats
+    print("%-20s %8.1f ms/frame" % ("keypoints", 1000 * (t1 - t0) / options.frames))
+    print("%-20s %8.1f ms/frame" % ("keypoints_stream", 1000 * (t2 - t1) / options.frames))
+    print("Upload: %.3f ms/frame, device waiting for upload: %.3f ms/frame, overlap: %.1f%%" %
+          (1000 * stats["upload"] / stats["frames"], 1000 * stats["stall"] / stats["frames"], 100 * stats["overlap"]))
+    print("Same number of keypoints: %s" % all(a.size == b.size for a, b in zip(ref, res)))
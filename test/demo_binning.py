@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Accuracy of the keypoints of SiftPlan with an anisotropic binning
+
+python demo_binning.py --size 1024 --binning 2,4
+compares the plan binning on the device with the plan run on a frame binned
+on the host, mapped back to the full resolution independently, then
+measures the angle error against the plan on the full resolution frame for
+the gradient rule used by the plan and for the displacement rule
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from bench_plan import frame
+from test_preproc import binning
+
+
+def unbin(kp, by, bx, gradient=True):
+    """
+    Map keypoints of a binned frame to the full resolution
+
+    @param kp: keypoints (record array), modified in place
+    @param gradient: map the angle as a gradient direction, else as a displacement
+    """
+    kp.x = kp.x * bx + 0.5 * (bx - 1)
+    kp.y = kp.y * by + 0.5 * (by - 1)
+    kp.scale = kp.scale * numpy.sqrt(bx * by)
+    if gradient:
+        kp.angle = numpy.arctan2(bx * numpy.sin(kp.angle), by * numpy.cos(kp.angle))
+    else:
+        kp.angle = numpy.arctan2(by * numpy.sin(kp.angle), bx * numpy.cos(kp.angle))
+    return kp
+
+
+def errors(kp1, kp2, tol=1.0, scale_tol=0.1):
+    """
+    @return: distances, relative scale errors and angle errors of the
+    keypoints of kp1 having a keypoint of kp2 closer than tol pixel and of
+    the same scale within scale_tol (the closest angle among them)
+    """
+    dist, scale, angle = [], [], []
+    for kp in kp1:
+        d2 = (kp2.x - kp.x) ** 2 + (kp2.y - kp.y) ** 2
+        close = numpy.where((d2 < tol ** 2) & (abs(kp2.scale - kp.scale) < scale_tol * kp.scale))[0]
+        if close.size:
+            da = abs((kp2.angle[close] - kp.angle + numpy.pi) % (2 * numpy.pi) - numpy.pi)
+            best = close[da.argmin()]
+            dist.append(numpy.sqrt(d2[best]))
+            scale.append(abs(kp2.scale[best] - kp.scale) / kp.scale)
+            angle.append(da.min())
+    return numpy.array(dist), numpy.array(scale), numpy.array(angle)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Accuracy of the keypoints with an anisotropic binning")
+    parser.add_option("-s", "--size", dest="size", type="int", default=1024,
+                      help="size of the square frame")
+    parser.add_option("-b", "--binning", dest="binning", default="2,4",
+                      help="vertical,horizontal binning")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    options, args = parser.parse_args()
+    by, bx = [int(i) for i in options.binning.split(",")]
+    img = frame((options.size, options.size), options.dtype)
+    plan = sift.SiftPlan(template=img, devicetype=options.devicetype, binning=(by, bx))
+    kp = plan.keypoints(img)
+    small = binning(img.astype(numpy.float32), (by, bx))
+    ref = unbin(sift.SiftPlan(template=small, devicetype=options.devicetype).keypoints(small), by, bx)
+    dist, scale, angle = errors(kp, ref)
+    print("binning %sx%s on the device: %i keypoints, %i found on the host-binned frame" % (by, bx, kp.size, dist.size))
+    if dist.size:
+        print("    max errors: position %.4f pixel, scale %.2e, angle %.2e rad" % (dist.max(), scale.max(), angle.max()))
+    full = sift.SiftPlan(template=img, devicetype=options.devicetype).keypoints(img)
+    for rule in ("gradient", "displacement"):
+        small_kp = sift.SiftPlan(template=small, devicetype=options.devicetype).keypoints(small)
+        dist, scale, angle = errors(unbin(small_kp, by, bx, rule == "gradient"), full, tol=max(by, bx), scale_tol=0.25)
+        if angle.size:
+            print("%-12s rule: %i keypoints matched at full resolution, median angle error %.3f rad" % (rule, angle.size, numpy.median(angle)))
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Keypoint capacity of SiftPlan
+
+python demo_capacity.py --size 512 --pix 1000
+starts a plan with buffers far too small (one keypoint every 1000 pixels),
+checks that the overflow is recovered without losing keypoints and prints
+the counts of each octave and scale and the capacity learnt over the frames
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from bench_plan import frame, matching
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Recovery of keypoint overflows by SiftPlan")
+    parser.add_option("-s", "--size", dest="size", type="int", default=512,
+                      help="size of the square frame")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("-p", "--pix", dest="pix", type="int", default=1000,
+                      help="pixels per keypoint of the initial capacity")
+    parser.add_option("-n", "--frames", dest="frames", type="int", default=5,
+                      help="number of frames")
+    options, args = parser.parse_args()
+    img = frame((options.size, options.size), options.dtype)
+    ref = sift.SiftPlan(template=img, devicetype=options.devicetype)
+    ref_kp = ref.keypoints(img)
+    plan = sift.SiftPlan(template=img, devicetype=options.devicetype, PIX_PER_KP=options.pix)
+    capacity = plan.kpsize
+    kp = plan.keypoints(img)
+    print("capacity %i -> %i, keypoints: %i expected, %i found, %i in common" % (capacity, plan.kpsize, ref_kp.size, kp.size, matching(ref_kp, kp)))
+    for octave, counts in enumerate(plan.keypoint_counts()):
+        print("octave %i: %s" % (octave, " ".join("%6i" % i for i in counts)))
+    for i in range(options.frames):
+        kp = plan.keypoints(img)
+        print("frame %i: %i keypoints, capacity %i" % (i, kp.size, plan.kpsize))
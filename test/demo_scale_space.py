@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*
+"""
+Scale space exported by SiftPlan
+
+python demo_scale_space.py --size 512
+runs a plan with keep_scale_space=True, checks that every DoG is the
+difference of its gaussian levels and that the keypoints are the same as
+without the option
+"""
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__status__ = "beta"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import sys
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+import sift
+import numpy
+from bench_plan import frame, matching
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(version="1.0", description="Check of the scale space kept on the device by SiftPlan")
+    parser.add_option("-s", "--size", dest="size", type="int", default=512,
+                      help="size of the square frame")
+    parser.add_option("-t", "--dtype", dest="dtype", default="uint16",
+                      help="data type of the frame")
+    parser.add_option("-d", "--devicetype", dest="devicetype", default="GPU",
+                      help="device type: CPU or GPU")
+    parser.add_option("--half", dest="half", action="store_true", default=False,
+                      help="store the DoGs in half precision")
+    options, args = parser.parse_args()
+    img = frame((options.size, options.size), options.dtype)
+    ref = sift.SiftPlan(template=img, devicetype=options.devicetype, half_dogs=options.half)
+    ref_kp = ref.keypoints(img)
+    plan = sift.SiftPlan(template=img, devicetype=options.devicetype, half_dogs=options.half, keep_scale_space=True)
+    kp = plan.keypoints(img)
+    print("memory: %.1fMB without, %.1fMB with the scale space" % (ref.memory / 2.0 ** 20, plan.memory / 2.0 ** 20))
+    for octave in plan.scale_space():
+        levels = [i.get() for i in octave["gaussians"]]
+        dogs = octave["dogs"].get().astype(numpy.float32)
+        error = max(abs(levels[s] - levels[s + 1] - dogs[s]).max() for s in range(dogs.shape[0]))
+        print("octave %i %s pixel %s sigmas %s: max DoG error %.5f" % (octave["octave"], octave["shape"], octave["pixel"],
+                                                                     ", ".join("%.3f" % i for i in octave["sigmas"]), error))
+    print("keypoints: %i without, %i with the scale space, %i in common" % (ref_kp.size, kp.size, matching(ref_kp, kp)))
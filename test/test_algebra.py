@@ -191,6 +191,96 @@ class test_algebra(unittest.TestCase):
             logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
             logger.info("Compact operation took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
 
+    def test_compact_scan(self):
+        """
+        tests the stream compaction by prefix sums: compact_count, compact_offsets and compact_scatter
+        """
+        nbkeypoints = 10000
+        start = 1000
+        end = 9000
+        keypoints = numpy.random.rand(nbkeypoints, 4).astype(numpy.float32)
+        keypoints[:, 2] = numpy.arange(nbkeypoints)
+        keypoints[numpy.random.rand(nbkeypoints) < 0.25, 1] = -1
+        gpu_keypoints = pyopencl.array.to_device(queue, keypoints)
+        output = pyopencl.array.zeros(queue, (nbkeypoints, 4), dtype=numpy.float32, order="C")
+        counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+        counters = pyopencl.array.to_device(queue, numpy.array([start, end], dtype=numpy.int32))
+        wg = 64,
+        nb_groups = 37  # chunks of different sizes, some empty
+        offsets = pyopencl.array.empty(queue, (nb_groups,), dtype=numpy.int32)
+        scan = pyopencl.LocalMemory(4 * wg[0])
+        nbkeypoints = numpy.int32(nbkeypoints)
+        self.program.compact_count(queue, (nb_groups * wg[0],), wg,
+            gpu_keypoints.data, counters.data, offsets.data, nbkeypoints, scan)
+        self.program.compact_offsets(queue, wg, wg,
+            offsets.data, numpy.int32(nb_groups), counters.data, numpy.int32(0), counter.data, scan)
+        self.program.compact_scatter(queue, (nb_groups * wg[0],), wg,
+            gpu_keypoints.data, output.data, counters.data, numpy.int32(0), offsets.data, nbkeypoints, scan)
+        res = output.get()
+        count = counter.get()[0]
+        valid = keypoints[start:end][keypoints[start:end, 1] != -1]
+        self.assertEqual(count, start + valid.shape[0], "counter")
+        self.assert_(abs(res[start:count] - valid).max() == 0, "same valid keypoints, in the same order")
+        self.assert_(abs(res[:start]).max() == 0 and abs(res[count:]).max() == 0, "nothing written outside the range")
+
+    def test_select_strongest(self):
+        """
+        tests the selection of the strongest keypoints: response_histogram,
+        response_threshold, then select_keypoints and the compaction of each
+        range at the end of the keypoints
+        """
+        nbkeypoints = 10000
+        found = 6000
+        budget = 1000
+        nb_bins = 1024
+        peak_thresh = numpy.float32(255.0 * 0.04 / 3.0)
+        keypoints = numpy.zeros((nbkeypoints, 4), dtype=numpy.float32)
+        sign = numpy.where(numpy.random.rand(found) < 0.5, -1, 1)
+        keypoints[:found, 0] = sign * peak_thresh * 2 ** (6 * numpy.random.rand(found))
+        keypoints[:found, 1:3] = 100 * numpy.random.rand(found, 2)
+        keypoints[:found, 3] = numpy.arange(found)
+        bounds = numpy.array([0, 2500, found], dtype=numpy.int32)
+        gpu_keypoints = pyopencl.array.to_device(queue, keypoints)
+        selected = pyopencl.array.empty(queue, (nbkeypoints, 4), dtype=numpy.float32)
+        gpu_bounds = pyopencl.array.to_device(queue, bounds)
+        counter = pyopencl.array.to_device(queue, numpy.array([found], dtype=numpy.int32))
+        counters = pyopencl.array.zeros(queue, (3,), dtype=numpy.int32)
+        histogram = pyopencl.array.zeros(queue, (nb_bins,), dtype=numpy.int32)
+        threshold = pyopencl.array.empty(queue, (2,), dtype=numpy.int32)
+        wg = 64,
+        nb_groups = 16
+        offsets = pyopencl.array.empty(queue, (nb_groups,), dtype=numpy.int32)
+        scan = pyopencl.LocalMemory(4 * wg[0])
+        nbkeypoints = numpy.int32(nbkeypoints)
+        self.program.response_histogram(queue, (nb_groups * wg[0],), wg,
+            gpu_keypoints.data, counter.data, histogram.data, nbkeypoints, peak_thresh, numpy.int32(nb_bins),
+            pyopencl.LocalMemory(4 * nb_bins))
+        self.program.response_threshold(queue, (1,), (1,),
+            histogram.data, numpy.int32(nb_bins), numpy.int32(budget), threshold.data)
+        self.assertEqual(histogram.get().sum(), found, "all keypoints in the histogram")
+        for first in range(bounds.size - 1):
+            self.program.select_keypoints(queue, (nb_groups * wg[0],), wg,
+                gpu_keypoints.data, selected.data, gpu_bounds.data, numpy.int32(first), numpy.int32(first + 1),
+                counter.data, counters.data, threshold.data, nbkeypoints, peak_thresh, numpy.int32(nb_bins))
+            self.program.compact_count(queue, (nb_groups * wg[0],), wg,
+                selected.data, counters.data, offsets.data, nbkeypoints, scan)
+            self.program.compact_offsets(queue, wg, wg,
+                offsets.data, numpy.int32(nb_groups), counters.data, numpy.int32(2), counter.data, scan)
+            self.program.compact_scatter(queue, (nb_groups * wg[0],), wg,
+                selected.data, gpu_keypoints.data, counters.data, numpy.int32(2), offsets.data, nbkeypoints, scan)
+        res = gpu_keypoints.get()
+        count = counter.get()[0]
+        self.assertEqual(count, found + budget, "budget of keypoints appended")
+        self.assert_(abs(res[:found] - keypoints[:found]).max() == 0, "first pass unchanged")
+        kept = res[found:count]
+        self.assert_((numpy.diff(kept[:, 3]) > 0).all(), "order kept")
+        dropped = numpy.ones(found, dtype=bool)
+        dropped[kept[:, 3].astype(int)] = False
+        weakest = abs(kept[:, 0]).min()
+        strongest = abs(keypoints[:found, 0][dropped]).max()
+        # only the keypoints of the threshold bin can be on both sides
+        self.assert_(strongest < weakest * 2 ** (16.0 / nb_bins) * 1.001, "strongest keypoints selected")
+
 
 
 
@@ -211,6 +301,8 @@ def test_suite_algebra():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_algebra("test_combine"))
     testSuite.addTest(test_algebra("test_compact"))
+    testSuite.addTest(test_algebra("test_compact_scan"))
+    testSuite.addTest(test_algebra("test_select_strongest"))
     return testSuite
 
 if __name__ == '__main__':
@@ -51,7 +51,9 @@ from test_convol import test_suite_convol
 from test_algebra import test_suite_algebra
 from test_image import test_suite_image
 from test_keypoints_old import test_suite_keypoints
+from test_keypoints import test_suite_plan
 from test_matching import test_suite_matching
+from test_cache import test_suite_cache
 
 def test_suite_all():
     testSuite = unittest.TestSuite()
@@ -62,7 +64,9 @@ def test_suite_all():
     testSuite.addTest(test_suite_convol())
     testSuite.addTest(test_suite_image())
     testSuite.addTest(test_suite_keypoints())
+    testSuite.addTest(test_suite_plan())
     testSuite.addTest(test_suite_matching())
+    testSuite.addTest(test_suite_cache())
     return testSuite
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#-*- coding: utf8 -*-
+#
+#    Project: Sift implementation in Python + OpenCL
+#             https://github.com/kif/sift_pyocl
+#
+
+"""
+Test suite for the on-disk cache of compiled OpenCL programs
+"""
+
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__license__ = "BSD"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2026-10-16"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import time, os, logging, shutil, tempfile
+import numpy
+import pyopencl, pyopencl.array
+import sys
+import unittest
+from utilstest import UtilsTest, getLogger, ctx
+import sift
+from sift.cache import ProgramCache
+logger = getLogger(__file__)
+queue = pyopencl.CommandQueue(ctx)
+
+
+class test_cache(unittest.TestCase):
+    def setUp(self):
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "memset.cl")
+        self.kernel_src = open(kernel_path).read()
+        self.tmpdir = tempfile.mkdtemp(prefix="sift_cache_")
+        self.cache = ProgramCache(self.tmpdir)
+
+    def tearDown(self):
+        self.cache = None
+        shutil.rmtree(self.tmpdir)
+
+    def check_program(self, program):
+        """
+        Ensure the program works by running memset_int
+        """
+        data = pyopencl.array.empty(queue, 100, dtype=numpy.int32)
+        program.memset_int(queue, (128,), (1,), data.data, numpy.int32(42), numpy.int32(100)).wait()
+        self.assert_((data.get() == 42).all(), "memset worked")
+
+    def test_hit(self):
+        """
+        Second build should come from the disk cache
+        """
+        t0 = time.time()
+        prg1 = self.cache.build(ctx, self.kernel_src, "-D WORKGROUP_SIZE=128")
+        t1 = time.time()
+        prg2 = self.cache.build(ctx, self.kernel_src, "-D WORKGROUP_SIZE=128")
+        t2 = time.time()
+        logger.info("Build from source: %.3fms, from cache: %.3fms" % (1000.0 * (t1 - t0), 1000.0 * (t2 - t1)))
+        self.assertEqual(self.cache.misses, 1, "first build is a miss")
+        self.assertEqual(self.cache.hits, 1, "second build is a hit")
+        self.check_program(prg2)
+        self.cache.build(ctx, self.kernel_src, "-D WORKGROUP_SIZE=64")
+        self.assertEqual(self.cache.misses, 2, "other options are another entry")
+        self.assertEqual(len(self.cache.entries()), 2, "2 entries on disk")
+
+    def test_corrupted(self):
+        """
+        Corrupted entries are detected and rebuilt
+        """
+        self.cache.build(ctx, self.kernel_src)
+        filename = self.cache.entries()[0][2]
+        data = open(filename, "rb").read()
+        with open(filename, "wb") as f:
+            f.write(data[:len(data) // 2])
+        prg = self.cache.build(ctx, self.kernel_src)
+        self.assertEqual(self.cache.corrupted, 1, "corruption detected")
+        self.assertEqual(self.cache.misses, 2, "program rebuilt")
+        self.check_program(prg)
+        self.cache.build(ctx, self.kernel_src)
+        self.assertEqual(self.cache.hits, 1, "entry was replaced")
+
+    def test_evict(self):
+        """
+        Oldest entries are evicted when the cache is full
+        """
+        self.cache.build(ctx, self.kernel_src, "-D WORKGROUP_SIZE=32")
+        size = self.cache.entries()[0][1]
+        self.cache.max_size = size * 3 // 2
+        self.cache.build(ctx, self.kernel_src, "-D WORKGROUP_SIZE=64")
+        self.assertEqual(len(self.cache.entries()), 1, "only one entry left")
+        self.assertEqual(self.cache.evicted, 1, "one entry evicted")
+        self.cache.max_age = -1
+        self.cache.evict()
+        self.assertEqual(len(self.cache.entries()), 0, "all entries expired")
+
+
+def test_suite_cache():
+    testSuite = unittest.TestSuite()
+    testSuite.addTest(test_cache("test_hit"))
+    testSuite.addTest(test_cache("test_corrupted"))
+    testSuite.addTest(test_cache("test_evict"))
+    return testSuite
+
+if __name__ == '__main__':
+    mysuite = test_suite_cache()
+    runner = unittest.TextTestRunner()
+    if not runner.run(mysuite).wasSuccessful():
+        sys.exit(1)
@@ -48,7 +48,7 @@ import sys
 import unittest
 from utilstest import UtilsTest, getLogger, ctx
 import sift
-from sift.utils import calc_size
+from sift.utils import calc_size, recursive_gaussian
 logger = getLogger(__file__)
 if logger.getEffectiveLevel() <= logging.INFO:
     PROFILE = True
@@ -68,6 +68,23 @@ def my_blur(img, kernel):
     tmp1 = scipy.ndimage.filters.convolve1d(img, kernel, axis= -1, mode="reflect")
     return scipy.ndimage.filters.convolve1d(tmp1, kernel, axis=0, mode="reflect")
 
+def my_recursive(img, b, a1, a2, a3, axis=-1):
+    """
+    numpy implementation of the recursive gaussian (causal + anti-causal
+    passes) along one axis, borders extended with the edge value
+    """
+    data = numpy.rollaxis(img.astype(numpy.float64), axis)
+    out = numpy.empty_like(data)
+    w1 = w2 = w3 = data[0]
+    for i in range(data.shape[0]):
+        out[i] = b * data[i] + a1 * w1 + a2 * w2 + a3 * w3
+        w1, w2, w3 = out[i], w1, w2
+    w2 = w3 = w1
+    for i in range(data.shape[0] - 1, -1, -1):
+        out[i] = b * out[i] + a1 * w1 + a2 * w2 + a3 * w3
+        w1, w2, w3 = out[i], w1, w2
+    return numpy.rollaxis(out, 0, axis % img.ndim + 1).astype(numpy.float32)
+
 
 class test_convol(unittest.TestCase):
     def setUp(self):
@@ -215,11 +232,217 @@ class test_convol(unittest.TestCase):
                 fig.show()
                 raw_input("enter")
 
+    def test_convol_tiled(self):
+        """
+        tests the tiled (local memory) convolution kernels
+        """
+        wg_h = (64, 2)
+        wg_v = (16, 4)
+        rows = numpy.int32(8)
+        shape_h = calc_size((self.input.shape[1], self.input.shape[0]), wg_h)
+        shape_v = (calc_size((self.input.shape[1],), wg_v[:1])[0],
+                   wg_v[1] * int(numpy.ceil(float(self.input.shape[0]) / (wg_v[1] * rows))))
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1) | 1
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution_tiled(queue, shape_h, wg_h,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H,
+                                pyopencl.LocalMemory(4 * wg_h[1] * (wg_h[0] + ksize - 1)))
+            k2 = self.program.vertical_convolution_tiled(queue, shape_v, wg_v,
+                                self.gpu_tmp.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H,
+                                rows, pyopencl.LocalMemory(4 * wg_v[0] * (wg_v[1] * rows + ksize - 1)))
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            delta = abs(ref - res).max()
+            self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Tiled horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                  1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_transpose(self):
+        """
+        tests the convolution kernels working on the transposed image
+        """
+        shape_t = calc_size((self.input.shape[0], self.input.shape[1]), self.wg)
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1) | 1
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            k1 = self.program.horizontal_convolution_transpose(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            tmp = self.gpu_tmp.get().ravel()[:self.input.size].reshape(self.input.shape[1], self.input.shape[0])
+            k2 = self.program.vertical_convolution_transposed(queue, shape_t, self.wg,
+                                self.gpu_tmp.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            ref_tmp = scipy.ndimage.filters.convolve1d(self.input, gaussian, axis= -1, mode="reflect")
+            ref = my_blur(self.input, gaussian)
+            delta_tmp = abs(ref_tmp.T - tmp).max()
+            delta = abs(ref - res).max()
+            self.assert_(delta_tmp < 1e-4, "sigma= %s transposed delta=%s" % (sigma, delta_tmp))
+            self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Transposed horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                       1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_image(self):
+        """
+        tests the convolution kernels working on image2d_t
+        """
+        if not ctx.devices[0].image_support:
+            logger.warning("Device %s has no image support, skipping" % ctx.devices[0].name)
+            return
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "texture.cl")
+        program = pyopencl.Program(ctx, open(kernel_path).read()).build()
+        fmt = pyopencl.ImageFormat(pyopencl.channel_order.R, pyopencl.channel_type.FLOAT)
+        size = (self.input.shape[1], self.input.shape[0])
+        img_in = pyopencl.Image(ctx, pyopencl.mem_flags.READ_WRITE, fmt, shape=size)
+        img_tmp = pyopencl.Image(ctx, pyopencl.mem_flags.READ_WRITE, fmt, shape=size)
+        img_out = pyopencl.Image(ctx, pyopencl.mem_flags.READ_WRITE, fmt, shape=size)
+        pyopencl.enqueue_copy(queue, img_in, self.input, origin=(0, 0), region=size)
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1) | 1
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            k1 = program.horizontal_convolution_image(queue, self.shape, self.wg,
+                                img_in, img_tmp, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = program.vertical_convolution_image(queue, self.shape, self.wg,
+                                img_tmp, img_out, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = numpy.empty_like(self.input)
+            pyopencl.enqueue_copy(queue, res, img_out, origin=(0, 0), region=size).wait()
+            ref = my_blur(self.input, gaussian)
+            delta = abs(ref - res).max()
+            self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Horizontal image convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                  1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_recursive(self):
+        """
+        tests the recursive (IIR) gaussian kernels
+        """
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "recursive.cl")
+        program = pyopencl.Program(ctx, open(kernel_path).read()).build()
+        wg = (64,)
+        for sigma in [2, 15 / 8., 5.0]:
+            coefs = recursive_gaussian(sigma)
+            self.assert_(abs(sum(coefs) - 1.0) < 1e-5, "gain is 1")
+            k1 = program.horizontal_recursive(queue, calc_size((self.input.shape[0],), wg), wg,
+                                self.gpu_in.data, self.gpu_tmp.data, *(coefs + (self.IMAGE_W, self.IMAGE_H)))
+            k2 = program.vertical_recursive(queue, calc_size((self.input.shape[1],), wg), wg,
+                                self.gpu_tmp.data, self.gpu_out.data, *(coefs + (self.IMAGE_W, self.IMAGE_H)))
+            res = self.gpu_out.get()
+            ref = my_recursive(my_recursive(self.input, *coefs, axis=-1), *coefs, axis=0)
+            delta = abs(ref - res).max()
+            self.assert_(delta < 1e-2, "sigma= %s delta=%s" % (sigma, delta))
+            # far from the borders, close to the FIR gaussian
+            fir = scipy.ndimage.gaussian_filter(self.input, sigma, mode="nearest")
+            border = int(4 * sigma)
+            delta_fir = abs(fir - res)[border:-border, border:-border].mean()
+            self.assert_(delta_fir < 5.0, "sigma= %s mean delta to FIR=%s" % (sigma, delta_fir))
+            logger.info("sigma= %s delta=%s mean delta to FIR=%s" % (sigma, delta, delta_fir))
+            if PROFILE:
+                logger.info("Recursive horizontal pass took %.3fms and vertical pass took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                           1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_dog(self):
+        """
+        tests the vertical convolution kernels fused with the difference of gaussians
+        """
+        sigma = 2.0
+        ksize = int(8 * sigma + 1) | 1
+        x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+        gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+        gaussian /= gaussian.sum(dtype=numpy.float32)
+        gpu_filter = pyopencl.array.to_device(queue, gaussian)
+        gpu_dogs = pyopencl.array.zeros(queue, (2,) + self.input.shape, dtype=numpy.float32)
+        args = [gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H]
+        fused = [self.gpu_in.data, gpu_dogs.data, numpy.int32(1)]
+        ref_tmp = scipy.ndimage.filters.convolve1d(self.input, gaussian, axis= -1, mode="reflect")
+        ref = my_blur(self.input, gaussian)
+        # global
+        self.gpu_tmp.set(ref_tmp)
+        self.program.vertical_convolution_dog(queue, self.shape, self.wg, self.gpu_tmp.data, self.gpu_out.data, *(args + fused))
+        results = {"global": (self.gpu_out.get(), gpu_dogs.get()[1])}
+        # tiled
+        wg_v = (16, 4)
+        rows = numpy.int32(8)
+        shape_v = (calc_size((self.input.shape[1],), wg_v[:1])[0],
+                   wg_v[1] * int(numpy.ceil(float(self.input.shape[0]) / (wg_v[1] * rows))))
+        gpu_dogs.fill(0.0, queue)
+        self.program.vertical_convolution_tiled_dog(queue, shape_v, wg_v, self.gpu_tmp.data, self.gpu_out.data,
+                                                    *(args + [rows, pyopencl.LocalMemory(4 * wg_v[0] * (wg_v[1] * rows + ksize - 1))] + fused))
+        results["tiled"] = (self.gpu_out.get(), gpu_dogs.get()[1])
+        # transposed
+        self.gpu_tmp.set(numpy.ascontiguousarray(ref_tmp.T).reshape(self.input.shape))
+        shape_t = calc_size((self.input.shape[0], self.input.shape[1]), self.wg)
+        gpu_dogs.fill(0.0, queue)
+        self.program.vertical_convolution_transposed_dog(queue, shape_t, self.wg, self.gpu_tmp.data, self.gpu_out.data, *(args + fused))
+        results["transpose"] = (self.gpu_out.get(), gpu_dogs.get()[1])
+        for engine, (res, dog) in results.items():
+            delta = abs(ref - res).max()
+            delta_dog = abs((self.input - ref) - dog).max()
+            self.assert_(delta < 1e-4, "%s delta=%s" % (engine, delta))
+            self.assert_(delta_dog < 1e-4, "%s DoG delta=%s" % (engine, delta_dog))
+            logger.info("%s delta=%s DoG delta=%s" % (engine, delta, delta_dog))
+
+    def test_convol_half(self):
+        """
+        tests the tiled convolution kernels with the levels stored as half (-D HALF_LEVELS)
+        """
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "convolution.cl")
+        program = pyopencl.Program(ctx, open(kernel_path).read()).build("-D HALF_LEVELS")
+        half_in = self.input.astype(numpy.float16)
+        gpu_in = pyopencl.array.to_device(queue, half_in)
+        gpu_tmp = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float16)
+        gpu_out = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float16)
+        wg_h = (64, 2)
+        wg_v = (16, 4)
+        rows = numpy.int32(8)
+        shape_h = calc_size((self.input.shape[1], self.input.shape[0]), wg_h)
+        shape_v = (calc_size((self.input.shape[1],), wg_v[:1])[0],
+                   wg_v[1] * int(numpy.ceil(float(self.input.shape[0]) / (wg_v[1] * rows))))
+        sigma = 2.0
+        ksize = int(8 * sigma + 1) | 1
+        x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+        gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+        gaussian /= gaussian.sum(dtype=numpy.float32)
+        gpu_filter = pyopencl.array.to_device(queue, gaussian)
+        program.horizontal_convolution_tiled(queue, shape_h, wg_h,
+                            gpu_in.data, gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H,
+                            pyopencl.LocalMemory(4 * wg_h[1] * (wg_h[0] + ksize - 1)))
+        program.vertical_convolution_tiled(queue, shape_v, wg_v,
+                            gpu_tmp.data, gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H,
+                            rows, pyopencl.LocalMemory(4 * wg_v[0] * (wg_v[1] * rows + ksize - 1)))
+        res = gpu_out.get().astype(numpy.float32)
+        # reference calculated in float on the rounded input: tmp and output are rounded to half
+        ref = my_blur(half_in.astype(numpy.float32), gaussian)
+        delta = abs(ref - res).max()
+        self.assert_(delta < 2 ** -10 * 2 * self.input.max(), "half delta=%s" % delta)
+        logger.info("half levels delta=%s" % delta)
+
 def test_suite_convol():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_convol("test_convol"))
     testSuite.addTest(test_convol("test_convol_hor"))
     testSuite.addTest(test_convol("test_convol_vert"))
+    testSuite.addTest(test_convol("test_convol_tiled"))
+    testSuite.addTest(test_convol("test_convol_transpose"))
+    testSuite.addTest(test_convol("test_convol_image"))
+    testSuite.addTest(test_convol("test_convol_recursive"))
+    testSuite.addTest(test_convol("test_convol_dog"))
+    testSuite.addTest(test_convol("test_convol_half"))
     return testSuite
 
 if __name__ == '__main__':
@@ -49,6 +49,7 @@ import unittest
 from utilstest import UtilsTest, getLogger, ctx
 import sift
 from sift.utils import calc_size
+from sift.opencl import ocl
 
 logger = getLogger(__file__)
 
@@ -202,6 +203,26 @@ class test_gaussian_v2(unittest.TestCase):
             show (ref, res, delta)
         self.assert_(abs(ref - res).max() < 1e-6, "gaussian are the same ")
 
+class test_gaussian_bank(unittest.TestCase):
+    def setUp(self):
+        self.devctx = ocl.get_context(*(ocl.select_device("GPU") or ocl.select_device("ALL")))
+
+    def test_bank(self):
+        """
+        filters calculated on the device (small sigma) and on the host (large sigma)
+        """
+        sigmas = [1.6, 2.0, 1.6 * 2 ** (1 / 3.), 50.0, 200.0]
+        bank = self.devctx.get_gaussians(sigmas)
+        self.assert_(bank is self.devctx.get_gaussians(sigmas), "bank is shared")
+        for sigma in sigmas:
+            buf, size = bank[sigma]
+            res = numpy.empty(size, dtype=numpy.float32)
+            pyopencl.enqueue_copy(self.devctx.get_queue(), res, buf).wait()
+            ref = gaussian_cpu(sigma, size)
+            delta = abs(ref - res).max()
+            logger.info("sigma=%s size=%s delta=%s" % (sigma, size, delta))
+            self.assert_(delta < 1e-6, "sigma=%s delta=%s" % (sigma, delta))
+
 
 def test_suite_gaussian():
     testSuite = unittest.TestSuite()
@@ -209,6 +230,7 @@ def test_suite_gaussian():
     testSuite.addTest(test_gaussian_v1("test_even"))
     testSuite.addTest(test_gaussian_v2("test_odd"))
     testSuite.addTest(test_gaussian_v2("test_even"))
+    testSuite.addTest(test_gaussian_bank("test_bank"))
     return testSuite
 
 if __name__ == '__main__':
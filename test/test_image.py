@@ -202,6 +202,133 @@ class test_image(unittest.TestCase):
 
 
 
+    def test_local_maxmin_masked(self):
+        """
+        tests the local maximum/minimum detection kernel restricted to a mask
+        """
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+        s = numpy.int32(s)
+        nb_keypoints = numpy.int32(nb_keypoints)
+        gpu_dogs = pyopencl.array.to_device(queue, DOGS)
+        mask = numpy.ones((height, width), dtype=numpy.uint8)
+        mask[:, width // 2:] = 0
+        mask[height // 4:height // 2, :width // 4] = 0
+        gpu_mask = pyopencl.array.to_device(queue, mask)
+        shape = calc_size((width, height), self.wg)
+        found = []
+        for masked in (False, True):
+            output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+            output.fill(-1.0, queue)
+            counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+            if masked:
+                k1 = self.program.local_maxmin_masked(queue, shape, self.wg, gpu_dogs.data, output.data, gpu_mask.data,
+                                                      border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                                                      counter.data, nb_keypoints, s, width, height)
+            else:
+                k1 = self.program.local_maxmin(queue, shape, self.wg, gpu_dogs.data, output.data,
+                                               border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                                               counter.data, nb_keypoints, s, width, height)
+            res = output.get()[:min(counter.get()[0], nb_keypoints)]
+            found.append(set((int(r), int(c)) for r, c in res[:, 1:3]))
+        ref = set((r, c) for r, c in found[0] if mask[r, c])
+        logger.info("%s keypoints, %s in the mask" % (len(found[0]), len(found[1])))
+        self.assert_(len(ref) < len(found[0]), "some keypoints are masked")
+        self.assert_(found[1] == ref, "masked keypoints are the valid unmasked ones")
+
+    def test_local_maxmin_half(self):
+        """
+        tests the local maximum/minimum detection kernel with DoGs stored as half
+        """
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+        s = numpy.int32(s)
+        nb_keypoints = numpy.int32(nb_keypoints)
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "image.cl")
+        program = pyopencl.Program(ctx, open(kernel_path).read()).build("-D HALF_DOGS")
+        half_dogs = DOGS.astype(numpy.float16)
+        gpu_dogs = pyopencl.array.to_device(queue, half_dogs)
+        output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+        output.fill(-1.0, queue)
+        counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+        shape = calc_size((width, height), self.wg)
+        program.local_maxmin(queue, shape, self.wg, gpu_dogs.data, output.data,
+                             border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                             counter.data, nb_keypoints, s, width, height)
+        res = output.get()[:min(counter.get()[0], nb_keypoints)]
+        # reference calculated in float on the rounded DoGs
+        ref, ref_nb = my_local_maxmin(half_dogs.astype(numpy.float32), peakthresh, border_dist, octsize,
+                                      EdgeThresh0, EdgeThresh, nb_keypoints, s, width, height)
+        ref = ref[:ref_nb]
+        found = set((int(r), int(c)) for r, c in res[:, 1:3])
+        expected = set((int(r), int(c)) for r, c in ref[:, 1:3])
+        logger.info("half DoGs: %s keypoints, %s expected" % (len(found), len(expected)))
+        self.assert_(found == expected, "same keypoints as the float calculation on the rounded DoGs")
+        self.assert_(abs(numpy.sort(res[:, 0]) - numpy.sort(ref[:, 0])).max() < 1e-4, "same peak values")
+
+    def test_local_maxmin_rolling(self):
+        """
+        tests the local maximum/minimum detection kernel on a rolling window of 3 DoGs
+        """
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+        s = numpy.int32(s)
+        nb_keypoints = numpy.int32(nb_keypoints)
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "image.cl")
+        program = pyopencl.Program(ctx, open(kernel_path).read()).build("-D DOG_SLICES=3")
+        window = numpy.empty((3, height, width), dtype=numpy.float32)
+        for dog in (s - 1, s, s + 1):
+            window[dog % 3] = DOGS[dog]
+        shape = calc_size((width, height), self.wg)
+        found = []
+        for prog, dogs in ((self.program, DOGS), (program, window)):
+            gpu_dogs = pyopencl.array.to_device(queue, numpy.ascontiguousarray(dogs))
+            output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+            output.fill(-1.0, queue)
+            counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+            prog.local_maxmin(queue, shape, self.wg, gpu_dogs.data, output.data,
+                              border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                              counter.data, nb_keypoints, s, width, height)
+            res = output.get()[:min(counter.get()[0], nb_keypoints)]
+            found.append(set((float(p), int(r), int(c)) for p, r, c in res[:, :3]))
+        logger.info("%s keypoints with all DoGs, %s with the rolling window" % (len(found[0]), len(found[1])))
+        self.assert_(found[0] == found[1], "same keypoints with the rolling window")
+
+    def test_local_maxmin_octave(self):
+        """
+        tests the extremum detection over all scales of the octave in one launch, and the selection of one scale
+        """
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+        nb_keypoints = numpy.int32(nb_keypoints)
+        nb_scales = numpy.int32(DOGS.shape[0] - 2)
+        gpu_dogs = pyopencl.array.to_device(queue, numpy.ascontiguousarray(DOGS))
+        shape = calc_size((width, height), self.wg)
+        expected = set()
+        for scale in range(1, nb_scales + 1):
+            output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+            counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+            self.program.local_maxmin(queue, shape, self.wg, gpu_dogs.data, output.data,
+                                      border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                                      counter.data, nb_keypoints, numpy.int32(scale), width, height)
+            res = output.get()[:min(counter.get()[0], nb_keypoints)]
+            expected |= set((float(p), int(r), int(c), int(t)) for p, r, c, t in res)
+        wg = (16, 4)
+        candidates = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+        nb_candidates = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+        tile = pyopencl.LocalMemory(4 * 3 * (wg[0] + 2) * (wg[1] + 2))
+        self.program.local_maxmin_octave(queue, calc_size((width, height), wg), wg, gpu_dogs.data, candidates.data, None,
+                                         border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                                         nb_candidates.data, nb_keypoints, nb_scales, width, height, tile)
+        res = candidates.get()[:min(nb_candidates.get()[0], nb_keypoints)]
+        found = set((float(p), int(r), int(c), int(t)) for p, r, c, t in res)
+        logger.info("%s keypoints scale by scale, %s in one launch" % (len(expected), len(found)))
+        self.assert_(found == expected, "same keypoints in one launch")
+
+        output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+        counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+        self.program.select_scale(queue, calc_size((int(nb_keypoints),), (128,)), (128,), candidates.data, nb_candidates.data,
+                                  output.data, counter.data, nb_keypoints, numpy.int32(s))
+        res = output.get()[:min(counter.get()[0], nb_keypoints)]
+        selected = set((float(p), int(r), int(c), int(t)) for p, r, c, t in res)
+        self.assert_(selected == set(k for k in expected if k[3] == s), "keypoints of the scale %s selected" % s)
+
     def test_interpolation(self):
         """
         tests the keypoints interpolation kernel
@@ -266,6 +393,10 @@ def test_suite_image():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_image("test_gradient"))
     testSuite.addTest(test_image("test_local_maxmin"))
+    testSuite.addTest(test_image("test_local_maxmin_masked"))
+    testSuite.addTest(test_image("test_local_maxmin_half"))
+    testSuite.addTest(test_image("test_local_maxmin_rolling"))
+    testSuite.addTest(test_image("test_local_maxmin_octave"))
     testSuite.addTest(test_image("test_interpolation"))
     return testSuite
 
@@ -51,6 +51,7 @@ from test_image_functions import * #for Python implementation of tested function
 from test_image_setup import *
 import sift
 from sift.utils import calc_size
+from sift.param import par
 logger = getLogger(__file__)
 if logger.getEffectiveLevel() <= logging.INFO:
     PROFILE = True
@@ -322,6 +323,129 @@ class test_keypoints(ParameterisedTestCase):
             
             
 
+def matching(kp, ref, tol=1.0, scale_tol=0.1):
+    """
+    @return: number of keypoints of kp having a keypoint of ref closer than
+    tol pixel with the same scale within scale_tol
+    """
+    found = 0
+    for k in kp:
+        d2 = (ref.x - k.x) ** 2 + (ref.y - k.y) ** 2
+        if ((d2 < tol ** 2) & (abs(ref.scale - k.scale) < scale_tol * k.scale)).any():
+            found += 1
+    return found
+
+
+class test_plan(unittest.TestCase):
+    """
+    Tests of the options of SiftPlan, on a whole image
+    """
+    def setUp(self):
+        self.image = scipy.misc.lena().astype(numpy.float32)
+
+    def tearDown(self):
+        self.image = None
+
+    def test_octave_range(self):
+        """
+        tests first_octave and last_octave: keypoints in pixels of the full image
+        """
+        full = sift.SiftPlan(template=self.image, devicetype="gpu")
+        ref = full.keypoints(self.image)
+        plan = sift.SiftPlan(template=self.image, devicetype="gpu", first_octave=1)
+        kp = plan.keypoints(self.image)
+        # keypoints of the octaves >= 1 of the default plan
+        ref = ref[ref.scale > 2 * par.InitSigma]
+        self.assert_(kp.size > 0, "keypoints found from octave 1")
+        self.assert_(kp.scale.min() > 0.9 * 2 * par.InitSigma, "no keypoint of octave 0")
+        found = matching(kp, ref, tol=2.0, scale_tol=0.2)
+        logger.info("first_octave=1: %s keypoints, %s octave >= 1 keypoints in the default plan, %s matching" % (kp.size, ref.size, found))
+        self.assert_(found > 0.5 * kp.size, "keypoints at the same place in full resolution pixels")
+        self.assert_(sift.SiftPlan(template=self.image, devicetype="gpu", last_octave=1).octave_max == 2, "last_octave=1: 2 octaves")
+        self.assert_(plan.octave_max == full.octave_max - 1, "first_octave=1: one octave less")
+        self.assertRaises(RuntimeError, sift.SiftPlan, template=self.image, devicetype="gpu", first_octave=20)
+
+    def test_scale_space(self):
+        """
+        tests the scale space exported with keep_scale_space=True
+        """
+        plan = sift.SiftPlan(template=self.image, devicetype="gpu", keep_scale_space=True)
+        plan.keypoints(self.image)
+        space = plan.scale_space()
+        self.assert_(len(space) == plan.octave_max, "one entry per octave")
+        first = None
+        for octave in space:
+            o = octave["octave"]
+            shape = (self.image.shape[0] // 2 ** o, self.image.shape[1] // 2 ** o)
+            self.assert_(octave["shape"] == shape, "octave %s shape %s" % (o, octave["shape"]))
+            self.assert_(octave["pixel"] == (2 ** o, 2 ** o), "octave %s pixel" % o)
+            self.assert_(len(octave["gaussians"]) == par.Scales + 3, "octave %s levels" % o)
+            sigmas = [par.InitSigma * 2.0 ** (s / par.Scales) for s in range(par.Scales + 3)]
+            self.assert_(abs(numpy.array(octave["sigmas"]) - sigmas).max() < 1e-6, "octave %s sigmas" % o)
+            self.assert_(octave["dogs"].shape == (par.Scales + 2,) + shape, "octave %s DoGs shape" % o)
+            levels = [g.get() for g in octave["gaussians"]]
+            dogs = octave["dogs"].get()
+            for g in levels:
+                self.assert_(isinstance(octave["gaussians"][0], pyopencl.array.Array) and g.shape == shape, "octave %s level shape" % o)
+            for scale in range(par.Scales + 2):
+                delta = abs(dogs[scale] - (levels[scale] - levels[scale + 1])).max()
+                self.assert_(delta < 1e-3, "octave %s DoG %s delta=%s" % (o, scale, delta))
+            if first is None:
+                first = levels[1]
+        self.assert_(first.std() > 1.0, "the levels hold the blurred image")
+        # the arrays exported before are still valid after another call
+        plan.keypoints(self.image)
+        again = space[0]["gaussians"][1].get()
+        self.assert_(abs(again - first).max() < 1e-3, "scale space of the last image")
+
+    def test_capacity(self):
+        """
+        tests the overflow of the keypoint buffers: the octaves which
+        overflowed are calculated again with larger buffers
+        """
+        ref_plan = sift.SiftPlan(template=self.image, devicetype="gpu")
+        ref = ref_plan.keypoints(self.image)
+        plan = sift.SiftPlan(template=self.image, devicetype="gpu", PIX_PER_KP=2000)
+        kpsize = plan.kpsize
+        self.assert_(kpsize < ref.size, "capacity of %s for %s keypoints" % (kpsize, ref.size))
+        kp = plan.keypoints(self.image)
+        logger.info("capacity %s -> %s, %s keypoints, %s with ample capacity" % (kpsize, plan.kpsize, kp.size, ref.size))
+        self.assert_(plan.kpsize > kpsize, "the keypoint buffers grew")
+        self.assert_(kp.size == ref.size, "same number of keypoints")
+        # the order of the keypoints within a scale depends on the scheduling
+        kp = kp[numpy.lexsort((kp.angle, kp.scale, kp.y, kp.x))]
+        ref = ref[numpy.lexsort((ref.angle, ref.scale, ref.y, ref.x))]
+        for name in ("x", "y", "scale", "angle"):
+            delta = abs(kp[name] - ref[name]).max()
+            self.assert_(delta < 1e-3, "%s delta=%s" % (name, delta))
+        self.assert_(abs(kp.desc.astype(int) - ref.desc).max() <= 1, "same descriptors")
+        self.assert_((plan.keypoint_counts() == ref_plan.keypoint_counts()).all(), "same counts per scale")
+
+    def test_max_keypoints(self):
+        """
+        tests max_keypoints: at most N keypoints, secondary orientations included
+        """
+        ref = sift.SiftPlan(template=self.image, devicetype="gpu").keypoints(self.image)
+        for budget in (100, 500):
+            plan = sift.SiftPlan(template=self.image, devicetype="gpu", max_keypoints=budget)
+            kp = plan.keypoints(self.image)
+            locations = numpy.unique(kp.x + 1j * kp.y).size
+            logger.info("max_keypoints=%s: %s keypoints at %s locations, %s without budget" % (budget, kp.size, locations, ref.size))
+            self.assert_(kp.size == budget, "%s keypoints for a budget of %s" % (kp.size, budget))
+            self.assert_(matching(kp, ref, tol=0.01, scale_tol=0.01) == kp.size, "keypoints of the plan without budget")
+        kp = sift.SiftPlan(template=self.image, devicetype="gpu", max_keypoints=2 * ref.size).keypoints(self.image)
+        self.assert_(kp.size == ref.size, "all the keypoints fit in the budget")
+
+
+def test_suite_plan():
+    testSuite = unittest.TestSuite()
+    testSuite.addTest(test_plan("test_octave_range"))
+    testSuite.addTest(test_plan("test_scale_space"))
+    testSuite.addTest(test_plan("test_capacity"))
+    testSuite.addTest(test_plan("test_max_keypoints"))
+    return testSuite
+
+
 def test_suite_keypoints():
     testSuite = unittest.TestSuite()
     TESTCASES = [{"orientation_gpu":(128,), "keypoints_gpu2":(8, 8, 8)},
@@ -422,6 +422,89 @@ class test_preproc(unittest.TestCase):
         self.assert_(delta < 1e-6, "delta=%s" % delta)
 
 
+    def test_mask_shrink(self):
+        """
+        Test the shrinking of a mask: valid only if the whole block is valid
+        """
+        mask = numpy.ones(self.input.shape, dtype=numpy.uint8)
+        mask[100:103, 200:207] = 0
+        mask[-1, -1] = 0
+        out_shape = tuple(int(math.ceil(float(i) / j)) for i, j in zip(self.input.shape, self.binning))
+        mask_gpu = pyopencl.array.to_device(queue, mask)
+        out_gpu = pyopencl.array.empty(queue, out_shape, dtype=numpy.uint8)
+        k1 = self.program.mask_shrink(queue, calc_size((out_shape[1], out_shape[0]), self.wg), self.wg, mask_gpu.data, out_gpu.data,
+                                      numpy.int32(self.binning[1]), numpy.int32(self.binning[0]),
+                                      numpy.int32(mask.shape[1]), numpy.int32(mask.shape[0]),
+                                      numpy.int32(out_shape[1]), numpy.int32(out_shape[0]))
+        res = out_gpu.get()
+        big = numpy.ones([i * j for i, j in zip(out_shape, self.binning)], dtype=numpy.uint8)
+        big[:mask.shape[0], :mask.shape[1]] = mask
+        ref = big.reshape(out_shape[0], self.binning[0], out_shape[1], self.binning[1]).min(axis=3).min(axis=1)
+        if PROFILE:
+            logger.info("Mask shrinking took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
+        self.assert_((res == ref).all(), "mask shrink matches: %s errors" % (res != ref).sum())
+        self.assert_(res.sum() < res.size, "some pixels are masked")
+
+    def test_max_min_fused(self):
+        """
+        tests the conversion kernels with fused max/min reduction
+        """
+        kernels = [(numpy.uint8, "u8_to_float_max_min"), (numpy.uint16, "u16_to_float_max_min"),
+                   (numpy.int16, "s16_to_float_max_min"), (numpy.uint32, "u32_to_float_max_min"),
+                   (numpy.int32, "s32_to_float_max_min"), (numpy.int64, "s64_to_float_max_min"),
+                   (numpy.float64, "f64w_to_float_max_min")]
+        if "cl_khr_fp64" in ctx.devices[0].extensions:
+            kernels.append((numpy.float64, "f64_to_float_max_min"))
+        for dtype, kernel in kernels:
+            lint = (self.input + 7).astype(dtype)
+            if dtype == numpy.float64:
+                lint = lint / 3.0 - 7
+            t0 = time.time()
+            au8 = pyopencl.array.to_device(queue, lint)
+            k1 = self.program.__getattr__(kernel)(queue, (self.red_size * self.red_size,), (self.red_size,),
+                                                 au8.data, self.gpudata.data, self.buffers_max_min.data,
+                                                 numpy.int32(lint.size))
+            k2 = self.reduction.max_min_global_stage2(queue, (self.red_size,), (self.red_size,),
+                                                      self.buffers_max_min.data,
+                                                      self.buffers_max.data,
+                                                      self.buffers_min.data)
+            k2.wait()
+            t1 = time.time()
+            ref = lint.astype(numpy.float32)
+            delta = abs(ref - self.gpudata.get()).max()
+            if PROFILE:
+                logger.info("Conversion %s->float + reduction stage1 took %.3fms" % (numpy.dtype(dtype), 1e-6 * (k1.profile.end - k1.profile.start)))
+                logger.info("Reduction stage2 took %.3fms" % (1e-6 * (k2.profile.end - k2.profile.start)))
+            self.assert_(delta == 0, "conversion %s: delta=%s" % (kernel, delta))
+            self.assertEqual(self.buffers_max.get()[0], ref.max(), "max is OK for %s" % kernel)
+            self.assertEqual(self.buffers_min.get()[0], ref.min(), "min is OK for %s" % kernel)
+
+    def test_rgb16(self):
+        """
+        tests the 16 bits RGB and RGBA kernel with fused max/min reduction
+        """
+        for channels in (3, 4):
+            lint = numpy.empty((self.input.shape[0], self.input.shape[1], channels), dtype=numpy.uint16)
+            for i in range(channels):
+                lint[:, :, i] = self.input.astype(numpy.uint16) * (i + 1)
+            au16 = pyopencl.array.to_device(queue, lint)
+            k1 = self.program.rgb16_to_float_max_min(queue, (self.red_size * self.red_size,), (self.red_size,),
+                                                     au16.data, self.gpudata.data, self.buffers_max_min.data,
+                                                     numpy.int32(self.input.size), numpy.int32(channels))
+            k2 = self.reduction.max_min_global_stage2(queue, (self.red_size,), (self.red_size,),
+                                                      self.buffers_max_min.data,
+                                                      self.buffers_max.data,
+                                                      self.buffers_min.data)
+            k2.wait()
+            ref = 0.299 * lint[:, :, 0] + 0.587 * lint[:, :, 1] + 0.114 * lint[:, :, 2]
+            res = self.gpudata.get()
+            delta = abs(ref - res).max()
+            if PROFILE:
+                logger.info("Conversion RGB16(%s) ->float + reduction stage1 took %.3fms" % (channels, 1e-6 * (k1.profile.end - k1.profile.start)))
+            self.assert_(delta < 1e-3, "%s channels: delta=%s" % (channels, delta))
+            self.assert_(abs(self.buffers_max.get()[0] - res.max()) < 1e-3, "max is OK")
+            self.assert_(abs(self.buffers_min.get()[0] - res.min()) < 1e-3, "min is OK")
+
 
 def test_suite_preproc():
     testSuite = unittest.TestSuite()
@@ -430,8 +513,11 @@ def test_suite_preproc():
     testSuite.addTest(test_preproc("test_int32"))
     testSuite.addTest(test_preproc("test_int64"))
     testSuite.addTest(test_preproc("test_rgb"))
+    testSuite.addTest(test_preproc("test_max_min_fused"))
+    testSuite.addTest(test_preproc("test_rgb16"))
     testSuite.addTest(test_preproc("test_shrink"))
     testSuite.addTest(test_preproc("test_bin"))
+    testSuite.addTest(test_preproc("test_mask_shrink"))
     return testSuite
 
 if __name__ == '__main__':